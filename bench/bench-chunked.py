@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+"""
+Benchmark scotch.chunked.ChunkedDecoder against large chunked bodies.
+
+For comparison, this also times the old buffer-slicing algorithm from
+Webcleaner's UnchunkStream, which re-slices its whole buffer after every
+chunk and so goes quadratic when it's fed large blocks.
+
+    bench-chunked.py [--size MB] [--chunk BYTES] [--read BYTES]
+"""
+import sys, time
+from optparse import OptionParser
+
+import _path
+from scotch.chunked import ChunkedDecoder
+
+class _SlicingDecoder:
+    """
+    The UnchunkStream algorithm, minus the logging.
+    """
+    def __init__(self):
+        self.buf = ''
+        self.bytes_remaining = None
+        self.closed = False
+
+    def decode(self, s):
+        self.buf += s
+        s = ''
+
+        while self.buf and not self.closed:
+            if self.bytes_remaining is None:
+                i = self.buf.find('\n')
+                if i < 0:
+                    break
+                line = self.buf[:i].strip()
+                self.buf = self.buf[i+1:]
+                if line:
+                    self.bytes_remaining = int(line.split(';')[0], 16)
+                    if self.bytes_remaining == 0:
+                        self.closed = True
+            if self.bytes_remaining is not None:
+                data = self.buf[:self.bytes_remaining]
+                s += data
+                self.buf = self.buf[self.bytes_remaining:]
+                self.bytes_remaining -= len(data)
+                if self.bytes_remaining == 0:
+                    self.bytes_remaining = None
+        return s
+
+def make_body(size, chunk_size):
+    chunk = 'x' * chunk_size
+    n = size // chunk_size
+
+    pieces = [ '%x\r\n%s\r\n' % (chunk_size, chunk) ] * n
+    pieces.append('0\r\nX-Trailer: yes\r\n\r\n')
+    return "".join(pieces), n * chunk_size
+
+def run(decoder_class, body, read_size):
+    decoder = decoder_class()
+
+    start = time.time()
+    total = 0
+    for i in xrange(0, len(body), read_size):
+        total += len(decoder.decode(body[i:i + read_size]))
+    return time.time() - start, total
+
+###
+
+option_parser = OptionParser()
+option_parser.add_option('--size', action='store', dest='size', type='int',
+                         default=16, help='body size, in MB')
+option_parser.add_option('--chunk', action='store', dest='chunk',
+                         type='int', default=1024, help='chunk size')
+option_parser.add_option('--read', action='append', dest='read', type='int',
+                         help='read size(s) to feed the decoder')
+option_parser.add_option('--no-slicing', action='store_true',
+                         dest='no_slicing',
+                         help="don't time the old slicing decoder")
+
+(options, args) = option_parser.parse_args(sys.argv[1:])
+
+read_sizes = options.read or [4096, 65536, 1024*1024]
+body, expected = make_body(options.size * 1024 * 1024, options.chunk)
+
+print '%d MB body, %d-byte chunks' % (options.size, options.chunk)
+
+decoders = [('ChunkedDecoder', ChunkedDecoder)]
+if not options.no_slicing:
+    decoders.append(('slicing', _SlicingDecoder))
+
+for read_size in read_sizes:
+    for name, decoder_class in decoders:
+        elapsed, total = run(decoder_class, body, read_size)
+        assert total == expected
+
+        print '%-16s read=%-8d %8.3fs %8.1f MB/s' % \
+              (name, read_size, elapsed, options.size / max(elapsed, 1e-9))
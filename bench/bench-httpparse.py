@@ -0,0 +1,192 @@
+#! /usr/bin/env python
+"""
+Benchmark reading responses through scotch.httpparse.ResponseParser and
+the current scotch.pool.Connection, against the readline-based
+head reader and string-splitting _parse_server_response that
+scotch.proxy used before.
+
+The responses come from an in-memory socket, so this times the parsing
+and buffering alone.
+
+    bench-httpparse.py [--n N] [--body BYTES] [--read BYTES]
+"""
+import sys, time
+from optparse import OptionParser
+
+import _path
+from scotch.pool import Connection
+from scotch.httpparse import ResponseParser
+from scotch.proxy import _wsgi_response
+
+class _FakeSocket:
+    """
+    Hand out a canned response, 'read_size' bytes at a time.
+    """
+    def __init__(self, data, read_size):
+        self.data = data
+        self.pos = 0
+        self.read_size = read_size
+
+    def recv(self, n):
+        n = min(n, self.read_size)
+        data = self.data[self.pos:self.pos + n]
+        self.pos += len(data)
+        return data
+
+class _NewConnection(Connection):
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ''
+
+class _OldConnection:
+    """
+    The old string-buffered scotch.pool.Connection.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ''
+        self.pos = 0
+
+    def readline(self):
+        while 1:
+            i = self.buf.find('\n', self.pos)
+            if i >= 0:
+                line = self.buf[self.pos:i + 1]
+                self.pos = i + 1
+                return line
+
+            data = self.sock.recv(4096)
+            if not data:
+                line = self.buf[self.pos:]
+                self.buf, self.pos = '', 0
+                return line
+
+            self.buf = self.buf[self.pos:] + data
+            self.pos = 0
+
+    def read_some(self, n):
+        if self.pos < len(self.buf):
+            data = self.buf[self.pos:self.pos + n]
+            self.pos += len(data)
+            if self.pos == len(self.buf):
+                self.buf, self.pos = '', 0
+            return data
+
+        return self.sock.recv(n)
+
+_hoppish = {
+    'connection':1, 'keep-alive':1, 'proxy-authenticate':1,
+    'proxy-authorization':1, 'te':1, 'trailers':1, 'transfer-encoding':1,
+    'upgrade':1
+    }
+
+def old_read_response(conn):
+    """
+    The old _read_response_head, _parse_response_head & (part of)
+    _response_framing, followed by _parse_server_response, and then the
+    body read with _iter_exactly.
+    """
+    lines = []
+    while 1:
+        line = conn.readline()
+        if not lines and not line.strip():
+            continue
+        lines.append(line)
+        if not line.strip():
+            break
+
+    status_line = lines[0].split(None, 2)
+    version, status_code = status_line[0], int(status_line[1])
+
+    headers = {}
+    for line in lines[1:-1]:
+        if ':' not in line:
+            continue
+        k, v = line.split(':', 1)
+        k, v = k.strip().lower(), v.strip()
+        if headers.has_key(k):
+            v = headers[k] + ', ' + v
+        headers[k] = v
+
+    length = int(headers['content-length'])
+
+    response = "".join(lines)
+    status_line, response = response.split("\r\n", 1)
+    wsgi_headers, _ = response.split("\r\n\r\n", 1)
+
+    status = status_line.split(' ', 1)[1]
+    wsgi_headers = wsgi_headers.split("\r\n")
+    wsgi_headers = [ h.split(':', 1) for h in wsgi_headers ]
+
+    new_headers = []
+    for (a, b) in wsgi_headers:
+        if not _hoppish.has_key(a.lower()):
+            new_headers.append((a, b[1:]))
+
+    while length > 0:
+        data = conn.read_some(min(length, 4096))
+        length -= len(data)
+
+def new_read_response(conn):
+    """
+    What _ProxyRequest.receive_head and iter_body do now.
+    """
+    parser = ResponseParser()
+    while parser.headers is None:
+        events = parser.feed(conn.read_some(conn.BUFSIZE))
+
+    status, headers = _wsgi_response(parser.status_code, parser.reason,
+                                     parser.headers)
+
+    while 1:
+        for (event, value) in events:
+            if event == 'end':
+                return
+        events = parser.feed(conn.read_some(conn.BUFSIZE))
+
+def make_response(body_size):
+    body = 'x' * body_size
+    head = [ 'HTTP/1.1 200 OK',
+             'Date: Mon, 19 Oct 2026 12:00:00 GMT',
+             'Server: Apache/2.4.41 (Ubuntu)',
+             'Content-Type: text/html; charset=utf-8',
+             'Content-Length: %d' % (len(body),),
+             'Cache-Control: private, max-age=0',
+             'Connection: keep-alive' ]
+    head += [ 'X-Header-%d: %s' % (i, 'v' * 40) for i in range(10) ]
+
+    return '\r\n'.join(head) + '\r\n\r\n' + body
+
+def run(read_response, connection_class, response, read_size, n):
+    start = time.time()
+    for i in xrange(n):
+        conn = connection_class(_FakeSocket(response, read_size))
+        read_response(conn)
+    return time.time() - start
+
+###
+
+option_parser = OptionParser()
+option_parser.add_option('--n', action='store', dest='n', type='int',
+                         default=20000, help='responses to parse')
+option_parser.add_option('--body', action='append', dest='body', type='int',
+                         help='body size(s)')
+option_parser.add_option('--read', action='store', dest='read', type='int',
+                         default=4096, help='bytes per recv')
+
+(options, args) = option_parser.parse_args(sys.argv[1:])
+
+for body_size in options.body or [0, 16*1024, 1024*1024]:
+    response = make_response(body_size)
+    n = max(1, options.n * 1024 // max(1024, body_size))
+
+    print '%d-byte body, %d responses, recv=%d' % (body_size, n,
+                                                   options.read)
+
+    for name, read_response, connection_class in \
+            (('old', old_read_response, _OldConnection),
+             ('ResponseParser', new_read_response, _NewConnection)):
+        elapsed = run(read_response, connection_class, response,
+                      options.read, n)
+        print '  %-16s %8.3fs %10.0f responses/s' % \
+              (name, elapsed, n / max(elapsed, 1e-9))
@@ -0,0 +1,317 @@
+#! /usr/bin/env python
+"""
+Benchmark the proxy & the recording proxy end to end, against a local
+stand-in upstream server.
+
+The upstream server, the proxy and the load-generating client each run
+in their own process.  The upstream serves bodies of --body bytes
+(Content-Length delimited, or --chunked), after --latency seconds, and
+keeps its connections open unless --no-keepalive is given.  The client
+sends --requests requests through the proxy, --concurrency at a time,
+and reports requests per second, latency percentiles, and the proxy
+process's CPU time & peak RSS.
+
+    bench-proxy.py [--mode proxy|recording ...] [--requests N]
+                   [--concurrency N] [--threads N] [--body BYTES]
+                   [--chunked] [--latency SECONDS] [--no-keepalive]
+                   [--output results.json] [--compare old-results.json]
+
+With --output, the results are saved as JSON; with --compare, they're
+compared against an earlier run's.
+"""
+import sys, os, time, signal, socket, threading, httplib, json
+import BaseHTTPServer, SocketServer
+from optparse import OptionParser
+from wsgiref.simple_server import WSGIRequestHandler
+
+import _path
+import scotch.proxy, scotch.recorder, scotch.server
+
+MODES = ('proxy', 'recording')
+
+###
+
+class _UpstreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answer every GET with the configured body.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # the head & body go out in separate writes; without this, Nagle
+        # and delayed ACKs stall every response on a reused connection
+        # by ~40ms, which would swamp whatever the proxy is doing.
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        options = self.server.options
+        if options.latency:
+            time.sleep(options.latency)
+
+        self.send_response(200)
+        self.send_header('Content-type', 'application/octet-stream')
+        if not options.keepalive:
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+
+        body = self.server.body
+        if options.chunked:
+            self.send_header('Transfer-encoding', 'chunked')
+            self.end_headers()
+
+            for i in range(0, len(body), 8192):
+                piece = body[i:i + 8192]
+                self.wfile.write('%x\r\n%s\r\n' % (len(piece), piece))
+            self.wfile.write('0\r\n\r\n')
+        else:
+            self.send_header('Content-length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class _UpstreamServer(SocketServer.ThreadingMixIn,
+                      BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        pass
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def _fork(serve):
+    """
+    Run serve() in a child process; return its pid.
+    """
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, lambda *args: os._exit(0))
+        try:
+            serve()
+        finally:
+            os._exit(0)
+    return pid
+
+def start_upstream(options):
+    server = _UpstreamServer(('127.0.0.1', 0), _UpstreamHandler)
+    server.options = options
+    server.body = 'x' * options.body
+
+    pid = _fork(server.serve_forever)
+    server.server_close()
+
+    return pid, server.server_address
+
+def start_proxy(mode, options):
+    if mode == 'recording':
+        app = scotch.recorder.Recorder(scotch.proxy.ProxyApp())
+    else:
+        app = scotch.proxy.ProxyApp()
+
+    httpd = scotch.server.make_server(('127.0.0.1', 0), app, _QuietHandler,
+                                      threads=options.threads)
+    httpd.socket.listen(128)            # rather than SocketServer's 5.
+
+    pid = _fork(lambda: scotch.server.serve_until_interrupted(httpd))
+    address = httpd.socket.getsockname()
+    httpd.server_close()
+
+    return pid, address
+
+def stop(pid):
+    """
+    Stop a child process; return its resource usage.
+    """
+    os.kill(pid, signal.SIGTERM)
+    (_, _, rusage) = os.wait4(pid, 0)
+    return rusage
+
+def drive(proxy_address, url, n_requests, concurrency):
+    """
+    Send 'n_requests' GETs for 'url' through the proxy, 'concurrency' at
+    a time; return (elapsed time, list of latencies, number of errors).
+    """
+    latencies = []
+    errors = []
+    counter = iter(xrange(n_requests))
+    lock = threading.Lock()
+
+    def client():
+        while 1:
+            lock.acquire()
+            try:
+                try:
+                    counter.next()
+                except StopIteration:
+                    return
+            finally:
+                lock.release()
+
+            start = time.time()
+            try:
+                conn = httplib.HTTPConnection(*proxy_address)
+                conn.request('GET', url)
+                response = conn.getresponse()
+                response.read()
+                conn.close()
+                ok = (response.status == 200)
+            except (socket.error, httplib.HTTPException):
+                ok = False
+
+            if ok:
+                latencies.append(time.time() - start)
+            else:
+                errors.append(1)
+
+    threads = [ threading.Thread(target=client) for i in range(concurrency) ]
+
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    return elapsed, latencies, len(errors)
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    i = int(round(p / 100.0 * (len(values) - 1)))
+    return values[i]
+
+def run(mode, upstream_address, options):
+    (pid, proxy_address) = start_proxy(mode, options)
+    url = 'http://%s:%d/bench' % upstream_address
+
+    try:
+        drive(proxy_address, url, options.warmup, options.concurrency)
+        (elapsed, latencies, errors) = drive(proxy_address, url,
+                                             options.requests,
+                                             options.concurrency)
+    finally:
+        rusage = stop(pid)
+
+    ms = lambda t: t is not None and round(t * 1000, 3) or None
+    cpu = rusage.ru_utime + rusage.ru_stime
+
+    return { 'mode' : mode,
+             'requests' : len(latencies),
+             'errors' : errors,
+             'elapsed' : round(elapsed, 3),
+             'rps' : round(len(latencies) / elapsed, 1),
+             'latency_ms' : { 'p50' : ms(percentile(latencies, 50)),
+                              'p90' : ms(percentile(latencies, 90)),
+                              'p99' : ms(percentile(latencies, 99)),
+                              'max' : ms(percentile(latencies, 100)) },
+             'proxy_cpu_s' : round(cpu, 3),
+             'proxy_cpu_per_request_ms' : round(cpu * 1000 /
+                                                max(1, len(latencies)), 3),
+             'proxy_max_rss_kb' : rusage.ru_maxrss }
+
+def compare(results, old_results):
+    """
+    Print the change in each result from an earlier run.
+    """
+    old = dict([ (r['mode'], r) for r in old_results['results'] ])
+
+    for r in results:
+        o = old.get(r['mode'])
+        if o is None:
+            continue
+
+        print '%s vs. previous run:' % (r['mode'],)
+        for (name, get) in (('rps', lambda r: r['rps']),
+                            ('p50 ms', lambda r: r['latency_ms']['p50']),
+                            ('p99 ms', lambda r: r['latency_ms']['p99']),
+                            ('cpu/request ms',
+                             lambda r: r['proxy_cpu_per_request_ms']),
+                            ('max rss kb', lambda r: r['proxy_max_rss_kb'])):
+            (new_value, old_value) = (get(r), get(o))
+            if new_value is None or not old_value:
+                continue
+            change = 100.0 * (new_value - old_value) / old_value
+            print '  %-16s %12s -> %-12s (%+.1f%%)' % (name, old_value,
+                                                       new_value, change)
+
+###
+
+option_parser = OptionParser()
+option_parser.add_option('--mode', action='append', dest='modes',
+                         choices=MODES, help='proxy and/or recording')
+option_parser.add_option('--requests', action='store', type='int',
+                         dest='requests', default=2000,
+                         help='requests to time, per mode')
+option_parser.add_option('--warmup', action='store', type='int',
+                         dest='warmup', default=100,
+                         help='requests to send before timing')
+option_parser.add_option('--concurrency', action='store', type='int',
+                         dest='concurrency', default=8,
+                         help='requests in flight at once')
+option_parser.add_option('--threads', action='store', type='int',
+                         dest='threads', default=8,
+                         help='proxy server threads')
+option_parser.add_option('--body', action='store', type='int', dest='body',
+                         default=4096, help='upstream body size')
+option_parser.add_option('--chunked', action='store_true', dest='chunked',
+                         help='send chunked upstream bodies')
+option_parser.add_option('--latency', action='store', type='float',
+                         dest='latency', default=0,
+                         help='upstream delay before answering, in seconds')
+option_parser.add_option('--no-keepalive', action='store_false',
+                         dest='keepalive', default=True,
+                         help='close upstream connections after each response')
+option_parser.add_option('--output', action='store', dest='output',
+                         help='save the results to this JSON file')
+option_parser.add_option('--compare', action='store', dest='compare',
+                         help='compare against results saved earlier')
+
+(options, args) = option_parser.parse_args(sys.argv[1:])
+
+config = dict([ (k, getattr(options, k)) for k in
+                ('requests', 'warmup', 'concurrency', 'threads', 'body',
+                 'chunked', 'latency', 'keepalive') ])
+
+print 'config: %s' % (', '.join([ '%s=%s' % (k, config[k])
+                                  for k in sorted(config) ]),)
+
+(upstream_pid, upstream_address) = start_upstream(options)
+
+results = []
+try:
+    for mode in options.modes or MODES:
+        r = run(mode, upstream_address, options)
+        results.append(r)
+
+        print '%-10s %8.1f req/s   p50 %s ms  p90 %s ms  p99 %s ms  ' \
+              'max %s ms   %d errors' % (mode, r['rps'],
+                                         r['latency_ms']['p50'],
+                                         r['latency_ms']['p90'],
+                                         r['latency_ms']['p99'],
+                                         r['latency_ms']['max'], r['errors'])
+        print '%-10s cpu %.3fs (%.3f ms/request), max rss %d KB' % \
+              ('', r['proxy_cpu_s'], r['proxy_cpu_per_request_ms'],
+               r['proxy_max_rss_kb'])
+finally:
+    stop(upstream_pid)
+
+output = { 'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python' : sys.version.split()[0],
+           'config' : config,
+           'results' : results }
+
+if options.output:
+    fp = open(options.output, 'w')
+    json.dump(output, fp, indent=2, sort_keys=True)
+    fp.write('\n')
+    fp.close()
+    print 'saved results to', options.output
+
+if options.compare:
+    compare(results, json.load(open(options.compare)))
@@ -0,0 +1,370 @@
+#! /usr/bin/env python
+"""
+Benchmark the recorder and the tools that work on recordings, over a
+synthetic recording of --records records.
+
+The records mix HTML pages, images, scripts, stylesheets & JSON; GETs,
+form POSTs and redirects; and bodies from a few hundred bytes to a
+megabyte (see make_records).  This times:
+
+ * Recorder.__call__ -- the overhead per request, over a bare app;
+ * Recorder.save & Recorder.load;
+ * bin/display-recorded-session, run on the saved recording;
+ * each of the scotch.utils.filter_* functions, over every record;
+ * compare.is_same_response, over every record;
+ * twill_commands.next_record, stepping through the whole recording.
+
+    bench-recorder.py [--records N] [--body-scale X] [--seed N]
+                      [--only NAME ...] [--output results.json]
+                      [--history history.jsonl]
+
+Records average about 6KB of body; for recordings of a million records,
+shrink the bodies with e.g. --body-scale 0.05 to keep them in memory.
+
+--history appends the results to a file, one JSON object per line, and
+prints the change from the last run there with the same settings; that
+makes it easy to see what a change to the storage or the tools did.
+"""
+import sys, os, time, random, tempfile, subprocess, json
+from cStringIO import StringIO
+from optparse import OptionParser
+
+import _path
+from scotch.recorder import Recorder, RecordHolder, Record, Response
+from scotch import utils, compare, twill_commands
+
+BINDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+
+# (weight, content type, status, method, body sizes)
+_KINDS = [ (20, 'text/html; charset=utf-8', '200 OK', 'GET',
+            (2000, 20000, 100000)),
+           (5, 'text/html; charset=utf-8', '200 OK', 'POST', (2000, 20000)),
+           (5, 'text/html', '302 Found', 'POST', (0,)),
+           (5, 'text/html', '302 Found', 'GET', (0,)),
+           (30, 'image/png', '200 OK', 'GET', (500, 5000, 50000, 1000000)),
+           (15, 'application/x-javascript', '200 OK', 'GET', (5000, 100000)),
+           (10, 'text/css', '200 OK', 'GET', (2000, 30000)),
+           (10, 'application/json', '200 OK', 'GET', (200, 2000)) ]
+
+def make_records(n, seed=0, body_scale=1.0):
+    """
+    Build a RecordHolder full of 'n' plausible-looking records.
+    """
+    rand = random.Random(seed)
+
+    kinds = []
+    for (weight, content_type, status, method, sizes) in _KINDS:
+        kinds += [ (content_type, status, method, sizes) ] * weight
+
+    # slices of this are new strings, so the records don't share bodies.
+    filler = ''.join([ chr(rand.randrange(32, 127)) for i in range(4096) ])
+    filler = filler * (1 + 1000000 // len(filler))
+
+    holder = RecordHolder()
+    for i in xrange(n):
+        (content_type, status, method, sizes) = rand.choice(kinds)
+
+        # mostly the smaller sizes.
+        size = sizes[min(int(rand.expovariate(2)), len(sizes) - 1)]
+        size = int(size * body_scale)
+        start = rand.randrange(0, len(filler) - size + 1)
+        body = filler[start:start + size]
+
+        inp = ''
+        query_string = ''
+        if method == 'POST':
+            inp = 'username=user%d&password=secret&submit=Login' % (i,)
+        elif rand.random() < 0.2:
+            query_string = 'page=%d&q=search+terms' % (i,)
+
+        environ = { 'REQUEST_METHOD' : method,
+                    'PATH_INFO' : 'http://www.example.com/path/%d' % (i,),
+                    'QUERY_STRING' : query_string,
+                    'SERVER_PROTOCOL' : 'HTTP/1.1',
+                    'REMOTE_ADDR' : '10.0.0.%d' % (i % 8,),
+                    'HTTP_HOST' : 'www.example.com',
+                    'HTTP_USER_AGENT' : 'Mozilla/5.0 (bench)',
+                    'HTTP_ACCEPT' : '*/*' }
+        if inp:
+            environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+            environ['CONTENT_LENGTH'] = str(len(inp))
+
+        response = Response()
+        response.status = status
+        response.headers = [ ('Content-Type', content_type),
+                             ('Content-Length', str(len(body))),
+                             ('Date', 'Mon, 19 Oct 2026 12:00:00 GMT'),
+                             ('Server', 'Apache') ]
+        if status.startswith('302'):
+            response.headers.append(('Location',
+                                     'http://www.example.com/next/%d' % (i,)))
+        response.content_list = [body]
+        response.errout = ''
+
+        holder.add_record(Record(environ, inp, response, timestamp=i))
+
+    return holder
+
+class _Null:
+    def write(self, s):
+        pass
+
+def _quietly(fn, *args):
+    """
+    Call fn(*args) with stdout thrown away.
+    """
+    stdout = sys.stdout
+    sys.stdout = _Null()
+    try:
+        return fn(*args)
+    finally:
+        sys.stdout = stdout
+
+def _timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+### the benchmarks; each takes the records & a scratch directory, and
+### returns a dictionary of results.
+
+def bench_recorder_call(holder, tmpdir):
+    body = ['x' * 2000]
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-type', 'text/html')])
+        return body
+
+    def start_response(status, headers):
+        return None
+
+    def run(app, n):
+        for i in xrange(n):
+            environ = { 'REQUEST_METHOD' : 'GET', 'PATH_INFO' : '/%d' % (i,),
+                        'wsgi.input' : StringIO(''),
+                        'wsgi.errors' : StringIO() }
+            for data in app(environ, start_response):
+                pass
+
+    n = min(len(holder), 100000)
+    bare = _timed(run, app, n)
+    recorded = _timed(run, Recorder(app), n)
+
+    return { 'requests' : n,
+             'overhead_us' : round((recorded - bare) * 1e6 / n, 2) }
+
+def bench_save_load(holder, tmpdir):
+    filename = os.path.join(tmpdir, 'recording.pickle')
+
+    recorder = Recorder(None, holder)
+    fp = open(filename, 'wb')
+    save = _timed(recorder.save, fp)
+    fp.close()
+
+    recorder = Recorder(None)
+    fp = open(filename, 'rb')
+    load = _timed(recorder.load, fp)
+    fp.close()
+
+    assert len(recorder.record_holder) == len(holder)
+    size = os.path.getsize(filename)
+
+    return { 'save_s' : round(save, 3), 'load_s' : round(load, 3),
+             'file_mb' : round(size / 1048576.0, 1),
+             'load_records_per_s' : round(len(holder) / max(load, 1e-9)) }
+
+def _saved(holder, tmpdir):
+    """
+    Return the name of a file holding the recording.
+    """
+    filename = os.path.join(tmpdir, 'recording.pickle')
+    if not os.path.exists(filename):
+        fp = open(filename, 'wb')
+        Recorder(None, holder).save(fp)
+        fp.close()
+    return filename
+
+def bench_display(holder, tmpdir):
+    filename = _saved(holder, tmpdir)
+
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    subprocess.check_call([sys.executable,
+                           os.path.join(BINDIR, 'display-recorded-session'),
+                           filename], stdout=devnull)
+    elapsed = time.time() - start
+    devnull.close()
+
+    return { 'elapsed_s' : round(elapsed, 3) }
+
+def bench_filters(holder, tmpdir):
+    results = {}
+    for name in sorted(dir(utils)):
+        if not name.startswith('filter_'):
+            continue
+        fn = getattr(utils, name)
+
+        start = time.time()
+        n = len([ r for r in holder if fn(r) ])
+        elapsed = time.time() - start
+
+        results[name] = { 'elapsed_ms' : round(elapsed * 1000, 1),
+                          'matched' : n }
+    return results
+
+def bench_compare(holder, tmpdir):
+    records = list(holder)
+
+    def run():
+        same = 0
+        for (r1, r2) in zip(records, records[:1] + records[:-1]):
+            same += compare.is_same_response(r1.response, r1.response)
+            compare.is_same_response(r1.response, r2.response)
+        return same
+
+    elapsed = _timed(run)
+    n = 2 * len(records)
+    return { 'comparisons' : n,
+             'per_comparison_us' : round(elapsed * 1e6 / n, 2) }
+
+def bench_next_record(holder, tmpdir):
+    filename = _saved(holder, tmpdir)
+    load = _timed(_quietly, twill_commands.load_recording, filename)
+
+    def walk():
+        twill_commands.record_index = -1
+        steps = 0
+        while 1:
+            i = twill_commands.record_index
+            twill_commands.next_record()
+            if twill_commands.record_index == i:
+                return steps
+            steps += 1
+
+    start = time.time()
+    steps = _quietly(walk)
+    elapsed = time.time() - start
+
+    return { 'load_s' : round(load, 3),
+             'elapsed_ms' : round(elapsed * 1000, 1), 'steps' : steps }
+
+BENCHMARKS = [ ('recorder_call', bench_recorder_call),
+               ('save_load', bench_save_load),
+               ('display', bench_display),
+               ('filters', bench_filters),
+               ('compare', bench_compare),
+               ('next_record', bench_next_record) ]
+
+def _flatten(results, prefix=''):
+    """
+    Flatten nested result dictionaries into { 'a.b.c' : value }.
+    """
+    flat = {}
+    for (k, v) in results.items():
+        if isinstance(v, dict):
+            flat.update(_flatten(v, prefix + k + '.'))
+        else:
+            flat[prefix + k] = v
+    return flat
+
+def compare_history(output, history_file):
+    """
+    Print the change from the last run in 'history_file' with the same
+    configuration.
+    """
+    previous = None
+    try:
+        for line in open(history_file):
+            line = line.strip()
+            if line:
+                run = json.loads(line)
+                if run['config'] == output['config']:
+                    previous = run
+    except IOError:
+        pass
+
+    if previous is None:
+        print 'no previous run with these settings in', history_file
+        return
+
+    print 'change since %s (%s):' % (previous['time'], previous['revision'])
+    old = _flatten(previous['results'])
+    new = _flatten(output['results'])
+    for k in sorted(new):
+        if k in old and isinstance(new[k], (int, float)) and old[k]:
+            change = 100.0 * (new[k] - old[k]) / old[k]
+            if abs(change) >= 1:
+                print '  %-52s %10s -> %-10s (%+.1f%%)' % (k, old[k], new[k],
+                                                           change)
+
+def _revision():
+    try:
+        p = subprocess.Popen(['git', 'describe', '--always', '--dirty'],
+                             cwd=BINDIR, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        return p.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+###
+
+option_parser = OptionParser()
+option_parser.add_option('--records', action='store', type='int',
+                         dest='records', default=10000,
+                         help='records in the synthetic recording')
+option_parser.add_option('--body-scale', action='store', type='float',
+                         dest='body_scale', default=1.0,
+                         help='multiply the body sizes by this')
+option_parser.add_option('--seed', action='store', type='int', dest='seed',
+                         default=0, help='random seed for the recording')
+option_parser.add_option('--only', action='append', dest='only',
+                         choices=[ name for (name, _) in BENCHMARKS ],
+                         help='run just this benchmark')
+option_parser.add_option('--output', action='store', dest='output',
+                         help='save the results to this JSON file')
+option_parser.add_option('--history', action='store', dest='history',
+                         help='append the results to this file, and compare '
+                              'them with the last run there')
+
+(options, args) = option_parser.parse_args(sys.argv[1:])
+
+start = time.time()
+holder = make_records(options.records, options.seed, options.body_scale)
+print 'built %d records in %.1fs' % (len(holder), time.time() - start)
+
+tmpdir = tempfile.mkdtemp()
+results = {}
+try:
+    for (name, fn) in BENCHMARKS:
+        if options.only and name not in options.only:
+            continue
+
+        results[name] = fn(holder, tmpdir)
+
+        print name
+        for (k, v) in sorted(_flatten(results[name]).items()):
+            print '  %-48s %s' % (k, v)
+finally:
+    for filename in os.listdir(tmpdir):
+        os.unlink(os.path.join(tmpdir, filename))
+    os.rmdir(tmpdir)
+
+output = { 'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'revision' : _revision(),
+           'python' : sys.version.split()[0],
+           'config' : { 'records' : options.records, 'seed' : options.seed,
+                        'body_scale' : options.body_scale },
+           'results' : results }
+
+if options.output:
+    fp = open(options.output, 'w')
+    json.dump(output, fp, indent=2, sort_keys=True)
+    fp.write('\n')
+    fp.close()
+    print 'saved results to', options.output
+
+if options.history:
+    compare_history(output, options.history)
+
+    fp = open(options.history, 'a')
+    fp.write(json.dumps(output, sort_keys=True) + '\n')
+    fp.close()
@@ -22,7 +22,11 @@ __version__ = "0.1"
 
 
 import BaseHTTPServer, select, signal, socket, SocketServer, urlparse
-import re
+import sys, os
+
+# use scotch's response parser, from the source tree.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from scotch.httpparse import ResponseParser, ParseError
 
 
 class TimeoutError(Exception):
@@ -125,7 +129,9 @@ class ProxyHandler (BaseHTTPServer.BaseHTTPRequestHandler):
 			sock.send(data)
 		iw = [self.connection, sock]
 		count = 0
-		self.headers_done = 0
+		self.parser = None
+		if self.command != 'CONNECT':
+			self.parser = ResponseParser(self.command)
 		while 1:
 			count += 1
 			(ins, _, exs) = select.select(iw, [], iw, 3)
@@ -138,41 +144,42 @@ class ProxyHandler (BaseHTTPServer.BaseHTTPRequestHandler):
 						out = sock
 					data = i.recv(8192)
 					if data:
-						self.dump_headers(data)
+						if i is sock:
+							self.dump_headers(data)
 						out.send(data)
 						count = 0
 			else:
 				print "idle", count
 			if count == max_idling: break
 
-	rx_hdr = re.compile("^([a-zA-Z\-0-9]+):\W+(.*)$")
-
 	def dump_headers(self, data):
-
-		if self.headers_done:
+		"""
+		Feed the server's response to the parser, & print its headers
+		once they've all arrived.
+		"""
+		if self.parser is None:
 			return
 
-		headers = []
-		for line in data.split("\n"):
-
-			line = line.strip()
-
+		try:
+			events = self.parser.feed(data)
+		except ParseError, e:
+			print "<< (unparseable response: %s)" % (e,)
+			self.parser = None
+			return
 
-			if not line:
-				self.headers_done = 1
-				break
+		for (event, headers) in events:
+			if event != 'head':
+				continue
 
+			headers = [ (k.lower(), v) for (k, v) in headers ]
+			headers.sort()
+			for k, v in headers:
+				print "<< %s: %s" % (k, v)
+			print ''
 
-			m = self.rx_hdr.match(line)
-			
-			if m:
-				k, v = m.groups()
-				headers.append((k.lower(), v))
-
-		headers.sort()
-		for k, v in headers:
-			print "<< %s: %s" % (k, v)
-		print ''
+			# only the headers are of interest.
+			self.parser = None
+			break
 
 
 	do_HEAD = do_GET
@@ -0,0 +1,581 @@
+"""
+An asynchronous HTTP proxy server, built on asyncore.
+
+ProxyApp is a WSGI app, so it handles one request per thread of whatever
+WSGI server it's mounted in, and one slow server stalls everything
+queued up behind it.  ProxyServer does the same job -- with the same
+header munging -- but multiplexes all client & server connections in a
+single process:
+
+>> server = ProxyServer(('127.0.0.1', 8000))
+>> server.serve_forever()
+
+It can record traffic just like a Recorder wrapped around a ProxyApp:
+
+>> record_holder = scotch.recorder.RecordHolder()
+>> server = ProxyServer(('127.0.0.1', 8000), record_holder=record_holder)
+
+and each transaction is added to 'record_holder' as a Record once its
+response is complete.  With verbosity=1 the records are displayed as
+they're made; verbosity=2 also shows the headers going back and forth.
+
+Server connections are kept open (HTTP/1.1) and reused, like
+scotch.pool does for ProxyApp.  Client connections are kept open when
+the client speaks HTTP/1.1 and the response length is known up front.
+Hostname lookups go through a scotch.resolver.Resolver; they block, but
+the answers are cached.
+"""
+
+import asyncore, asynchat, socket, sys, time, urllib
+
+from scotch import utils
+from scotch.proxy import _ProxyRequest, _wsgi_response, _split_netloc, \
+     _display_header_list, BE_TOLERANT_OF_BROKEN_SERVERS
+from scotch.httpparse import parse_response_head, header_dict, \
+     response_framing, ParseError
+from scotch.recorder import Record, Response, _cleanse_environ
+from scotch.resolver import Resolver
+from scotch.chunked import ChunkedDecoder, ChunkedError
+
+class ProxyServer(asyncore.dispatcher):
+    """
+    Asynchronous HTTP proxy server, with optional recording.
+    """
+    TIMEOUT=30
+    IDLE_TIMEOUT=30
+    MAX_IDLE_PER_HOST=4
+    MAX_HEAD=65536
+
+    def __init__(self, address, record_holder=None, verbosity=0,
+                 resolver=None):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(1024)
+
+        self.record_holder = record_holder
+        self.verbosity = verbosity
+
+        if resolver is None:
+            resolver = Resolver()
+        self.resolver = resolver
+
+        self.idle = {}                  # (host, port) -> upstream channels
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            _ClientChannel(self, pair[0], pair[1])
+
+    def serve_forever(self, timeout=1.0):
+        """
+        Serve until interrupted.
+        """
+        while 1:
+            self.handle_requests(timeout)
+
+    def handle_requests(self, timeout=1.0):
+        """
+        Wait up to 'timeout' seconds for network activity and deal with
+        it; then time out stalled connections.
+        """
+        asyncore.loop(timeout=timeout, use_poll=True, map=self.map, count=1)
+        self._expire(time.time())
+
+    def close_all(self):
+        """
+        Close the server and all of its connections.
+        """
+        for channel in self.map.values():
+            channel.close()
+        self.idle = {}
+
+    def record(self, environ, inp, response):
+        """
+        Save a completed transaction, as Recorder would.
+        """
+        if self.record_holder is None:
+            return
+
+        record = Record(_cleanse_environ(environ), inp, response)
+        self.record_holder.add_record(record)
+
+        if self.verbosity >= 1:
+            if utils.display_record(record):
+                print '(# %d)' % (len(self.record_holder),)
+
+    def get_upstream(self, host, port, fresh=False):
+        """
+        Return a connection to host:port, reusing an idle one if possible.
+        """
+        conns = self.idle.get((host, port))
+        while conns and not fresh:
+            channel = conns.pop()
+            if channel.connected:
+                channel.reused = True
+                return channel
+
+        return _UpstreamChannel(self, host, port)
+
+    def put_upstream(self, channel):
+        conns = self.idle.setdefault(channel.key, [])
+        if len(conns) < self.MAX_IDLE_PER_HOST:
+            channel.deadline = time.time() + self.IDLE_TIMEOUT
+            conns.append(channel)
+        else:
+            channel.close()
+
+    def remove_upstream(self, channel):
+        conns = self.idle.get(channel.key, [])
+        if channel in conns:
+            conns.remove(channel)
+
+    def _expire(self, now):
+        for channel in self.map.values():
+            deadline = getattr(channel, 'deadline', None)
+            if deadline is not None and deadline < now:
+                channel.handle_timeout()
+
+class _ClientChannel(asynchat.async_chat):
+    """
+    A connection from a browser: read requests, and relay the responses
+    coming back from the _UpstreamChannel.
+    """
+    MAX_PENDING=16                      # blocks queued for a slow server
+
+    def __init__(self, server, sock, addr):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.server = server
+        self.addr = addr
+        self.upstream = None
+        self._reset()
+
+    def _reset(self):
+        """
+        Get ready for the next request on this connection.
+        """
+        self.set_terminator('\r\n\r\n')
+        self.ibuffer = []
+        self.state = 'head'
+        self.deadline = time.time() + self.server.IDLE_TIMEOUT
+
+        self.environ = self.proxy_request = None
+        self.head_sent = False
+
+    def readable(self):
+        # stop reading the request body while the server catches up.
+        if self.upstream is not None and \
+           len(self.upstream.producer_fifo) > self.MAX_PENDING:
+            return False
+        return asynchat.async_chat.readable(self)
+
+    def collect_incoming_data(self, data):
+        if self.state == 'head':
+            self.ibuffer.append(data)
+            if sum(map(len, self.ibuffer)) > self.server.MAX_HEAD:
+                self._send_error('400 Request Header Too Large')
+        elif self.state == 'body':
+            self.upstream.send_body(data)
+            if self.inp is not None:
+                self.inp.append(data)
+
+        # (anything else is pipelined or junk; ignore it.)
+
+    def found_terminator(self):
+        if self.state == 'head':
+            head = "".join(self.ibuffer)
+            self.ibuffer = []
+            if head.strip():
+                self._start_request(head)
+        elif self.state == 'body':
+            self.state = 'waiting'
+            self.set_terminator(None)
+
+    def _start_request(self, head):
+        server = self.server
+
+        try:
+            self.environ = _build_environ(head, self.addr,
+                                          server.socket.getsockname())
+            self.proxy_request = _ProxyRequest(self.environ)
+        except Exception, e:
+            self._send_error("400 %s" % (str(e),))
+            return
+
+        if server.verbosity >= 2:
+            print '++', self.environ.get('PATH_INFO')
+            _display_header_list('>>', self.proxy_request.headers)
+
+        # only hang on to the data if we're recording it.
+        self.inp = self.response = None
+        if server.record_holder is not None:
+            self.inp = []
+            self.response = Response()
+            self.response.content_list = []
+            self.response.errout = ''
+
+        self.state = 'waiting'
+        self.deadline = None
+        self.set_terminator(None)
+
+        if not self._connect_upstream():
+            return
+
+        content_len = self.proxy_request.content_len
+        if content_len:
+            self.state = 'body'
+            self.set_terminator(content_len)
+
+    def _connect_upstream(self, fresh=False):
+        (host, port) = _split_netloc(self.proxy_request.netloc)
+        try:
+            self.upstream = self.server.get_upstream(host, port, fresh)
+        except socket.error, e:
+            self._send_error('502 Bad Gateway', str(e))
+            return False
+
+        self.upstream.start(self, self.proxy_request)
+        return True
+
+    ### called by the _UpstreamChannel
+
+    def response_head(self, status, headers, length):
+        if self.server.verbosity >= 2:
+            print '**', status
+            _display_header_list('<<', headers)
+            print ''
+
+        protocol = self.environ.get('SERVER_PROTOCOL')
+        connection = self.environ.get('HTTP_CONNECTION', '').lower()
+
+        # if the body length isn't known, the end of the body is marked
+        # by closing the connection.
+        self.close_after = length is None or protocol != 'HTTP/1.1' or \
+                           'close' in connection
+        if protocol != 'HTTP/1.1':
+            protocol = 'HTTP/1.0'
+
+        out = ['%s %s\r\n' % (protocol, status)]
+        for k, v in headers:
+            out.append('%s: %s\r\n' % (k, v))
+        if self.close_after:
+            out.append('Connection: close\r\n')
+        out.append('\r\n')
+
+        self.push("".join(out))
+        self.head_sent = True
+
+        if self.response is not None:
+            self.response.status = status
+            self.response.headers = headers
+
+    def response_data(self, data):
+        self.push(data)
+        if self.response is not None:
+            self.response.content_list.append(data)
+
+    def response_done(self):
+        self.upstream = None
+
+        if self.response is not None:
+            self.server.record(self.environ, "".join(self.inp),
+                               self.response)
+
+        # if the server answered before the request body was all in,
+        # there's no telling where the next request starts: drop the
+        # rest of it.
+        if self.close_after or self.state == 'body':
+            self.state = 'closing'
+            self.set_terminator(None)
+            self.close_when_done()
+        else:
+            self._reset()
+
+    def upstream_failed(self, error, retry=False):
+        self.upstream = None
+
+        # a reused connection died before answering; try a new one,
+        # if the request can be sent again.
+        if retry and not self.proxy_request.content_len:
+            self._connect_upstream(fresh=True)
+            return
+
+        if self.head_sent:
+            self.close()
+        elif isinstance(error, socket.timeout):
+            self._send_error('504 Gateway Timeout', str(error))
+        else:
+            self._send_error('502 Bad Gateway', str(error))
+
+    ###
+
+    def _send_error(self, status, message=''):
+        body = '%s\n%s\n' % (status, message)
+        self.push('HTTP/1.0 %s\r\nContent-Type: text/plain\r\n'
+                  'Content-Length: %d\r\nConnection: close\r\n\r\n%s' %
+                  (status, len(body), body))
+        self.close_when_done()
+        self.state = 'closing'
+        self.set_terminator(None)
+
+    def handle_timeout(self):
+        self.close()
+
+    def handle_close(self):
+        if self.upstream is not None:
+            self.upstream.close()
+            self.upstream = None
+        self.close()
+
+class _UpstreamChannel(asynchat.async_chat):
+    """
+    A connection to a server: send requests, and parse the responses
+    into head & body for the _ClientChannel.
+    """
+    MAX_PENDING=16                      # blocks queued for a slow client
+
+    def __init__(self, server, host, port):
+        asynchat.async_chat.__init__(self, map=server.map)
+        self.server = server
+        self.key = (host, port)
+
+        self.client = None
+        self.reused = False
+        self.state = 'idle'
+        self.deadline = None
+
+        self.addresses = list(server.resolver.resolve(host, port))
+        self._connect_next()
+
+    def _connect_next(self):
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(self.addresses.pop(0))
+
+    def start(self, client, proxy_request):
+        """
+        Send the request head; the client sends the body, if any, with
+        'send_body'.
+        """
+        self.client = client
+        self.method = proxy_request.method
+        self.got_response = False
+
+        self.state = 'head'
+        self.ibuffer = []
+        self.lines = []
+        self.decoder = None
+        self.set_terminator('\n')
+        self.deadline = time.time() + self.server.TIMEOUT
+
+        self.push(proxy_request.request_head)
+
+    def send_body(self, data):
+        # a slow upload is still progress; don't time it out.
+        self.deadline = time.time() + self.server.TIMEOUT
+        self.push(data)
+
+    def handle_write(self):
+        if self.state != 'idle':
+            self.deadline = time.time() + self.server.TIMEOUT
+        asynchat.async_chat.handle_write(self)
+
+    def readable(self):
+        # stop reading from the server while the client catches up.
+        if self.client is not None and \
+           len(self.client.producer_fifo) > self.MAX_PENDING:
+            return False
+        return True
+
+    def collect_incoming_data(self, data):
+        self.got_response = True
+        self.deadline = time.time() + self.server.TIMEOUT
+
+        if self.state == 'head':
+            self.ibuffer.append(data)
+        elif self.state == 'body':
+            if self.decoder is not None:
+                try:
+                    data = self.decoder.decode(data)
+                except ChunkedError, e:
+                    self._fail(e)
+                    return
+
+            if data:
+                self.client.response_data(data)
+
+            if self.decoder is not None and self.decoder.done:
+                self._finish(True)
+        elif self.state == 'idle':
+            # servers shouldn't talk when they haven't been asked.
+            self.close()
+
+    def found_terminator(self):
+        if self.state == 'head':
+            line = "".join(self.ibuffer) + '\n'
+            self.ibuffer = []
+
+            # ignore any stray blank lines before the status line.
+            if not self.lines and not line.strip():
+                return
+
+            self.lines.append(line)
+            if line.strip():
+                if sum(map(len, self.lines)) > self.server.MAX_HEAD:
+                    self._fail(Exception("response head too large"))
+                return
+
+            self._start_response()
+        elif self.state == 'body':
+            self._finish(True)
+
+    def _start_response(self):
+        head = "".join(self.lines)
+        try:
+            (version, status_code, reason, headers) = \
+                   parse_response_head(head, BE_TOLERANT_OF_BROKEN_SERVERS)
+        except ParseError, e:
+            self._fail(e)
+            return
+
+        self.lines = []
+
+        # skip over any interim (1xx) responses.
+        if 100 <= status_code < 200:
+            return
+
+        try:
+            (length, chunked, self.keep_alive) = \
+                     response_framing(self.method, version, status_code,
+                                      header_dict(headers))
+        except ParseError, e:
+            self._fail(e)
+            return
+        (status, wsgi_headers) = _wsgi_response(status_code, reason, headers)
+
+        self.client.response_head(status, wsgi_headers, length)
+
+        self.state = 'body'
+        if chunked:
+            self.decoder = ChunkedDecoder()
+            self.set_terminator(None)
+        elif length is None:
+            self.set_terminator(None)   # read until the server closes.
+        elif length == 0:
+            self._finish(True)
+        else:
+            self.set_terminator(length)
+
+    def _finish(self, complete):
+        client = self.client
+
+        self.client = None
+        self.state = 'idle'
+        self.deadline = None
+        self.set_terminator(None)
+
+        if complete and self.keep_alive and self.connected:
+            self.server.put_upstream(self)
+        else:
+            self.close()
+
+        client.response_done()
+
+    def _fail(self, error, retry=False):
+        client = self.client
+
+        self.client = None
+        self.close()
+
+        if client is not None:
+            client.upstream_failed(error, retry)
+
+    def handle_connect(self):
+        pass
+
+    def handle_timeout(self):
+        if self.state == 'idle':
+            self.close()
+        else:
+            self._fail(socket.timeout('timed out'))
+
+    def handle_close(self):
+        if self.state == 'body' and self.decoder is None and \
+           self.get_terminator() is None:
+            # the body ran until the server closed the connection.
+            self.keep_alive = False
+            self._finish(True)
+        elif self.state == 'idle':
+            self.close()
+        else:
+            self._fail(socket.error('server closed the connection'),
+                       retry=self.reused and not self.got_response)
+
+    def handle_error(self):
+        (_, error, _) = sys.exc_info()
+
+        # try the next address if we couldn't connect to this one.
+        if self.connecting and self.addresses:
+            self.del_channel()
+            self.socket.close()
+            self._connect_next()
+            return
+
+        if self.server.verbosity >= 2:
+            (_, t, v, tbinfo) = asyncore.compact_traceback()
+            self.log_info('upstream error: %s:%s %s' % (t, v, tbinfo),
+                          'error')
+        self._fail(error)
+
+    def close(self):
+        self.server.remove_upstream(self)
+        asynchat.async_chat.close(self)
+
+###
+
+def _build_environ(head, client_address, server_address):
+    """
+    Build a WSGI-style environment from the head of an HTTP request,
+    so that it can be handed to _ProxyRequest & saved in a Record.
+    """
+    lines = head.replace('\r\n', '\n').split('\n')
+
+    request_line = lines[0].split()
+    if len(request_line) != 3:
+        raise Exception("bad request line %r" % (lines[0],))
+    (method, uri, protocol) = request_line
+
+    if '?' in uri:
+        path, query_string = uri.split('?', 1)
+    else:
+        path, query_string = uri, ''
+
+    environ = { 'REQUEST_METHOD' : method,
+                'SCRIPT_NAME' : '',
+                'PATH_INFO' : urllib.unquote(path),
+                'QUERY_STRING' : query_string,
+                'SERVER_PROTOCOL' : protocol,
+                'SERVER_NAME' : server_address[0],
+                'SERVER_PORT' : str(server_address[1]),
+                'REMOTE_ADDR' : client_address[0],
+                'wsgi.url_scheme' : 'http' }
+
+    for line in lines[1:]:
+        if ':' not in line:
+            continue
+
+        k, v = line.split(':', 1)
+        k, v = k.strip().upper().replace('-', '_'), v.strip()
+
+        if k in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[k] = v
+            continue
+
+        k = 'HTTP_' + k
+        if environ.has_key(k):
+            v = environ[k] + ',' + v
+        environ[k] = v
+
+    return environ
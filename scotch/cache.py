@@ -0,0 +1,535 @@
+"""
+An HTTP response cache for scotch.proxy.
+
+>> cache = HTTPCache(max_memory=64*1024*1024,
+..                   directory='/var/tmp/scotch-cache', max_disk=1024**3)
+>> app = ProxyApp(cache=cache)
+
+The cache follows the HTTP/1.1 freshness rules for a shared cache:
+responses are fresh for their Cache-Control s-maxage/max-age, or until
+their Expires date, or -- if they only have a Last-Modified date -- for
+10% of their age when they were fetched.  Requests can tighten or loosen
+that with their own Cache-Control max-age, min-fresh and max-stale (a
+browser's reload sends max-age=0).  Stale responses with an ETag or
+Last-Modified date are revalidated with a conditional GET; a '304 Not
+Modified' answer refreshes the cached copy.
+
+Small bodies are kept in memory (up to 'max_memory' bytes in all); larger
+bodies go to files in 'directory' (up to 'max_disk' bytes in all).  Both
+are evicted least-recently-used first.  Without a 'directory', bodies
+that don't fit in memory just aren't cached.  The cache isn't kept
+between runs: any entry files left in 'directory' are removed when the
+HTTPCache is created, so don't share a directory between two of them.
+
+Every response that goes through the cache gets an 'X-Cache' header
+(HIT, MISS, or REVALIDATED), so the cache's behavior shows up in
+recordings.
+"""
+
+import os, time, tempfile, threading
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+
+_cacheable_status = { 200:1, 203:1, 300:1, 301:1, 410:1 }
+
+class CacheEntry:
+    """
+    A cached response: status line, headers, and a body that's either a
+    string (in memory) or the name of a file (on disk).
+    """
+    def __init__(self, url, status, headers, vary, request_time,
+                 response_time):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.vary = vary                # [ (request header, value), ... ]
+
+        self.request_time = request_time
+        self.response_time = response_time
+
+        self.body = None
+        self.filename = None
+        self.size = 0
+
+    def current_age(self, now=None):
+        """
+        The age of the response, per RFC 2616 section 13.2.3.
+        """
+        if now is None:
+            now = time.time()
+
+        date = _parse_date(_get_header(self.headers, 'date'))
+        if date is None:
+            date = self.response_time
+
+        try:
+            age = int(_get_header(self.headers, 'age') or 0)
+        except ValueError:
+            age = 0
+
+        apparent_age = max(0, self.response_time - date)
+        corrected_age = max(apparent_age, age)
+        initial_age = corrected_age + (self.response_time - self.request_time)
+
+        return initial_age + (now - self.response_time)
+
+    def freshness_lifetime(self):
+        """
+        How long the response stays fresh, in seconds.
+        """
+        directives = _cache_control(self.headers)
+        for name in ('s-maxage', 'max-age'):
+            if directives.has_key(name):
+                return _delta_seconds(directives[name])
+
+        date = _parse_date(_get_header(self.headers, 'date'))
+        if date is None:
+            date = self.response_time
+
+        expires = _get_header(self.headers, 'expires')
+        if expires is not None:
+            expires = _parse_date(expires)
+            if expires is None:         # invalid dates mean 'already expired'
+                return 0
+            return max(0, expires - date)
+
+        last_modified = _parse_date(_get_header(self.headers, 'last-modified'))
+        if last_modified is not None:
+            return min(HTTPCache.HEURISTIC_MAX,
+                       max(0, (date - last_modified) / 10))
+
+        return 0
+
+    def is_fresh(self, now=None, request_directives={}):
+        """
+        Check whether the response can be served without revalidating it,
+        taking the request's Cache-Control max-age, min-fresh and
+        max-stale into account.
+        """
+        directives = _cache_control(self.headers)
+        if directives.has_key('no-cache'):
+            return False
+
+        age = self.current_age(now)
+        lifetime = self.freshness_lifetime()
+
+        if request_directives.has_key('max-age') and \
+           age > _delta_seconds(request_directives['max-age']):
+            return False
+
+        if request_directives.has_key('min-fresh'):
+            age += _delta_seconds(request_directives['min-fresh'])
+
+        # the server can insist that stale responses be revalidated.
+        if request_directives.has_key('max-stale') and \
+           not directives.has_key('must-revalidate') and \
+           not directives.has_key('proxy-revalidate'):
+            max_stale = request_directives['max-stale']
+            if max_stale is None:       # any amount of staleness will do
+                return True
+            lifetime += _delta_seconds(max_stale)
+
+        return lifetime > age
+
+    def can_revalidate(self):
+        return _get_header(self.headers, 'etag') is not None or \
+               _get_header(self.headers, 'last-modified') is not None
+
+    def conditional_headers(self):
+        """
+        The headers for a conditional GET that revalidates this entry.
+        """
+        headers = []
+
+        etag = _get_header(self.headers, 'etag')
+        if etag is not None:
+            headers.append(('IF-NONE-MATCH', etag))
+
+        last_modified = _get_header(self.headers, 'last-modified')
+        if last_modified is not None:
+            headers.append(('IF-MODIFIED-SINCE', last_modified))
+
+        return headers
+
+    def matches(self, request_headers):
+        """
+        Check that a request selects the same variant (see 'Vary').
+        """
+        for (k, v) in self.vary:
+            if _get_header(request_headers, k) != v:
+                return False
+        return True
+
+class HTTPCache:
+    """
+    A thread-safe, size-bounded LRU cache of HTTP responses, indexed by
+    absolute URL.
+    """
+    MAX_MEMORY=32*1024*1024
+    MAX_DISK=256*1024*1024
+    MAX_MEMORY_ENTRY=256*1024
+    HEURISTIC_MAX=24*60*60
+    BLOCKSIZE=4096
+
+    def __init__(self, max_memory=None, directory=None, max_disk=None):
+        if max_memory is None:
+            max_memory = self.MAX_MEMORY
+        if max_disk is None:
+            max_disk = self.MAX_DISK
+        if directory is None:
+            max_disk = 0
+        elif not os.path.isdir(directory):
+            os.makedirs(directory)
+        else:
+            # left over from an earlier run; nothing knows about them now.
+            for name in os.listdir(directory):
+                if name.startswith('entry-'):
+                    _unlink(os.path.join(directory, name))
+
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.directory = directory
+
+        self.entries = OrderedDict()    # URL -> entry, least recent first
+        self.memory_used = 0
+        self.disk_used = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def check(self, method, url, request_headers):
+        """
+        Decide what to do with a request.  Return (entry, body, action),
+        where 'action' is
+
+         * None -- the request doesn't go through the cache at all;
+         * 'HIT' -- serve the (fresh) cached entry & body;
+         * 'REVALIDATE' -- the cached entry is stale: ask the server with
+           entry.conditional_headers(), & serve the entry if it says 304;
+         * 'MISS' -- fetch the response from the server.
+        """
+        if method != 'GET':
+            # POST, PUT, DELETE etc. may change the resource.
+            if method != 'HEAD':
+                self.invalidate(url)
+            return None, None, None
+
+        directives = _cache_control(request_headers)
+        if directives.has_key('no-store') or \
+           _get_header(request_headers, 'authorization') is not None:
+            return None, None, None
+
+        (entry, body) = self.lookup(url, request_headers)
+        if entry is None:
+            return None, None, 'MISS'
+
+        if not directives.has_key('no-cache') and \
+           entry.is_fresh(request_directives=directives):
+            return entry, body, 'HIT'
+
+        if entry.can_revalidate():
+            return entry, body, 'REVALIDATE'
+
+        _close(body)
+        return None, None, 'MISS'
+
+    def iter_body(self, body):
+        """
+        Iterate over a body returned by 'lookup' or 'check'.
+        """
+        if isinstance(body, str):
+            return [body]
+        return _iter_file(body, self.BLOCKSIZE)
+
+    def close_body(self, body):
+        """
+        Release a body returned by 'lookup' or 'check' without serving it.
+        """
+        _close(body)
+
+    def lookup(self, url, request_headers):
+        """
+        Return (entry, body) for a cached response to the given request,
+        or (None, None).  'body' is a string or an open file; an open file
+        stays readable even if the entry is evicted while it's being served.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(url)
+            if entry is None or not entry.matches(request_headers):
+                return None, None
+
+            # mark it most recently used.
+            del self.entries[url]
+            self.entries[url] = entry
+
+            if entry.filename is not None:
+                try:
+                    return entry, open(entry.filename, 'rb')
+                except IOError:
+                    self._remove(url)
+                    return None, None
+
+            return entry, entry.body
+        finally:
+            self.lock.release()
+
+    def invalidate(self, url):
+        self.lock.acquire()
+        try:
+            self._remove(url)
+        finally:
+            self.lock.release()
+
+    def refresh(self, entry, headers, request_time, response_time):
+        """
+        Update a cached entry with the headers from a '304 Not Modified'.
+        """
+        headers = [ (k, v) for (k, v) in headers
+                    if k.lower() != 'content-length' ]
+        replaced = dict([ (k.lower(), 1) for (k, v) in headers ])
+
+        new_headers = [ (k, v) for (k, v) in entry.headers
+                        if not replaced.has_key(k.lower()) ]
+        new_headers.extend(headers)
+
+        self.lock.acquire()
+        try:
+            entry.headers = new_headers
+            entry.request_time = request_time
+            entry.response_time = response_time
+        finally:
+            self.lock.release()
+
+    def make_entry(self, url, status, headers, request_headers,
+                   request_time, response_time):
+        """
+        Build an entry for a response that's about to be streamed, or
+        return None if the response can't be cached.
+        """
+        try:
+            status_code = int(status.split()[0])
+        except (ValueError, IndexError):
+            return None
+
+        if not _cacheable_status.has_key(status_code):
+            return None
+
+        directives = _cache_control(headers)
+        if directives.has_key('no-store') or directives.has_key('private'):
+            return None
+
+        vary = []
+        for k in (_get_header(headers, 'vary') or '').split(','):
+            k = k.strip()
+            if k == '*':
+                return None
+            if k:
+                vary.append((k, _get_header(request_headers, k)))
+
+        entry = CacheEntry(url, status, headers, vary, request_time,
+                           response_time)
+
+        # only keep responses that could ever be served from the cache.
+        if not entry.can_revalidate() and entry.freshness_lifetime() <= 0:
+            return None
+
+        return entry
+
+    def iter_store(self, entry, blocks):
+        """
+        Pass 'blocks' (the response body) through, and store 'entry' with
+        that body once all of it has gone by.
+        """
+        pieces = []
+        size = 0
+        fp = None
+
+        try:
+            for data in blocks:
+                yield data
+
+                if entry is None:
+                    continue
+
+                size += len(data)
+                if fp is not None:
+                    fp.write(data)
+                elif size <= self.MAX_MEMORY_ENTRY:
+                    pieces.append(data)
+                elif self.directory:
+                    # too big for memory; spill it to disk.
+                    (fd, entry.filename) = tempfile.mkstemp(
+                        dir=self.directory, prefix='entry-')
+                    fp = os.fdopen(fd, 'wb')
+                    fp.write("".join(pieces))
+                    fp.write(data)
+                    pieces = []
+
+                if size > max(self.MAX_MEMORY_ENTRY, self.max_disk):
+                    # too big to cache at all.
+                    fp = _discard(fp, entry.filename)
+                    entry = None
+                    pieces = []
+
+            if entry is not None:
+                if fp is not None:
+                    fp.close()
+                    fp = None
+                else:
+                    entry.body = "".join(pieces)
+                entry.size = size
+
+                self._add(entry)
+                entry = None
+        finally:
+            # the body was cut short; don't cache it.
+            if entry is not None:
+                _discard(fp, entry.filename)
+
+            # (if the client went away, let go of the response too.)
+            if hasattr(blocks, 'close'):
+                blocks.close()
+
+    def _add(self, entry):
+        self.lock.acquire()
+        try:
+            self._remove(entry.url)
+            self.entries[entry.url] = entry
+
+            if entry.filename is not None:
+                self.disk_used += entry.size
+            else:
+                self.memory_used += entry.size
+
+            self._evict()
+        finally:
+            self.lock.release()
+
+    def _evict(self):
+        """
+        Throw out least-recently-used entries until the cache is back
+        within its limits.
+        """
+        if self.memory_used > self.max_memory:
+            for entry in self.entries.values():
+                if self.memory_used <= self.max_memory:
+                    break
+                if entry.filename is None:
+                    self._remove(entry.url)
+
+        if self.disk_used > self.max_disk:
+            for entry in self.entries.values():
+                if self.disk_used <= self.max_disk:
+                    break
+                if entry.filename is not None:
+                    self._remove(entry.url)
+
+    def _remove(self, url):
+        entry = self.entries.pop(url, None)
+        if entry is None:
+            return
+
+        if entry.filename is not None:
+            self.disk_used -= entry.size
+            _unlink(entry.filename)
+        else:
+            self.memory_used -= entry.size
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            for url in self.entries.keys():
+                self._remove(url)
+        finally:
+            self.lock.release()
+
+###
+
+def _get_header(headers, name):
+    """
+    Get the value of a header from a list of (name, value) pairs,
+    joining repeated headers with ', '; None if it's not there.
+    """
+    name = name.lower()
+    values = [ v for (k, v) in headers if k.lower() == name ]
+    if not values:
+        return None
+    return ', '.join(values)
+
+def _cache_control(headers):
+    """
+    Parse Cache-Control (and Pragma: no-cache) into a dictionary of
+    directive -> value (None for directives without values).
+    """
+    directives = {}
+    for d in (_get_header(headers, 'cache-control') or '').split(','):
+        d = d.strip()
+        if not d:
+            continue
+        if '=' in d:
+            k, v = d.split('=', 1)
+            directives[k.strip().lower()] = v.strip().strip('"')
+        else:
+            directives[d.lower()] = None
+
+    if 'no-cache' in (_get_header(headers, 'pragma') or '').lower():
+        directives['no-cache'] = None
+
+    return directives
+
+def _delta_seconds(value):
+    """
+    Parse a Cache-Control delta-seconds value; invalid values are 0.
+    """
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+def _parse_date(value):
+    """
+    Parse an HTTP date into seconds since the epoch, or None.
+    """
+    if not value:
+        return None
+    t = parsedate_tz(value)
+    if t is None:
+        return None
+    try:
+        return mktime_tz(t)
+    except (OverflowError, ValueError):
+        return None
+
+def _iter_file(fp, blocksize):
+    try:
+        while 1:
+            data = fp.read(blocksize)
+            if not data:
+                break
+            yield data
+    finally:
+        fp.close()
+
+def _close(body):
+    """
+    Close a body returned by 'lookup', if it's a file.
+    """
+    if body is not None and not isinstance(body, str):
+        body.close()
+
+def _discard(fp, filename):
+    """
+    Close & remove a partly-written entry file.
+    """
+    if fp is not None:
+        fp.close()
+    if filename is not None:
+        _unlink(filename)
+
+def _unlink(filename):
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
@@ -0,0 +1,120 @@
+"""
+An incremental decoder for 'Transfer-encoding: chunked' [HTTP/1.1].
+
+Feed it data as it comes off the network, and it hands back whatever
+body data it has decoded so far:
+
+>> decoder = ChunkedDecoder()
+>> while not decoder.done:
+..     body.append(decoder.decode(sock.recv(4096)))
+
+Once the last chunk and the trailers have been read, 'decoder.done' is
+True, 'decoder.trailers' holds the trailer headers, and 'decoder.unused'
+holds any data fed in past the end of the body (e.g. the start of the
+next response on a keep-alive connection).
+
+Based on UnchunkStream from Webcleaner (amitp@cs.stanford.edu), but
+chunk data is sliced straight out of the incoming block rather than
+shuffled through an ever-shrinking buffer, and trailers are handled.
+"""
+
+import re
+
+_match_size = re.compile(r"^([0-9a-fA-F]+)\s*(;.*)?$").match
+
+# decoder states
+_SIZE, _DATA, _DATA_END, _TRAILER, _DONE = range(5)
+
+class ChunkedError(Exception):
+    """
+    The chunked data is malformed.
+    """
+    pass
+
+class ChunkedDecoder:
+    """
+    Stream filter for chunked transfer-encoding.
+    """
+    MAX_LINE=65536
+
+    def __init__(self):
+        self.state = _SIZE
+        self.bytes_remaining = 0
+        self.buf = ''                   # partial size/trailer line
+        self.trailers = []
+        self.unused = ''
+        self.done = False
+
+    def __repr__(self):
+        return '<ChunkedDecoder done=%s buflen=%d bytes_remaining=%d>' % \
+               (self.done, len(self.buf), self.bytes_remaining)
+
+    def decode(self, s):
+        """
+        Decode the given data; return the body data found in it.
+        """
+        if self.done:
+            self.unused += s
+            return ''
+
+        # only a partial line is ever kept over between calls.
+        if self.buf:
+            s = self.buf + s
+            self.buf = ''
+
+        out = []
+        pos, end = 0, len(s)
+
+        while pos < end:
+            if self.state == _DATA:
+                n = min(self.bytes_remaining, end - pos)
+                out.append(s[pos:pos + n])
+                pos += n
+
+                self.bytes_remaining -= n
+                if self.bytes_remaining == 0:
+                    self.state = _DATA_END
+                continue
+
+            # everything else is line-based.
+            i = s.find('\n', pos)
+            if i < 0:
+                self.buf = s[pos:]
+                if len(self.buf) > self.MAX_LINE:
+                    raise ChunkedError("line too long")
+                break
+
+            line = s[pos:i].strip()
+            pos = i + 1
+
+            if self.state == _SIZE:
+                if not line:            # tolerate stray blank lines.
+                    continue
+
+                m = _match_size(line)
+                if not m:
+                    raise ChunkedError("invalid chunk size %r" % (line,))
+
+                self.bytes_remaining = int(m.group(1), 16)
+                if self.bytes_remaining:
+                    self.state = _DATA
+                else:
+                    self.state = _TRAILER
+
+            elif self.state == _DATA_END:
+                if line:
+                    raise ChunkedError("missing CRLF after chunk data")
+                self.state = _SIZE
+
+            elif self.state == _TRAILER:
+                if not line:
+                    self.state = _DONE
+                    self.done = True
+                    self.unused = s[pos:]
+                    break
+
+                if ':' in line:
+                    k, v = line.split(':', 1)
+                    self.trailers.append((k.strip(), v.strip()))
+
+        return "".join(out)
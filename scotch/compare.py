@@ -6,11 +6,11 @@ import sets
 
 def is_same_response(response1, response2):
     """
-    Compare the status, output, and headers; return True if the same,
-    return False otherwise.
+    Compare the status, (decoded) output, and headers; return True if the
+    same, return False otherwise.
     """
     if response1.status != response2.status or \
-       response1.get_output() != response2.get_output():
+       response1.get_decoded_output() != response2.get_decoded_output():
         return False
 
     (same, diff12, diff21) = compare_headers(response1, response2)
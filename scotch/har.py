@@ -0,0 +1,449 @@
+"""
+Convert between recordings and HTTP Archive (HAR 1.2) files, as saved by
+browser developer tools.
+
+>> fp = open('recording.har', 'w')
+>> writer = HARWriter(fp)
+>> for record in records:
+..    writer.write(record)
+>> writer.close()
+
+>> for record in read_har(open('capture.har', 'rb')):
+..    new_response = record.refeed(app)
+
+Both directions stream: the writer writes each entry as it's given, and
+read_har parses the archive one entry at a time, so only one entry is
+ever held in memory.  Binary bodies are base64-encoded a block at a time,
+straight into the file; text bodies are written as text.
+
+HAR bodies are decoded, so recorded gzip/deflate responses are exported
+decoded, and imported responses lose their Content-Encoding header.
+Request bodies that aren't UTF-8 are exported base64-encoded, marked
+with a custom '_encoding' field, which read_har understands.
+"""
+
+import time, calendar, base64, json, re, urlparse, cgi
+
+from scotch.recorder import Record, Response
+
+CREATOR = { 'name' : 'scotch', 'version' : '0.5' }
+
+# encode this many bytes of a body at a time; a multiple of 3, so that
+# the pieces of base64 join up.
+BASE64_BLOCK = 3 * 16384
+
+_BODY = '@@scotch-body@@'               # stands in for a body, in an entry.
+
+_TEXT_TYPES = ('text/', 'application/json', 'application/javascript',
+               'application/x-javascript', 'application/xml',
+               'application/xhtml+xml', 'application/x-www-form-urlencoded')
+
+class HARError(Exception):
+    pass
+
+###
+### writing
+###
+
+class HARWriter:
+    """
+    Write records to 'fp' as a HAR file, one entry at a time.
+    """
+    def __init__(self, fp, creator=CREATOR):
+        self.fp = fp
+        self.n_entries = 0
+
+        head = json.dumps({ 'log' : { 'version' : '1.2',
+                                      'creator' : creator,
+                                      'entries' : _BODY } })
+        (self.head, self.tail) = head.split('"%s"' % (_BODY,))
+        fp.write(self.head + '[')
+
+    def write(self, record):
+        (entry, body, is_text) = record_to_entry(record)
+
+        (before, after) = json.dumps(entry).split('"%s"' % (_BODY,))
+
+        fp = self.fp
+        if self.n_entries:
+            fp.write(',')
+        fp.write('\n')
+        fp.write(before)
+
+        if is_text:
+            fp.write(json.dumps(body))
+        else:
+            fp.write('"')
+            for i in xrange(0, len(body), BASE64_BLOCK):
+                fp.write(base64.b64encode(body[i:i + BASE64_BLOCK]))
+            fp.write('"')
+
+        fp.write(after)
+        self.n_entries += 1
+
+    def close(self):
+        self.fp.write('\n]' + self.tail + '\n')
+
+def record_to_entry(record):
+    """
+    Build the HAR entry for 'record', with a placeholder for the response
+    body; return (entry, body, is_text).
+    """
+    environ = record.environ
+    response = record.response
+
+    url = _request_url(environ)
+    query_string = environ.get('QUERY_STRING', '')
+
+    request = { 'method' : environ.get('REQUEST_METHOD', 'GET'),
+                'url' : _unicode(url),
+                'httpVersion' : environ.get('SERVER_PROTOCOL', 'HTTP/1.1'),
+                'headers' : _environ_headers(environ),
+                'queryString' : [ { 'name' : _unicode(k),
+                                    'value' : _unicode(v) } for (k, v) in
+                                  cgi.parse_qsl(query_string, True) ],
+                'cookies' : [],
+                'headersSize' : -1,
+                'bodySize' : len(record.inp) }
+
+    if record.inp:
+        post_data = { 'mimeType' : _unicode(environ.get('CONTENT_TYPE', '')) }
+        try:
+            post_data['text'] = record.inp.decode('utf-8')
+        except UnicodeDecodeError:
+            post_data['text'] = base64.b64encode(record.inp)
+            post_data['_encoding'] = 'base64'
+        request['postData'] = post_data
+
+    try:
+        status_code, status_text = response.status.split(' ', 1)
+    except ValueError:
+        status_code, status_text = response.status, ''
+
+    body = response.get_decoded_output()
+    content_type = response.get_content_type() or ''
+
+    content = { 'size' : len(body),
+                'mimeType' : _unicode(content_type),
+                'text' : _BODY }
+    if len(body) != response.get_output_length():
+        content['compression'] = len(body) - response.get_output_length()
+
+    is_text = content_type.lower().startswith(_TEXT_TYPES)
+    if is_text:
+        try:
+            body = body.decode('utf-8')
+        except UnicodeDecodeError:
+            is_text = False
+    if not is_text:
+        content['encoding'] = 'base64'
+
+    headers = [ { 'name' : _unicode(k), 'value' : _unicode(v) }
+                for (k, v) in response.headers ]
+    redirect_url = ''
+    for (k, v) in response.headers:
+        if k.lower() == 'location':
+            redirect_url = _unicode(v)
+
+    entry = { 'startedDateTime' : _format_time(getattr(record,
+                                                       'timestamp', 0)),
+              'time' : 0,
+              'request' : request,
+              'response' : { 'status' : int(status_code),
+                             'statusText' : _unicode(status_text),
+                             'httpVersion' : request['httpVersion'],
+                             'headers' : headers,
+                             'cookies' : [],
+                             'content' : content,
+                             'redirectURL' : redirect_url,
+                             'headersSize' : -1,
+                             'bodySize' : response.get_output_length() },
+              'cache' : {},
+              'timings' : { 'send' : 0, 'wait' : 0, 'receive' : 0 } }
+
+    return entry, body, is_text
+
+def _request_url(environ):
+    """
+    Reconstruct the URL; proxied requests have it all in PATH_INFO.
+    """
+    url = environ.get('PATH_INFO', '')
+    if '://' not in url:
+        host = environ.get('HTTP_HOST') or environ.get('SERVER_NAME',
+                                                           'localhost')
+        url = '%s://%s%s%s' % (environ.get('wsgi.url_scheme', 'http'), host,
+                               environ.get('SCRIPT_NAME', ''), url)
+
+    if environ.get('QUERY_STRING'):
+        url += '?' + environ['QUERY_STRING']
+    return url
+
+def _environ_headers(environ):
+    headers = []
+    for (k, v) in environ.items():
+        if k.startswith('HTTP_'):
+            name = k[5:].replace('_', '-').title()
+        elif k in ('CONTENT_TYPE', 'CONTENT_LENGTH') and v:
+            name = k.replace('_', '-').title()
+        else:
+            continue
+        headers.append({ 'name' : name, 'value' : _unicode(v) })
+
+    headers.sort(key=lambda h: h['name'])
+    return headers
+
+def _unicode(s):
+    if isinstance(s, unicode):
+        return s
+    try:
+        return str(s).decode('utf-8')
+    except UnicodeDecodeError:
+        return str(s).decode('latin-1')
+
+def _format_time(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t)) + \
+           '.%03dZ' % (int(t * 1000) % 1000,)
+
+###
+### reading
+###
+
+_time_re = re.compile(r'(\d+)-(\d+)-(\d+)T(\d+):(\d+):(\d+)(\.\d+)?'
+                      r'(Z|([+-])(\d\d):?(\d\d))?$')
+
+def _parse_time(s):
+    m = _time_re.match(s)
+    if not m:
+        return 0
+
+    (year, month, day, hour, minute, second) = map(int, m.groups()[:6])
+    t = calendar.timegm((year, month, day, hour, minute, second))
+    if m.group(7):
+        t += float(m.group(7))
+    if m.group(9):
+        offset = int(m.group(10)) * 3600 + int(m.group(11)) * 60
+        if m.group(9) == '+':
+            t -= offset
+        else:
+            t += offset
+    return t
+
+class _JSONStream:
+    """
+    Pull JSON values out of a file, a value at a time.
+    """
+    BLOCK = 65536
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, n=None):
+        if self.pos > len(self.buf) // 2:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+
+        data = self.fp.read(n or self.BLOCK)
+        if not data:
+            self.eof = True
+        self.buf += data
+        return bool(data)
+
+    def peek(self):
+        """
+        Return the next non-whitespace character, or '' at the end.
+        """
+        while 1:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise HARError("expected one of %r, got %r" % (chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """
+        Decode the next value, reading as much more as it takes.
+        """
+        self.peek()
+        n = self.BLOCK
+        while 1:
+            try:
+                (value, end) = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                end = None
+
+            # a number could run on into the next block.
+            if end is not None and (end < len(self.buf) or self.eof):
+                self.pos = end
+                return value
+
+            if not self._fill(n):
+                if end is not None:
+                    self.pos = end
+                    return value
+                raise HARError("bad or truncated JSON at offset %d" %
+                               (self.pos,))
+            n *= 2
+
+    def members(self):
+        """
+        Yield the keys of the object starting here; the caller reads (or
+        skips) each value.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+
+        while 1:
+            key = self.value()
+            self.expect(':')
+            yield key
+
+            if self.expect(',}') == '}':
+                return
+
+    def items(self):
+        """
+        Yield the values in the array starting here.
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+
+        while 1:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+def read_entries(fp):
+    """
+    Yield the entries in the HAR file 'fp' (as dictionaries).
+    """
+    stream = _JSONStream(fp)
+    for key in stream.members():
+        if key != 'log':
+            stream.value()
+            continue
+
+        for key in stream.members():
+            if key == 'entries':
+                for entry in stream.items():
+                    yield entry
+            else:
+                stream.value()
+
+def read_har(fp):
+    """
+    Yield a Record for each entry in the HAR file 'fp'.
+    """
+    for entry in read_entries(fp):
+        yield entry_to_record(entry)
+
+_skip_response_headers = ('content-encoding', 'content-length',
+                          'transfer-encoding')
+
+def entry_to_record(entry):
+    request = entry['request']
+    response_entry = entry['response']
+
+    url = request['url'].encode('utf-8')
+    (scheme, netloc, path, params, query, fragment) = urlparse.urlparse(url)
+    if params:
+        path += ';' + params
+
+    host, port = netloc, (scheme == 'https' and '443' or '80')
+    if ':' in netloc and not netloc.endswith(']'):
+        host, port = netloc.rsplit(':', 1)
+
+    environ = { 'REQUEST_METHOD' : request['method'].encode('utf-8'),
+                'PATH_INFO' : urlparse.urlunparse((scheme, netloc, path,
+                                                   '', '', '')),
+                'QUERY_STRING' : query,
+                'SERVER_PROTOCOL' : _protocol(request.get('httpVersion')),
+                'SERVER_NAME' : host,
+                'SERVER_PORT' : port,
+                'wsgi.url_scheme' : scheme }
+
+    for header in request.get('headers', []):
+        name = header['name'].encode('utf-8')
+        if name.startswith(':'):            # HTTP/2 pseudo-headers
+            continue
+        value = header['value'].encode('utf-8')
+
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        if environ.has_key(key):
+            value = environ[key] + ', ' + value
+        environ[key] = value
+
+    inp = ''
+    post_data = request.get('postData')
+    if post_data:
+        if post_data.has_key('text'):
+            inp = post_data['text']
+            if post_data.get('_encoding') == 'base64':
+                inp = base64.b64decode(inp)
+            else:
+                inp = inp.encode('utf-8')
+        elif post_data.get('params'):
+            inp = '&'.join([ '%s=%s' % (p['name'].encode('utf-8'),
+                                        p.get('value', '').encode('utf-8'))
+                             for p in post_data['params'] ])
+        if post_data.get('mimeType'):
+            environ['CONTENT_TYPE'] = post_data['mimeType'].encode('utf-8')
+    if inp:
+        environ['CONTENT_LENGTH'] = str(len(inp))
+
+    content = response_entry.get('content', {})
+    body = content.get('text', '')
+    if content.get('encoding') == 'base64':
+        body = base64.b64decode(body)
+    else:
+        body = body.encode('utf-8')
+
+    response = Response()
+    response.status = ('%s %s' % (response_entry['status'],
+                                  response_entry.get('statusText', ''))
+                       ).strip().encode('utf-8')
+    response.headers = []
+    had_length = bool(body)
+    for header in response_entry.get('headers', []):
+        name = header['name'].encode('utf-8')
+        if name.lower() == 'content-length':
+            had_length = True
+        if name.startswith(':') or \
+           name.lower() in _skip_response_headers:
+            continue
+        response.headers.append((name, header['value'].encode('utf-8')))
+
+    # the body's been decoded, so its length has probably changed.
+    if had_length:
+        response.headers.append(('Content-Length', str(len(body))))
+    response.content_list = [body]
+    response.errout = ''
+
+    timestamp = _parse_time(entry.get('startedDateTime', ''))
+    if entry.get('time', 0) > 0:
+        timestamp += entry['time'] / 1000.0
+
+    return Record(environ, inp, response, timestamp=timestamp)
+
+def _protocol(version):
+    version = (version or 'HTTP/1.1').encode('utf-8').upper()
+    if version.startswith('HTTP/'):
+        return version
+    return 'HTTP/1.1'
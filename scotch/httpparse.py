@@ -0,0 +1,408 @@
+"""
+Incremental HTTP/1.x response & request parsers.
+
+Feed it data as it comes off the network, and it hands back a list of
+events:
+
+>> parser = ResponseParser(method='GET')
+>> for (event, value) in parser.feed(data):
+..     if event == 'head':      # value is the list of (name, value) headers
+..         print parser.status_code, parser.reason
+..     elif event == 'body':    # value is a piece of the (de-chunked) body
+..         out.write(value)
+..     elif event == 'end':     # value is the list of chunked trailers
+..         break
+
+and call parser.feed_eof() when the server closes the connection.  Once
+the response is done, anything that was fed in past its end is left in
+'parser.unused'.  Interim (1xx) responses are skipped.
+
+The head is collected in a bytearray and scanned only once, however it's
+split up; body data is passed on without copying whenever a whole block
+belongs to the body.
+
+With tolerant=True (the default) the parser copes with broken servers:
+bare '\\n' line endings, header lines without a colon (which are ignored),
+missing reason phrases, and stray blank lines before the status line.
+
+RequestParser does the same for requests, as read off the client's side
+of a connection (e.g. by scotch.pcap); its events are the same, and a
+request without a Content-Length or chunked body has no body.
+"""
+
+from scotch.chunked import ChunkedDecoder, ChunkedError
+
+class ParseError(Exception):
+    pass
+
+class ResponseParser:
+    """
+    Parse one HTTP response, incrementally.
+    """
+    MAX_HEAD=65536
+
+    def __init__(self, method='GET', tolerant=True):
+        self.method = method
+        self.tolerant = tolerant
+
+        self.buf = bytearray()
+        self.scanned = 0                # how much of 'buf' has been searched
+
+        self.head = None
+        self.version = self.status_code = self.reason = None
+        self.headers = None
+
+        self.length = None
+        self.chunked = False
+        self.keep_alive = False
+
+        self.remaining = None
+        self.decoder = None
+        self.done = False
+        self.unused = ''
+
+    def feed(self, data):
+        """
+        Parse some more of the response; return a list of events.
+        """
+        if self.done:
+            self.unused += data
+            return []
+
+        events = []
+        if self.head is None:
+            data = self._feed_head(data, events)
+            if self.head is None or self.done:
+                return events
+
+        if data:
+            self._feed_body(data, events)
+
+        return events
+
+    def feed_eof(self):
+        """
+        The server has closed the connection; return the last events.
+        """
+        if self.done:
+            return []
+
+        if self.head is None:
+            raise ParseError("incomplete response head")
+
+        if self.chunked or self.remaining:
+            raise ParseError("incomplete response body")
+
+        self.done = True
+        return [('end', [])]
+
+    def _collect_head(self, data):
+        """
+        Collect a head; return (head, the data after it), or None if it
+        isn't all here yet.
+        """
+        buf = self.buf
+
+        if not buf:
+            # ignore any stray blank lines before the first line.
+            if data[:1] in ('\r', '\n'):
+                data = data.lstrip('\r\n')
+
+            # usually the whole head comes in one piece, and there's no
+            # need to copy it into the buffer at all.
+            end = find_head_end(data, 0)
+            if end >= 0:
+                return data[:end], data[end:]
+
+        buf.extend(data)
+        end = find_head_end(buf, max(0, self.scanned - 3))
+        if end < 0:
+            self.scanned = len(buf)
+            if len(buf) > self.MAX_HEAD:
+                raise ParseError("head too large")
+            return None
+
+        (head, data) = (str(buf[:end]), str(buf[end:]))
+        del buf[:]
+        self.scanned = 0
+
+        return head, data
+
+    def _feed_head(self, data, events):
+        """
+        Collect the head; once it's complete, parse it, and return any
+        data that's left over.
+        """
+        while 1:
+            collected = self._collect_head(data)
+            if collected is None:
+                return ''
+            (head, data) = collected
+
+            (self.version, self.status_code, self.reason, self.headers) = \
+                           parse_response_head(head, self.tolerant)
+
+            # skip over any interim (1xx) responses.
+            if not (100 <= self.status_code < 200):
+                break
+
+        self.head = head
+        rest = data
+
+        (self.length, self.chunked, self.keep_alive) = \
+                      response_framing(self.method, self.version,
+                                       self.status_code,
+                                       header_dict(self.headers))
+        events.append(('head', self.headers))
+
+        if self.chunked:
+            self.decoder = ChunkedDecoder()
+        elif self.length is not None:
+            self.remaining = self.length
+            if self.length == 0:
+                self._end(rest, [], events)
+                return ''
+
+        return rest
+
+    def _feed_body(self, data, events):
+        if self.decoder is not None:
+            try:
+                body = self.decoder.decode(data)
+            except ChunkedError, e:
+                raise ParseError(str(e))
+
+            if body:
+                events.append(('body', body))
+            if self.decoder.done:
+                self._end(self.decoder.unused, self.decoder.trailers, events)
+
+        elif self.remaining is not None:
+            n = len(data)
+            if n <= self.remaining:
+                self.remaining -= n
+                events.append(('body', data))
+                if self.remaining == 0:
+                    self._end('', [], events)
+            else:
+                events.append(('body', data[:self.remaining]))
+                self._end(data[self.remaining:], [], events)
+
+        else:
+            events.append(('body', data))   # until the connection closes.
+
+    def _end(self, unused, trailers, events):
+        self.remaining = 0
+        self.done = True
+        self.unused = unused
+        events.append(('end', trailers))
+
+class RequestParser(ResponseParser):
+    """
+    Parse one HTTP request, incrementally.
+    """
+    def __init__(self, tolerant=True):
+        ResponseParser.__init__(self, None, tolerant)
+        self.uri = None
+
+    def feed_eof(self):
+        """
+        The client has closed the connection; return the last events.
+        """
+        if self.done or (self.head is None and not self.buf):
+            return []
+
+        if self.head is None:
+            raise ParseError("incomplete request head")
+        raise ParseError("incomplete request body")
+
+    def _feed_head(self, data, events):
+        collected = self._collect_head(data)
+        if collected is None:
+            return ''
+        (head, rest) = collected
+
+        (self.method, self.uri, self.version, self.headers) = \
+                      parse_request_head(head, self.tolerant)
+        self.head = head
+
+        (self.length, self.chunked, self.keep_alive) = \
+                      request_framing(self.version, header_dict(self.headers))
+        events.append(('head', self.headers))
+
+        if self.chunked:
+            self.decoder = ChunkedDecoder()
+        else:
+            self.remaining = self.length
+            if self.length == 0:
+                self._end(rest, [], events)
+                return ''
+
+        return rest
+
+###
+
+def find_head_end(buf, start):
+    """
+    Find the end of the blank line that ends the head in 'buf', allowing
+    for '\\n' as well as '\\r\\n' line endings; -1 if it's not there yet.
+    """
+    end = -1
+    for terminator in ('\r\n\r\n', '\n\n', '\n\r\n'):
+        i = buf.find(terminator, start)
+        if i >= 0 and (end < 0 or i + len(terminator) < end):
+            end = i + len(terminator)
+
+    return end
+
+def _head_lines(head, tolerant):
+    """
+    Split a head into lines, dropping any blank ones before the first.
+    """
+    if head.count('\n') == head.count('\r\n'):
+        lines = head.split('\r\n')
+    elif tolerant:
+        lines = [ line.rstrip('\r') for line in head.split('\n') ]
+    else:
+        raise ParseError("bare newline in head")
+
+    while lines and not lines[0].strip():
+        lines.pop(0)
+    if not lines:
+        raise ParseError("empty head")
+
+    return lines
+
+def parse_response_head(head, tolerant=True):
+    """
+    Parse the status line & headers of a response.
+
+    Return (version, status code, reason, headers), where 'headers' is a
+    list of (name, value) pairs.
+    """
+    lines = _head_lines(head, tolerant)
+
+    status_line = lines[0].split(None, 2)
+    if len(status_line) < 2 or not status_line[0].startswith('HTTP/'):
+        raise ParseError("bad status line %r" % (lines[0],))
+
+    version = status_line[0]
+    try:
+        status_code = int(status_line[1])
+    except ValueError:
+        raise ParseError("bad status line %r" % (lines[0],))
+
+    reason = ''
+    if len(status_line) > 2:
+        reason = status_line[2].strip()
+
+    return version, status_code, reason, _parse_headers(lines, tolerant)
+
+def parse_request_head(head, tolerant=True):
+    """
+    Parse the request line & headers of a request.
+
+    Return (method, uri, version, headers), where 'headers' is a list of
+    (name, value) pairs.
+    """
+    lines = _head_lines(head, tolerant)
+
+    request_line = lines[0].split()
+    if len(request_line) != 3 or not request_line[2].startswith('HTTP/'):
+        raise ParseError("bad request line %r" % (lines[0],))
+
+    (method, uri, version) = request_line
+    return method, uri, version, _parse_headers(lines, tolerant)
+
+def _parse_headers(lines, tolerant):
+    """
+    Parse the header lines that follow the first line of a head.
+    """
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            break
+
+        if line[0] in ' \t' and headers:
+            # a continuation of the previous header.
+            (k, v) = headers[-1]
+            headers[-1] = (k, v + ' ' + line.strip())
+            continue
+
+        (k, colon, v) = line.partition(':')
+        if not colon or not k:
+            if tolerant:
+                continue
+            raise ParseError("bad header line %r" % (line,))
+
+        headers.append((k.strip(), v.strip()))
+
+    return headers
+
+def header_dict(headers):
+    """
+    Map lower-case header names to values, joining repeated headers.
+    """
+    d = {}
+    for (k, v) in headers:
+        k = k.lower()
+        if d.has_key(k):
+            v = d[k] + ', ' + v
+        d[k] = v
+    return d
+
+def response_framing(method, version, status_code, headers):
+    """
+    Figure out how the body of a response is delimited, given the header
+    dictionary from 'header_dict'.
+
+    Return a tuple (length, chunked, keep_alive): 'length' is the body
+    length, or None if it's chunked or runs until the connection closes;
+    'keep_alive' is True if the server will keep the connection open.
+    """
+    keep_alive = _keep_alive(version, headers)
+
+    if method == 'HEAD' or status_code in (204, 304) or \
+       100 <= status_code < 200:
+        return 0, False, keep_alive
+
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        return None, True, keep_alive
+
+    if headers.has_key('content-length'):
+        return _content_length(headers['content-length']), False, keep_alive
+
+    # no framing; the body runs until the server closes the connection.
+    return None, False, False
+
+def request_framing(version, headers):
+    """
+    Like response_framing, for a request: a request without a length
+    has no body.
+    """
+    keep_alive = _keep_alive(version, headers)
+
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        return None, True, keep_alive
+
+    if headers.has_key('content-length'):
+        return _content_length(headers['content-length']), False, keep_alive
+    return 0, False, keep_alive
+
+def _content_length(value):
+    """
+    Parse a Content-Length value, which may be repeated (joined by
+    'header_dict') as long as the lengths agree.
+    """
+    lengths = [ v.strip() for v in value.split(',') ]
+    for v in lengths:
+        if not v.isdigit() or v != lengths[0]:
+            raise ParseError("bad Content-Length %r" % (value,))
+    return int(lengths[0])
+
+def _keep_alive(version, headers):
+    tokens = [ t.strip().lower() for t in
+               headers.get('connection', '').split(',') ]
+    if version == 'HTTP/1.1':
+        return 'close' not in tokens
+    return 'keep-alive' in tokens
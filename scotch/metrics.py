@@ -0,0 +1,375 @@
+"""
+Counters, gauges & histograms for the proxy and the recorder, served in
+the Prometheus text format.
+
+>> registry = Registry()
+>> app = ProxyApp(metrics=registry)
+>> app = Recorder(app, metrics=registry)
+>> app = MetricsApp(app, registry)          # serves '/metrics'
+
+and then point Prometheus (or just a browser) at http://proxy:8000/metrics.
+Requests for the metrics path itself aren't proxied or recorded.
+
+Updating a metric doesn't take a lock: each thread counts into its own
+shard, and the shards are only added up when the metrics are rendered.
+Histograms have fixed buckets, so observing a value is a binary search
+and two additions.  That's cheap enough to leave on all the time.
+"""
+
+import time, threading
+from bisect import bisect_left
+
+# upper bounds, in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30)
+
+class _Shards:
+    """
+    Per-thread cells, for lock-free updates.
+    """
+    def __init__(self, make_cell):
+        self.make_cell = make_cell
+        self.local = threading.local()
+        self.cells = []                 # (thread, cell)
+        self.retired = make_cell()      # what finished threads counted.
+        self.lock = threading.Lock()
+
+    def cell(self):
+        try:
+            return self.local.cell
+        except AttributeError:
+            cell = self.local.cell = self.make_cell()
+
+            self.lock.acquire()
+            try:
+                self.cells.append((threading.currentThread(), cell))
+            finally:
+                self.lock.release()
+
+            return cell
+
+    def collect(self, merge):
+        """
+        Fold the cells of finished threads into 'retired', and return a
+        list of all the cells.
+        """
+        self.lock.acquire()
+        try:
+            live = []
+            for (thread, cell) in self.cells:
+                if thread.isAlive():
+                    live.append((thread, cell))
+                else:
+                    merge(self.retired, cell)
+            self.cells = live
+
+            return [self.retired] + [ cell for (_, cell) in live ]
+        finally:
+            self.lock.release()
+
+def _merge_dicts(into, cell):
+    for (k, v) in cell.items():
+        into[k] = into.get(k, 0) + v
+
+def _merge_lists(into, cell):
+    for i in range(len(cell)):
+        into[i] += cell[i]
+
+class Counter:
+    """
+    A count that only goes up, optionally split up by labels.
+    """
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.shards = _Shards(dict)
+
+    def inc(self, n=1, labels=()):
+        cell = self.shards.cell()
+        cell[labels] = cell.get(labels, 0) + n
+
+    def values(self):
+        """
+        Return a dictionary mapping label values to totals.
+        """
+        totals = {}
+        for cell in self.shards.collect(_merge_dicts):
+            _merge_dicts(totals, cell)
+        return totals
+
+    def render(self):
+        totals = self.values()
+        if not totals and not self.labelnames:
+            totals[()] = 0
+
+        keys = totals.keys()
+        keys.sort()
+
+        return [ '%s%s %s' % (self.name,
+                              _format_labels(zip(self.labelnames, k)),
+                              _format_value(totals[k])) for k in keys ]
+
+class Gauge(Counter):
+    """
+    A value that goes up & down, e.g. the number of active requests; or,
+    with 'fn', whatever fn() returns when the gauge is rendered.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), fn=None):
+        Counter.__init__(self, name, help, labelnames)
+        self.fn = fn
+
+    def dec(self, n=1, labels=()):
+        self.inc(-n, labels)
+
+    def values(self):
+        if self.fn is not None:
+            return { () : self.fn() }
+        return Counter.values(self)
+
+class Histogram:
+    """
+    Count observations into fixed buckets, and keep their sum.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+
+        # a cell is [ count per bucket ..., count over the top, sum ].
+        n = len(self.buckets) + 2
+        self.shards = _Shards(lambda: [0] * n)
+
+    def observe(self, value):
+        cell = self.shards.cell()
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def values(self):
+        """
+        Return (cumulative bucket counts, total count, sum).
+        """
+        totals = [0] * (len(self.buckets) + 2)
+        for cell in self.shards.collect(_merge_lists):
+            _merge_lists(totals, cell)
+
+        cumulative = []
+        count = 0
+        for n in totals[:-1]:
+            count += n
+            cumulative.append(count)
+
+        return cumulative[:-1], count, totals[-1]
+
+    def render(self):
+        (cumulative, count, total) = self.values()
+
+        lines = []
+        for (le, n) in zip(self.buckets, cumulative):
+            lines.append('%s_bucket{le="%s"} %d' % (self.name,
+                                                    _format_value(le), n))
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, count))
+        lines.append('%s_sum %s' % (self.name, _format_value(total)))
+        lines.append('%s_count %d' % (self.name, count))
+
+        return lines
+
+class Registry:
+    """
+    A collection of metrics, rendered together.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.by_name = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=(), fn=None):
+        return self._add(Gauge, name, help, labelnames, fn)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram, name, help, buckets)
+
+    def _add(self, klass, name, *args):
+        """
+        Create & register a metric, unless there's already one by that
+        name (e.g. from another ProxyApp sharing the registry).
+        """
+        self.lock.acquire()
+        try:
+            metric = self.by_name.get(name)
+            if metric is None:
+                metric = klass(name, *args)
+                self.metrics.append(metric)
+                self.by_name[name] = metric
+            elif metric.__class__ is not klass:
+                raise ValueError("metric %s is a %s" % (name, metric.type))
+            return metric
+        finally:
+            self.lock.release()
+
+    def render(self):
+        """
+        Render all of the metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in list(self.metrics):
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+
+    pairs = [ '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                                    .replace('\n', '\\n'))
+              for (k, v) in pairs ]
+    return '{%s}' % (','.join(pairs),)
+
+def _format_value(v):
+    if isinstance(v, float):
+        if v == int(v):
+            return '%d' % (v,)
+        return repr(v)
+    return str(v)
+
+class ProxyMetrics:
+    """
+    The metrics ProxyApp keeps, when it's given a registry.
+    """
+    def __init__(self, registry, app):
+        self.requests = registry.counter('scotch_proxy_requests_total',
+                              'Requests answered, by status class.',
+                              ('class',))
+        self.active = registry.gauge('scotch_proxy_active_requests',
+                              'Requests being answered right now.')
+        self.bytes = registry.counter('scotch_proxy_bytes_total',
+                              'Body bytes from clients (in) & to them (out).',
+                              ('direction',))
+        self.tunnel_bytes = registry.counter('scotch_proxy_tunnel_bytes_total',
+                              'Bytes relayed through CONNECT tunnels.',
+                              ('direction',))
+
+        self.connect_time = registry.histogram(
+                              'scotch_proxy_upstream_connect_seconds',
+                              'Time to open new upstream connections.')
+        self.ttfb = registry.histogram('scotch_proxy_upstream_ttfb_seconds',
+                              'Time from sending a request upstream to '
+                              'receiving the response head.')
+        self.total_time = registry.histogram('scotch_proxy_request_seconds',
+                              'Time to answer a request, body and all.')
+
+        scheduler = app.scheduler
+        registry.gauge('scotch_proxy_upstream_active',
+                       'Upstream requests in progress.',
+                       fn=lambda: scheduler.n_active)
+        registry.gauge('scotch_proxy_upstream_waiting',
+                       'Requests queued by the scheduler.',
+                       fn=lambda: scheduler.n_waiting)
+
+        pool = app.pool
+        registry.gauge('scotch_proxy_idle_connections',
+                       'Idle upstream connections in the pool.',
+                       fn=lambda: sum([ len(c) for c in pool.idle.values() ]))
+
+    def track(self, app, environ, start_response):
+        """
+        Run the WSGI app 'app', counting its response & timing it.
+        """
+        start = time.time()
+        self.active.inc()
+
+        try:
+            n = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            n = 0
+        if n:
+            self.bytes.inc(n, ('in',))
+
+        requests = self.requests
+        def counting_start_response(status, headers):
+            requests.inc(1, (status[:1] + 'xx',))
+            return start_response(status, headers)
+
+        try:
+            result = app(environ, counting_start_response)
+        except:
+            self.active.dec()
+            raise
+
+        return self._iter_tracked(result, environ, start)
+
+    def _iter_tracked(self, result, environ, start):
+        n = 0
+        try:
+            for data in result:
+                n += len(data)
+                yield data
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+            self.bytes.inc(n, ('out',))
+            self.total_time.observe(time.time() - start)
+            self.active.dec()
+
+            tunnel = environ.get('scotch.tunnel')
+            if tunnel is not None:
+                self.tunnel_bytes.inc(tunnel.bytes_up, ('up',))
+                self.tunnel_bytes.inc(tunnel.bytes_down, ('down',))
+
+    def fetched(self, proxy_request):
+        """
+        Note the connect time & time to first byte of an upstream request.
+        """
+        if proxy_request.connect_time is not None:
+            self.connect_time.observe(proxy_request.connect_time)
+        if proxy_request.ttfb is not None:
+            self.ttfb.observe(proxy_request.ttfb)
+
+class RecorderMetrics:
+    """
+    The metrics a Recorder keeps, when it's given a registry.
+    """
+    def __init__(self, registry, recorder):
+        self.records = registry.counter('scotch_recorder_records_total',
+                              'Transactions recorded.')
+        self.bytes = registry.counter('scotch_recorder_bytes_total',
+                              'Request & response body bytes recorded.')
+        self.in_flight = registry.gauge('scotch_recorder_in_flight',
+                              'Transactions being recorded right now.')
+
+        registry.gauge('scotch_recorder_records',
+                       'Records held in memory.',
+                       fn=lambda: len(recorder.record_holder))
+
+class MetricsApp:
+    """
+    WSGI middleware that answers requests for 'path' with the metrics in
+    'registry', and passes everything else on to 'app'.
+    """
+    def __init__(self, app, registry, path='/metrics'):
+        self.app = app
+        self.registry = registry
+        self.path = path
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') != self.path:
+            return self.app(environ, start_response)
+
+        body = self.registry.render()
+        start_response('200 OK',
+                       [('Content-type', 'text/plain; version=0.0.4'),
+                        ('Content-length', str(len(body)))])
+        return [body]
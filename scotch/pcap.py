@@ -0,0 +1,679 @@
+"""
+Import HTTP transactions from packet captures, as saved by tcpdump or
+wireshark.
+
+>> for record in read_pcap(open('capture.pcap', 'rb')):
+..    writer.write(record)
+
+or read_pcap_file('capture.pcap', jobs=4) to spread the work over
+several processes.
+
+The capture is read one packet at a time.  TCP segments are put back in
+order for each connection, and fed through HTTP parsers (scotch.httpparse)
+as soon as they're in order, so only a connection's out-of-order segments
+and the transaction in progress are kept; a connection is forgotten when
+it closes, or after 'idle' seconds (of capture time) without a packet.
+Records are stamped with the time of the response's last packet, and come
+out in that order: they're held back only while an earlier response is
+still in progress.
+
+Classic pcap (either byte order, micro- or nanosecond timestamps) and
+pcapng files are understood, with Ethernet (and VLAN), Linux "cooked",
+BSD loopback & raw IP link types, and IPv4 & IPv6.  Connections that
+don't start with an HTTP/1.x request, HTTPS & CONNECT tunnels, and
+connections whose capture is missing data are skipped.
+
+The records look like the proxy's: PATH_INFO is the absolute URL, and
+the response has its hop-by-hop headers removed & its body de-chunked
+(but not decompressed).
+
+With jobs > 1, each worker reads the whole capture but only follows the
+connections that hash to it, writing its records to a temporary
+recording; the recordings are then merged in timestamp order.
+"""
+
+import struct, socket, heapq, os, tempfile, shutil
+
+from scotch.recorder import Record, Response
+from scotch.httpparse import ResponseParser, RequestParser, ParseError, \
+     header_dict
+from scotch.proxy import _wsgi_response
+
+IDLE = 300                              # seconds before forgetting a conn.
+MAX_PENDING = 4 * 1024 * 1024           # out-of-order bytes per direction.
+RELEASE = 1.0                           # seconds between releasing records.
+
+class PcapError(Exception):
+    pass
+
+###
+### reading packets
+###
+
+_PCAP_MAGIC = { '\xd4\xc3\xb2\xa1' : ('<', 1e-6),
+                '\xa1\xb2\xc3\xd4' : ('>', 1e-6),
+                '\x4d\x3c\xb2\xa1' : ('<', 1e-9),
+                '\xa1\xb2\x3c\x4d' : ('>', 1e-9) }
+
+_PCAPNG_SHB = '\x0a\x0d\x0d\x0a'
+
+def read_packets(fp):
+    """
+    Yield (timestamp, link type, data) for each packet in a pcap or
+    pcapng file.
+    """
+    magic = fp.read(4)
+    if _PCAP_MAGIC.has_key(magic):
+        return _read_pcap(fp, magic)
+    elif magic == _PCAPNG_SHB:
+        return _read_pcapng(fp)
+
+    raise PcapError("not a pcap or pcapng file")
+
+def _read_pcap(fp, magic):
+    (order, resolution) = _PCAP_MAGIC[magic]
+
+    header = fp.read(20)
+    if len(header) < 20:
+        raise PcapError("truncated pcap header")
+    linktype = struct.unpack(order + 'HHiIII', header)[5] & 0xffff
+
+    record_header = struct.Struct(order + 'IIII')
+    size = record_header.size
+    read = fp.read
+
+    while 1:
+        data = read(size)
+        if len(data) < size:
+            break                       # (a truncated last packet is ok.)
+
+        (sec, frac, caplen, length) = record_header.unpack(data)
+        data = read(caplen)
+        if len(data) < caplen:
+            break
+
+        yield sec + frac * resolution, linktype, data
+
+def _read_pcapng(fp):
+    interfaces = []                     # (link type, resolution)
+    order = '<'
+    timestamp = 0
+    head = _PCAPNG_SHB
+
+    while 1:
+        if head == _PCAPNG_SHB:
+            # the byte-order magic tells us how to read the section.
+            head = fp.read(8)
+            if len(head) < 8:
+                raise PcapError("truncated pcapng section header")
+            order = head[4:] == '\x4d\x3c\x2b\x1a' and '<' or '>'
+            length = struct.unpack(order + 'I', head[:4])[0]
+            fp.read(length - 12)
+            interfaces = []
+        else:
+            block_type = struct.unpack(order + 'I', head)[0]
+            length = struct.unpack(order + 'I', fp.read(4))[0]
+            if length < 12:
+                raise PcapError("bad pcapng block length")
+            body = fp.read(length - 12)
+            fp.read(4)
+
+            if block_type == 1:                 # interface description
+                linktype = struct.unpack(order + 'H', body[:2])[0]
+                interfaces.append((linktype,
+                                   _pcapng_resolution(body[8:], order)))
+
+            elif block_type == 6:               # enhanced packet
+                (i, high, low, caplen) = struct.unpack(order + 'IIII',
+                                                       body[:16])
+                (linktype, resolution) = interfaces[i]
+                timestamp = ((high << 32) | low) * resolution
+                yield timestamp, linktype, body[20:20 + caplen]
+
+            elif block_type == 3:               # simple packet
+                length = struct.unpack(order + 'I', body[:4])[0]
+                yield timestamp, interfaces[0][0], body[4:4 + length]
+
+        head = fp.read(4)
+        if len(head) < 4:
+            break
+
+def _pcapng_resolution(options, order):
+    """
+    Find the timestamp resolution in an interface's options.
+    """
+    i = 0
+    while i + 4 <= len(options):
+        (code, length) = struct.unpack(order + 'HH', options[i:i+4])
+        if code == 0:
+            break
+        if code == 9:                           # if_tsresol
+            value = ord(options[i+4])
+            if value & 0x80:
+                return 2.0 ** -(value & 0x7f)
+            return 10.0 ** -value
+        i += 4 + ((length + 3) & ~3)
+
+    return 1e-6
+
+###
+### decoding packets
+###
+
+_ETHERNET, _NULL, _RAW, _LINUX_SLL, _LINUX_SLL2 = 1, 0, 101, 113, 276
+_LOOP, _RAW_OLD, _IPV4, _IPV6 = 108, 12, 228, 229
+
+_ETHERTYPE_IPV4, _ETHERTYPE_IPV6 = 0x0800, 0x86dd
+_VLAN = (0x8100, 0x88a8, 0x9100)
+
+_ipv6_extensions = { 0:1, 43:1, 60:1 }   # hop-by-hop, routing, dest. opts
+
+_FIN, _SYN, _RST, _ACK = 0x01, 0x02, 0x04, 0x10
+
+_u16 = struct.Struct('>H').unpack_from
+_tcp = struct.Struct('>HHIIBB').unpack_from
+
+def decode_packet(linktype, data):
+    """
+    Decode a TCP/IP packet; return (src, sport, dst, dport, seq, flags,
+    payload, length), where the addresses are packed & 'length' is the
+    real length of the payload, which may be longer than the captured
+    'payload'.  Return None for anything else (including IP fragments).
+    """
+    if linktype == _ETHERNET:
+        ethertype = _u16(data, 12)[0]
+        offset = 14
+        while ethertype in _VLAN:
+            ethertype = _u16(data, offset + 2)[0]
+            offset += 4
+    elif linktype == _LINUX_SLL:
+        (ethertype, offset) = (_u16(data, 14)[0], 16)
+    elif linktype == _LINUX_SLL2:
+        (ethertype, offset) = (_u16(data, 0)[0], 20)
+    elif linktype in (_NULL, _LOOP):
+        ethertype = _null_family.get(data[:4])
+        offset = 4
+    elif linktype in (_RAW, _RAW_OLD, _IPV4, _IPV6):
+        ethertype = _ip_version.get(ord(data[0]) >> 4)
+        offset = 0
+    else:
+        return None
+
+    if ethertype == _ETHERTYPE_IPV4:
+        header_length = (ord(data[offset]) & 0x0f) * 4
+        if ord(data[offset + 9]) != 6:
+            return None
+        if _u16(data, offset + 6)[0] & 0x3fff:   # MF flag or offset
+            return None
+
+        end = offset + _u16(data, offset + 2)[0]
+        if end == offset:
+            end = len(data)             # (segmentation offload.)
+
+        (src, dst) = (data[offset+12:offset+16], data[offset+16:offset+20])
+        offset += header_length
+
+    elif ethertype == _ETHERTYPE_IPV6:
+        next_header = ord(data[offset + 6])
+        end = offset + 40 + _u16(data, offset + 4)[0]
+        (src, dst) = (data[offset+8:offset+24], data[offset+24:offset+40])
+        offset += 40
+
+        while _ipv6_extensions.has_key(next_header):
+            next_header = ord(data[offset])
+            offset += (ord(data[offset + 1]) + 1) * 8
+        if next_header != 6:
+            return None
+
+    else:
+        return None
+
+    (sport, dport, seq, ack, data_offset, flags) = _tcp(data, offset)
+    payload = data[offset + (data_offset >> 4) * 4:end]
+    length = end - offset - (data_offset >> 4) * 4
+
+    return src, sport, dst, dport, seq, flags, payload, length
+
+_null_family = { '\x02\x00\x00\x00' : _ETHERTYPE_IPV4,
+                 '\x00\x00\x00\x02' : _ETHERTYPE_IPV4 }
+for _family in (10, 24, 28, 30):
+    _null_family[struct.pack('<I', _family)] = _ETHERTYPE_IPV6
+    _null_family[struct.pack('>I', _family)] = _ETHERTYPE_IPV6
+
+_ip_version = { 4 : _ETHERTYPE_IPV4, 6 : _ETHERTYPE_IPV6 }
+
+def _address(packed):
+    if len(packed) == 4:
+        return socket.inet_ntoa(packed)
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+###
+### reassembly
+###
+
+class _LostData(Exception):
+    pass
+
+class _Stream:
+    """
+    Put one direction of a TCP connection back in order.
+    """
+    def __init__(self):
+        self.next_seq = None
+        self.pending = {}               # seq => out-of-order data
+        self.pending_bytes = 0
+        self.fin = None                 # seq at which the stream ends
+        self.closed = False
+
+    def add(self, seq, flags, payload, length):
+        """
+        Add a segment; return the data that's now in order.
+        """
+        if flags & _SYN:
+            self.next_seq = (seq + 1) & 0xffffffff
+            seq = self.next_seq
+        elif self.next_seq is None:
+            self.next_seq = seq
+
+        if len(payload) < length:
+            raise _LostData()           # not all of it was captured.
+
+        if flags & _FIN:
+            self.fin = (seq + length) & 0xffffffff
+
+        out = []
+        if payload:
+            offset = (seq - self.next_seq) & 0xffffffff
+            if offset == 0 or offset >= 0x80000000:
+                self._take(seq, payload, out)
+            elif not self.pending.has_key(seq) or \
+                 len(self.pending[seq]) < len(payload):
+                self.pending_bytes += len(payload) - \
+                                      len(self.pending.get(seq, ''))
+                self.pending[seq] = payload
+                if self.pending_bytes > MAX_PENDING:
+                    raise _LostData()
+
+        if self.next_seq == self.fin:
+            self.closed = True
+
+        return ''.join(out)
+
+    def _take(self, seq, payload, out):
+        """
+        Take in-order (or retransmitted) data, & anything pending that
+        now follows on.
+        """
+        while 1:
+            behind = (self.next_seq - seq) & 0xffffffff
+            if behind < len(payload):
+                payload = payload[behind:]
+                out.append(payload)
+                self.next_seq = (self.next_seq + len(payload)) & 0xffffffff
+
+            if not self.pending:
+                return
+
+            # drop whatever's been overtaken; carry on with what's next.
+            seq = None
+            for (pending_seq, data) in self.pending.items():
+                behind = (self.next_seq - pending_seq) & 0xffffffff
+                if behind < 0x80000000:
+                    del self.pending[pending_seq]
+                    self.pending_bytes -= len(data)
+                    if behind < len(data):
+                        (seq, payload) = (pending_seq, data)
+
+            if seq is None:
+                return
+
+###
+### HTTP
+###
+
+class _Connection:
+    """
+    Follow the HTTP transactions on one TCP connection.
+    """
+    def __init__(self, client, server, timestamp):
+        self.client = client            # (packed address, port)
+        self.server = server
+        self.streams = { client : _Stream(), server : _Stream() }
+        self.last_seen = timestamp
+
+        self.request = RequestParser()
+        self.response = None
+        self.waiting = []               # [environ, input pieces, parser]
+        self.body = []
+        self.records = []
+        self.started = False
+        self.ignored = False
+
+    def add(self, timestamp, sender, seq, flags, payload, length):
+        """
+        Add a packet; return any records it completed.
+        """
+        self.last_seen = timestamp
+        stream = self.streams[sender]
+
+        if self.ignored:
+            # just wait for it to close.
+            if flags & _FIN:
+                stream.closed = True
+            return []
+
+        try:
+            data = stream.add(seq, flags, payload, length)
+
+            if data:
+                if sender == self.client:
+                    self._feed_request(data, timestamp)
+                else:
+                    self._feed_response(data, timestamp)
+
+            if stream.closed and sender == self.server and \
+               self.response is not None:
+                self._response_events(self.response.feed_eof(), timestamp)
+
+        except (ParseError, _LostData):
+            self.ignored = True
+
+        records = self.records
+        self.records = []
+        return records
+
+    def is_closed(self):
+        for stream in self.streams.values():
+            if not stream.closed:
+                return False
+        return True
+
+    def close(self, timestamp):
+        """
+        Give up on the connection: the capture ended, or it was reset or
+        idle.  Return any records that completes.
+        """
+        if not self.ignored and self.response is not None:
+            try:
+                self._response_events(self.response.feed_eof(), timestamp)
+            except ParseError:
+                pass
+
+        return self.records
+
+    def _feed_request(self, data, timestamp):
+        if not self.started:
+            self.started = True
+            if not _looks_like_request(data):
+                self.ignored = True     # not HTTP, e.g. HTTPS.
+                return
+
+        while data:
+            parser = self.request
+            for (event, value) in parser.feed(data):
+                if event == 'head':
+                    if parser.method == 'CONNECT':
+                        self.ignored = True      # a tunnel; can't follow.
+                        return
+                    environ = self._environ(parser)
+                    self.waiting.append([environ, [], parser])
+                elif event == 'body':
+                    self.waiting[-1][1].append(value)
+
+            if not parser.done:
+                break
+
+            data = parser.unused
+            self.request = RequestParser()
+
+    def _feed_response(self, data, timestamp):
+        while data:
+            if self.response is None:
+                if not self.waiting:
+                    raise ParseError("response without a request")
+                self.response = ResponseParser(self.waiting[0][2].method)
+                self.body = []
+
+            parser = self.response
+            self._response_events(parser.feed(data), timestamp)
+
+            if not parser.done:
+                break
+            data = parser.unused
+
+    def _response_events(self, events, timestamp):
+        parser = self.response
+        for (event, value) in events:
+            if event == 'body':
+                self.body.append(value)
+            elif event == 'end':
+                (environ, inp, _) = self.waiting.pop(0)
+
+                response = Response()
+                (response.status, response.headers) = \
+                    _wsgi_response(parser.status_code, parser.reason,
+                                   parser.headers)
+                response.content_list = [''.join(self.body)]
+                response.errout = ''
+
+                self.records.append(Record(environ, ''.join(inp), response,
+                                           timestamp=timestamp))
+                self.response = None
+                self.body = []
+
+    def _environ(self, parser):
+        """
+        Build a WSGI environ, like the proxy's, for a request.
+        """
+        (server_addr, server_port) = self.server
+        headers = header_dict(parser.headers)
+
+        uri = parser.uri
+        if uri.startswith('http://') or uri.startswith('https://'):
+            (scheme, rest) = uri.split('://', 1)
+            (netloc, slash, path) = rest.partition('/')
+            path = slash + path
+        else:
+            (scheme, path) = ('http', uri)
+            netloc = headers.get('host')
+            if not netloc:
+                netloc = _address(server_addr)
+                if ':' in netloc:
+                    netloc = '[%s]' % (netloc,)
+                if server_port != 80:
+                    netloc += ':%d' % (server_port,)
+
+        (path, question, query) = path.partition('?')
+
+        (host, port) = (netloc, '80')
+        if ':' in netloc and not netloc.endswith(']'):
+            (host, port) = netloc.rsplit(':', 1)
+
+        environ = { 'REQUEST_METHOD' : parser.method,
+                    'PATH_INFO' : '%s://%s%s' % (scheme, netloc, path),
+                    'QUERY_STRING' : query,
+                    'SERVER_PROTOCOL' : parser.version,
+                    'SERVER_NAME' : host,
+                    'SERVER_PORT' : port,
+                    'REMOTE_ADDR' : _address(self.client[0]),
+                    'REMOTE_PORT' : str(self.client[1]),
+                    'wsgi.url_scheme' : scheme }
+
+        for (name, value) in parser.headers:
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            if environ.has_key(key):
+                value = environ[key] + ', ' + value
+            environ[key] = value
+
+        return environ
+
+def _looks_like_request(data):
+    method = data.split(' ', 1)[0]
+    return len(method) < len(data) and method.isalpha() and method.isupper()
+
+###
+
+def read_pcap(fp, idle=IDLE, part=None):
+    """
+    Yield a Record for each HTTP transaction in the capture in 'fp', in
+    timestamp order.
+
+    With part=(i, n), only follow the connections in the i'th of n
+    parts of the capture.
+    """
+    connections = {}                    # (sender, receiver) => _Connection
+    next_sweep = None
+
+    # a connection that goes quiet in the middle of a response completes
+    # it when it's forgotten, stamped with its last packet's time; hold
+    # on to later records until then.
+    finished = []
+    pending = []                        # heap of (timestamp, n, record)
+    n = 0
+    next_release = 0
+
+    for (timestamp, linktype, data) in read_packets(fp):
+        for record in finished:
+            heapq.heappush(pending, (record.timestamp, n, record))
+            n += 1
+        finished = []
+
+        if pending and timestamp >= next_release:
+            next_release = timestamp + RELEASE
+            until = _in_progress_since(connections, timestamp)
+            while pending and pending[0][0] <= until:
+                yield heapq.heappop(pending)[2]
+
+        try:
+            packet = decode_packet(linktype, data)
+        except (struct.error, IndexError):
+            continue                    # a truncated header.
+        if packet is None:
+            continue
+
+        (src, sport, dst, dport, seq, flags, payload, length) = packet
+        sender, receiver = (src, sport), (dst, dport)
+
+        if part is not None and \
+           hash(min(sender, receiver) + max(sender, receiver)) % part[1] \
+               != part[0]:
+            continue
+
+        connection = connections.get((sender, receiver))
+
+        if flags & _SYN and not flags & _ACK:
+            # a new connection, perhaps reusing an old one's ports.
+            if connection is not None:
+                finished.extend(_forget(connections, connection, timestamp))
+            connection = _Connection(sender, receiver, timestamp)
+            connections[(sender, receiver)] = connection
+            connections[(receiver, sender)] = connection
+
+        elif connection is None:
+            if not payload or flags & _RST:
+                continue
+
+            # we missed the start; pick it up if it starts a request.
+            connection = _Connection(sender, receiver, timestamp)
+            connections[(sender, receiver)] = connection
+            connections[(receiver, sender)] = connection
+
+        if flags & _RST:
+            finished.extend(_forget(connections, connection, timestamp))
+            continue
+
+        finished.extend(connection.add(timestamp, sender, seq, flags,
+                                       payload, length))
+
+        if connection.is_closed():
+            finished.extend(_forget(connections, connection, timestamp))
+
+        # every so often, forget connections that have gone quiet.
+        if next_sweep is None:
+            next_sweep = timestamp + idle
+        elif timestamp >= next_sweep:
+            next_sweep = timestamp + idle
+            for connection in connections.values():
+                if connection.last_seen < timestamp - idle and \
+                   connections.has_key((connection.client,
+                                        connection.server)):
+                    finished.extend(_forget(connections, connection,
+                                            connection.last_seen))
+
+    for connection in connections.values():
+        if connections.has_key((connection.client, connection.server)):
+            finished.extend(_forget(connections, connection,
+                                    connection.last_seen))
+
+    for record in finished:
+        heapq.heappush(pending, (record.timestamp, n, record))
+        n += 1
+    while pending:
+        yield heapq.heappop(pending)[2]
+
+def _in_progress_since(connections, timestamp):
+    """
+    The time of the oldest last packet of a connection that's in the
+    middle of a response, or 'timestamp' if none are.
+    """
+    for connection in connections.values():
+        if connection.response is not None and not connection.ignored:
+            timestamp = min(timestamp, connection.last_seen)
+    return timestamp
+
+def _forget(connections, connection, timestamp):
+    del connections[(connection.client, connection.server)]
+    del connections[(connection.server, connection.client)]
+    return connection.close(timestamp)
+
+def read_pcap_file(filename, jobs=1, idle=IDLE):
+    """
+    Like read_pcap, for the capture in 'filename', using 'jobs' processes.
+    The records come out in timestamp order.
+    """
+    if jobs <= 1:
+        return read_pcap(open(filename, 'rb'), idle)
+
+    return _merge(filename, jobs, idle)
+
+def _merge(filename, jobs, idle):
+    import multiprocessing
+    from scotch.storage import RecordReader
+
+    tmpdir = tempfile.mkdtemp(prefix='scotch-pcap-')
+    try:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            tasks = [ (filename, idle, (i, jobs),
+                       os.path.join(tmpdir, 'part-%d' % (i,)))
+                      for i in range(jobs) ]
+            parts = pool.map(_read_part, tasks)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        def decorate(i, part):
+            for (n, record) in enumerate(RecordReader(open(part, 'rb'))):
+                yield record.timestamp, i, n, record
+
+        streams = [ decorate(i, part) for (i, part) in enumerate(parts) ]
+        for (_, _, _, record) in heapq.merge(*streams):
+            yield record
+    finally:
+        shutil.rmtree(tmpdir)
+
+def _read_part((filename, idle, part, outname)):
+    """
+    Write the records from one part of a capture to 'outname'.
+    """
+    from scotch.storage import RecordWriter
+
+    outfp = open(outname, 'wb')
+    writer = RecordWriter(outfp)
+    for record in read_pcap(open(filename, 'rb'), idle, part):
+        writer.write(record)
+    outfp.close()
+
+    return outname
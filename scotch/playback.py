@@ -0,0 +1,158 @@
+"""
+A WSGI app that answers requests from a recording, as a stand-in for
+ProxyApp (or for any other recorded app).
+
+>> from scotch.storage import load_records
+>> record_holder = load_records(open('recording.pickle', 'rb'))
+>> app = PlaybackApp(record_holder)
+
+Requests are matched to records through a hash index on the method, the
+URL, the query string (with its parameters sorted), and a digest of the
+POSTed body (form data is sorted too).  If there's no exact match, the
+app falls back on each of the looser matches in 'fallback':
+
+ * 'no-body' -- ignore the POSTed body;
+ * 'no-query' -- ignore the query string and the body.
+
+Parameters named in 'ignore_params' (e.g. cache-busting timestamps) are
+left out of the query string and form data before matching.
+
+When the same request was recorded several times, the recorded responses
+are played back in order.  Once they run out, 'sequence' says what to do:
+'repeat' the last one, 'cycle' back to the first, or be 'strict' and
+treat the request as unmatched.
+
+Unmatched requests get a '404 Not Found' and are listed in 'misses'.
+"""
+
+import cgi, threading
+from urllib import urlencode
+from hashlib import sha1
+
+from scotch.recorder import _extract_input
+
+FALLBACKS = ('no-body', 'no-query')
+SEQUENCES = ('repeat', 'cycle', 'strict')
+
+class PlaybackApp:
+    """
+    WSGI application serving recorded responses.
+    """
+    def __init__(self, record_holder, fallback=('no-body',), sequence='repeat',
+                 ignore_params=(), verbosity=0):
+        for level in fallback:
+            if level not in FALLBACKS:
+                raise ValueError("unknown fallback %r" % (level,))
+        if sequence not in SEQUENCES:
+            raise ValueError("unknown sequence %r" % (sequence,))
+
+        self.levels = ['exact'] + list(fallback)
+        self.sequence = sequence
+        self.ignore_params = dict([ (k, 1) for k in ignore_params ])
+        self.verbosity = verbosity
+
+        # level -> { key -> [ record, record, ... ] }
+        self.index = {}
+        for level in self.levels:
+            self.index[level] = {}
+
+        for record in record_holder:
+            keys = self._keys(record.environ, record.inp)
+            for level in self.levels:
+                self.index[level].setdefault(keys[level], []).append(record)
+
+        self.cursors = {}               # (level, key) -> next record
+        self.misses = []
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        inp = _extract_input(environ)
+        record = self.find(environ, inp)
+
+        if record is None:
+            self.lock.acquire()
+            try:
+                self.misses.append(_describe(environ))
+            finally:
+                self.lock.release()
+
+            if self.verbosity >= 1:
+                print '!! no recorded response for', _describe(environ)
+
+            start_response('404 Not Found', [('Content-type', 'text/plain')])
+            return ['no recorded response for %s\n' % (_describe(environ),)]
+
+        if self.verbosity >= 1:
+            print '==>', _describe(environ), '...', record.response.status
+
+        response = record.response
+        start_response(response.status, list(response.headers))
+        return list(response.content_list)
+
+    def find(self, environ, inp):
+        """
+        Find the record to play back for the given request, or None.
+        """
+        keys = self._keys(environ, inp)
+
+        self.lock.acquire()
+        try:
+            for level in self.levels:
+                key = keys[level]
+                records = self.index[level].get(key)
+                if records:
+                    return self._next(level, key, records)
+        finally:
+            self.lock.release()
+
+        return None
+
+    def _next(self, level, key, records):
+        """
+        Pick the next of several recorded responses to the same request.
+        """
+        i = self.cursors.get((level, key), 0)
+
+        if i >= len(records):
+            if self.sequence == 'strict':
+                return None
+            elif self.sequence == 'cycle':
+                i = 0
+            else:
+                i = len(records) - 1
+
+        self.cursors[(level, key)] = i + 1
+        return records[i]
+
+    def _keys(self, environ, inp):
+        """
+        Build the index key for each match level.
+        """
+        method = environ.get('REQUEST_METHOD', 'GET').upper()
+        url = environ.get('PATH_INFO', '')
+        query = self._normalize(environ.get('QUERY_STRING', ''))
+
+        body = inp
+        if environ.get('CONTENT_TYPE', '').startswith(
+                                    'application/x-www-form-urlencoded'):
+            body = self._normalize(inp)
+        digest = sha1(body).hexdigest()
+
+        return { 'exact' : (method, url, query, digest),
+                 'no-body' : (method, url, query),
+                 'no-query' : (method, url) }
+
+    def _normalize(self, qs):
+        """
+        Sort the parameters in a query string & drop the ignored ones.
+        """
+        params = [ (k, v) for (k, v) in cgi.parse_qsl(qs, True)
+                   if not self.ignore_params.has_key(k) ]
+        params.sort()
+        return urlencode(params)
+
+def _describe(environ):
+    url = environ.get('PATH_INFO', '')
+    if environ.get('QUERY_STRING'):
+        url += '?' + environ['QUERY_STRING']
+    return '%s %s' % (environ.get('REQUEST_METHOD', 'GET'), url)
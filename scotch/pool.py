@@ -0,0 +1,237 @@
+"""
+A pool of persistent (HTTP/1.1 keep-alive) upstream connections.
+
+scotch.proxy hands each finished connection back to the pool, and the
+next request for the same host:port picks it up again instead of paying
+for a new TCP handshake.  Briefly,
+
+>> pool = ConnectionPool(max_per_host=4, idle_timeout=30)
+>> conn = pool.get('www.example.com', 80, timeout=10)
+>> ... talk HTTP/1.1 over conn.sock / conn.read_some() / conn.unread() ...
+>> pool.put(conn)           # or conn.close() if it can't be reused.
+
+Idle connections are dropped once they've been idle for longer than
+'idle_timeout' seconds, and at most 'max_per_host' idle connections are
+kept for any one host:port.
+
+Hostnames are looked up through a scotch.resolver.Resolver, which caches
+the answers; new connections try each of the host's addresses in turn.
+"""
+
+import socket, select, time, threading
+
+from scotch.resolver import Resolver
+
+class Connection:
+    """
+    A single upstream connection, with a read buffer so that data that's
+    been read past the end of one response can be pushed back for the
+    next one.  Otherwise reads go straight to the socket.
+    """
+    BUFSIZE=65536
+
+    def __init__(self, host, port, timeout, addresses=None,
+                 connect_timeout=None):
+        """
+        Connect to host:port, waiting up to 'connect_timeout' seconds for
+        each address (or 'timeout', if it's not given); 'timeout' is the
+        limit for each read or write from then on.
+        """
+        if addresses is None:
+            addresses = [(host, port)]
+        if connect_timeout is None:
+            connect_timeout = timeout
+
+        # try each address in turn, until one of them answers.
+        error = socket.error("no addresses for %s:%s" % (host, port))
+        for address in addresses:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(float(connect_timeout))
+            try:
+                sock.connect(address)
+                break
+            except socket.error, e:
+                sock.close()
+                error = e
+        else:
+            raise error
+
+        sock.settimeout(float(timeout))
+
+        self.host = host
+        self.port = port
+        self.sock = sock
+
+        self.buf = ''                   # data that was pushed back
+
+        self.reused = False
+        self.last_used = time.time()
+        self.phases = []                # (name, start, end) of opening it.
+
+    def is_stale(self):
+        """
+        Check to see if the server has hung up on this (idle) connection.
+
+        An idle connection should never be readable: if it is, the server
+        has either closed it or sent us junk, and we can't use it.
+        """
+        if self.buf:
+            return True
+
+        try:
+            (readable, _, _) = select.select([self.sock], [], [], 0)
+        except (select.error, socket.error):
+            return True
+
+        return bool(readable)
+
+    def read_some(self, n):
+        """
+        Read at most 'n' bytes, waiting on the network only if nothing
+        is buffered; return '' at EOF.
+        """
+        if not self.buf:
+            return self.sock.recv(n)
+
+        (data, self.buf) = (self.buf[:n], self.buf[n:])
+        return data
+
+    def unread(self, data):
+        """
+        Push 'data' back onto the front of the read buffer.
+        """
+        if data:
+            self.buf = data + self.buf
+
+    def close(self):
+        self.sock.close()
+
+class ConnectionPool:
+    """
+    Keep track of idle upstream connections, indexed by (host, port).
+
+    The pool is thread-safe, so a single pool can be shared between
+    several ProxyApp objects and/or a multithreaded WSGI server.
+    """
+    MAX_PER_HOST=4
+    IDLE_TIMEOUT=30
+
+    def __init__(self, max_per_host=None, idle_timeout=None, resolver=None):
+        if max_per_host is None:
+            max_per_host = self.MAX_PER_HOST
+        if idle_timeout is None:
+            idle_timeout = self.IDLE_TIMEOUT
+
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+
+        if resolver is None:
+            resolver = Resolver()
+        self.resolver = resolver
+
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, host, port, timeout, fresh=False, connect_timeout=None):
+        """
+        Return a connection to host:port, reusing an idle one if possible.
+        'timeout' limits each read & write, and 'connect_timeout' (if it's
+        given) limits connecting.
+
+        If 'fresh' is True, always open a new connection.
+        """
+        if not fresh:
+            conn = self._get_idle(host, port)
+            if conn is not None:
+                conn.sock.settimeout(float(timeout))
+                return conn
+
+        start = time.time()
+        addresses = self.resolver.resolve(host, port)
+        resolved = time.time()
+        try:
+            conn = Connection(host, port, timeout, addresses,
+                              connect_timeout)
+        except socket.error:
+            # the host may have moved; look it up again next time.
+            self.resolver.invalidate(host, port)
+            raise
+
+        conn.phases = [('dns', start, resolved),
+                       ('connect', resolved, time.time())]
+        return conn
+
+    def put(self, conn):
+        """
+        Return a connection to the pool after a complete request/response.
+        """
+        now = time.time()
+        conn.last_used = now
+
+        self.lock.acquire()
+        try:
+            self._expire(now)
+
+            conns = self.idle.setdefault((conn.host, conn.port), [])
+            if len(conns) < self.max_per_host:
+                conns.append(conn)
+                conn = None
+        finally:
+            self.lock.release()
+
+        # too many idle connections to this host already; drop this one.
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        self.lock.acquire()
+        try:
+            idle, self.idle = self.idle, {}
+        finally:
+            self.lock.release()
+
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _get_idle(self, host, port):
+        now = time.time()
+
+        self.lock.acquire()
+        try:
+            conns = self.idle.get((host, port), [])
+            while conns:
+                conn = conns.pop()      # most recently used first.
+                if now - conn.last_used > self.idle_timeout or \
+                   conn.is_stale():
+                    conn.close()
+                    continue
+
+                conn.reused = True
+                conn.phases = []
+                return conn
+        finally:
+            self.lock.release()
+
+        return None
+
+    def _expire(self, now):
+        """
+        Close connections that have been idle too long.  Call with the
+        lock held.
+        """
+        for key, conns in self.idle.items():
+            keep = []
+            for conn in conns:
+                if now - conn.last_used > self.idle_timeout:
+                    conn.close()
+                else:
+                    keep.append(conn)
+
+            if keep:
+                self.idle[key] = keep
+            else:
+                del self.idle[key]
@@ -13,9 +13,50 @@ To start an actual proxy, mount this WSGI app as '/' on some port, e.g.
 
 and then set your browser's proxy to that address.
 
+Responses are relayed as they arrive: the status & headers are passed
+to 'start_response' as soon as they've been read, and the body is
+returned as an iterator over blocks read from the server.
+
+Upstream connections speak HTTP/1.1 and are kept open between requests
+in a ConnectionPool (see scotch.pool); pass in your own pool to change
+the limits or to share it between several ProxyApp objects.
+
+Upstream requests are scheduled by a scotch.scheduler.Scheduler, which
+limits how many are going at once, per host and in total, and queues the
+rest fairly by client address; requests that can't be scheduled in
+time get a '503 Service Unavailable'.  Requests to servers that don't
+answer within _ProxyRequest's CONNECT_TIMEOUT or READ_TIMEOUT get a
+'504 Gateway Timeout', and servers that can't be reached, or that send
+back something that isn't an HTTP response, a '502 Bad Gateway'.
+
+To serve repeated requests from a local cache, pass in an HTTPCache
+(see scotch.cache):
+
+>> app = ProxyApp(cache=HTTPCache(directory='/var/tmp/scotch-cache'))
+
+By default the client's Accept-Encoding is passed on as-is.  With
+compression='passthrough', only the encodings that scotch.recorder can
+decode later (gzip and deflate) are passed on; compressed bodies go to
+the client untouched, and are recorded compressed.  With
+compression='identity', the server is asked not to compress at all.
+
+HTTPS goes through CONNECT tunnels, which need the server's help: serve
+the app with scotch.tunnel.TunnelRequestHandler.  The tunnel's payload
+isn't recorded, just its metadata -- see scotch.tunnel.
+
+To keep request counts, latency histograms etc., pass in a
+scotch.metrics.Registry as 'metrics', and serve it with MetricsApp.
+To see where the time went in individual requests, serve the app with
+scotch.trace.TracingApp.
 """
 
-import urlparse, socket, urllib
+import sys, urlparse, socket, urllib, tempfile, time
+
+from scotch.pool import ConnectionPool
+from scotch.httpparse import ResponseParser, ParseError
+from scotch.tunnel import split_authority
+from scotch.scheduler import Scheduler, Overloaded
+from scotch.metrics import ProxyMetrics
 
 BE_TOLERANT_OF_BROKEN_SERVERS=True
 
@@ -24,13 +65,40 @@ class ProxyApp:
     WSGI transparent proxy application.
     """
     
-    def __init__(self, verbosity=0):
+    COMPRESSION_MODES = (None, 'passthrough', 'identity')
+
+    def __init__(self, verbosity=0, pool=None, cache=None, compression=None,
+                 scheduler=None, metrics=None):
+        if compression not in self.COMPRESSION_MODES:
+            raise ValueError("unknown compression mode %r" % (compression,))
+
         self.verbosity = verbosity
+        self.compression = compression
+
+        if pool is None:
+            pool = ConnectionPool()
+        self.pool = pool
+        self.cache = cache
+
+        if scheduler is None:
+            scheduler = Scheduler()
+        self.scheduler = scheduler
+
+        self.metrics = None
+        if metrics is not None:
+            self.metrics = ProxyMetrics(metrics, self)
 
     def __call__(self, environ, start_response):
         """
         The WSGI worker function.
         """
+        if self.metrics is not None:
+            return self.metrics.track(self._proxy, environ, start_response)
+        return self._proxy(environ, start_response)
+
+    def _proxy(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') == 'CONNECT':
+            return self._connect(environ, start_response)
 
         #
         # build the proxy request.
@@ -44,56 +112,241 @@ class ProxyApp:
 
             return []
 
+        if self.compression is not None:
+            proxy_request.set_headers([('ACCEPT-ENCODING',
+                       _accept_encoding(proxy_request.headers,
+                                        self.compression))])
+
         if self.verbosity >= 1:
             print '++', environ.get('PATH_INFO')
             _display_header_list('>>', proxy_request.headers)
 
         #
-        # build a connection, send & receive
+        # see if the cache can answer the request.
         #
-        
-        server_response = []
-        proxy_request.connect()
-        
+
+        entry = body = action = None
+        if self.cache is not None:
+            (entry, body, action) = \
+                    self.cache.check(proxy_request.method,
+                                     proxy_request.absolute_url(),
+                                     proxy_request.headers)
+
+            if action == 'HIT':
+                return self._serve_cached(entry, body, 'HIT', start_response)
+            elif action == 'REVALIDATE':
+                proxy_request.set_headers(entry.conditional_headers())
+
+        #
+        # build a connection, send & receive the response head
+        #
+
+        request_time = time.time()
         try:
-            proxy_request.send()
-            
-            # ...get entire response.
-            server_response = proxy_request.receive()
-        finally:
-            proxy_request.close()
+            self._fetch(proxy_request)
+        except:
+            if entry is not None:
+                self.cache.close_body(body)
+            return self._fetch_failed(proxy_request, start_response)
+
+        response_time = time.time()
+        if self.metrics is not None:
+            self.metrics.fetched(proxy_request)
 
         #
-        # deal with the server response by forwarding it back up to the client.
+        # deal with the server response by forwarding it back up to the
+        # client: headers now, body as it arrives.
         #
 
-        (status, headers, body) = _parse_server_response(server_response)
+        if entry is not None and proxy_request.status_code == 304:
+            for _ in proxy_request.iter_body():         # releases the conn.
+                pass
+
+            headers = proxy_request.response_headers
+            self.cache.refresh(entry, headers, request_time, response_time)
+
+            return self._serve_cached(entry, body, 'REVALIDATED',
+                                      start_response)
+
+        if entry is not None:
+            self.cache.close_body(body)
+            entry = None
+
+        new_entry = None
+        try:
+            status = proxy_request.status
+            headers = proxy_request.response_headers
+
+            if action is not None:
+                new_entry = self.cache.make_entry(proxy_request.absolute_url(),
+                                                  status, headers,
+                                                  proxy_request.headers,
+                                                  request_time, response_time)
+                headers = headers + [('X-Cache', 'MISS')]
+
+            if self.verbosity >= 1:
+                print '**', status
+                _display_header_list('<<', headers)
+                print ''
+
+            started = time.time()
+            start_response(status, headers)
+            proxy_request.span('start_response', started)
+        except:
+            proxy_request.close()
+            raise
+
+        blocks = proxy_request.iter_body()
+        if action is not None:
+            blocks = self.cache.iter_store(new_entry, blocks)
+
+        return blocks
+
+    def _serve_cached(self, entry, body, result, start_response):
+        """
+        Answer from the cache, with an up-to-date Age header and an
+        X-Cache header saying where the response came from.
+        """
+        headers = [ (k, v) for (k, v) in entry.headers
+                    if k.lower() != 'age' ]
+        headers.append(('Age', str(int(entry.current_age()))))
+        headers.append(('X-Cache', result))
 
         if self.verbosity >= 1:
-            print '**', status
+            print '**', entry.status, '(cached)'
             _display_header_list('<<', headers)
             print ''
-            
-        start_response(status, headers)
 
-        return [body]
+        try:
+            start_response(entry.status, headers)
+        except:
+            self.cache.close_body(body)
+            raise
+
+        return self.cache.iter_body(body)
+
+    def _connect(self, environ, start_response):
+        """
+        Open a CONNECT tunnel; it relays data as the server iterates over
+        the response body.
+        """
+        tunnel = environ.get('scotch.tunnel')
+        if tunnel is None:
+            start_response('501 Not Implemented',
+                           [('Content-type', 'text/plain')])
+            return ['CONNECT is not supported by this server\n']
+
+        if tunnel.client is None:
+            # a tunnel from a recording that's being played back; there's
+            # no client to relay for, so don't go upstream.
+            start_response('200 Connection established', [])
+            return []
+
+        authority = environ.get('PATH_INFO', '')
+        if self.verbosity >= 1:
+            print '++ CONNECT', authority
+
+        try:
+            (host, port) = split_authority(authority)
+            tunnel.connect(self.pool, host, port,
+                           _ProxyRequest.CONNECT_TIMEOUT)
+        except ValueError:
+            start_response('400 bad authority %s' % (authority,),
+                           [('Content-type', 'text/plain')])
+            return []
+        except socket.timeout:
+            start_response('504 Gateway Timeout',
+                           [('Content-type', 'text/plain')])
+            return ['timed out connecting to %s\n' % (authority,)]
+        except socket.error, e:
+            start_response('502 Bad Gateway', [('Content-type', 'text/plain')])
+            return ['could not connect to %s: %s\n' % (authority, e)]
+
+        write = start_response('200 Connection established', [])
+        write('')                   # get the response out before relaying.
+
+        return tunnel
+
+    def _fetch(self, proxy_request):
+        """
+        Wait for the scheduler, then send the request & read the response
+        head, retrying once on a fresh connection if a pooled connection
+        turns out to be dead.
+        """
+        proxy_request.schedule(self.scheduler)
+        try:
+            proxy_request.connect(self.pool)
+            proxy_request.send()
+            proxy_request.receive_head()
+            return
+        except (socket.error, _EmptyResponse), e:
+            conn = proxy_request.conn
+            if isinstance(e, socket.timeout) or conn is None or \
+               not conn.reused:
+                proxy_request.close()
+                raise
+            conn.close()                # ...but keep the scheduler slot.
+        except:
+            proxy_request.close()
+            raise
+
+        # the server hung up on our idle connection; try a new one.
+        try:
+            proxy_request.connect(self.pool, fresh=True)
+            proxy_request.send()
+            proxy_request.receive_head()
+        except:
+            proxy_request.close()
+            raise
+
+    def _fetch_failed(self, proxy_request, start_response):
+        """
+        Answer for a server we couldn't get a response from (or couldn't
+        even try); anything unexpected is passed on up.
+        """
+        (_, e, _) = sys.exc_info()
+        if isinstance(e, Overloaded):
+            status = '503 Service Unavailable'
+            headers = [('Retry-After', '1')]
+        elif isinstance(e, socket.timeout):
+            status = '504 Gateway Timeout'
+            headers = []
+        elif isinstance(e, (socket.error, _EmptyResponse, ParseError)):
+            status = '502 Bad Gateway'
+            headers = []
+        else:
+            raise
+
+        if self.verbosity >= 1:
+            print '**', status, '(%s)' % (e,)
+
+        start_response(status, [('Content-type', 'text/plain')] + headers)
+        return ['%s: %s %s\n' % (status, proxy_request.netloc, e)]
+
+class _EmptyResponse(Exception):
+    """
+    The server closed the connection without sending a response.
+    """
+    pass
 
 class _ProxyRequest:
     """
     A class to take care of all of the ugliness of extracting information
     from the client that will then be passed on to the server.
     """
-    TIMEOUT=10
+    CONNECT_TIMEOUT=10
+    READ_TIMEOUT=30
     BLOCKSIZE=4096
+    SPOOL_SIZE=1024*1024
 
     def __init__(self, environ):
-        (path_info, protocol, method, query_string, body) = \
+        (path_info, protocol, method, query_string, content_len) = \
                     _extract_wsgi_in_headers(environ)
         
         client_headers = _extract_client_headers(environ)
         
-        if body:
-            client_headers.append(('CONTENT-LENGTH', len(body),))
+        if content_len:
+            client_headers.append(('CONTENT-LENGTH', content_len,))
         if environ.get('CONTENT_TYPE') and method == 'POST':
             client_headers.append(('CONTENT-TYPE', environ['CONTENT_TYPE']))
 
@@ -111,79 +364,279 @@ class _ProxyRequest:
         if scm != 'http' or not netloc:
             raise Exception("bad url %s" % (path_info,))
 
+        # HTTP/1.1 requires a Host header.
+        for (k, v) in client_headers:
+            if k.lower() == 'host':
+                break
+        else:
+            client_headers.append(('HOST', netloc))
+
         self.method = method
-        self.body = body
-        self.headers = client_headers
         self.netloc = netloc
         self.url = url
         self.protocol = protocol
 
-    def connect(self):
+        # the body is streamed from 'wsgi.input' when the request is sent.
+        self.input = environ.get('wsgi.input')
+        self.content_len = content_len
+        self.spool = None
+
+        # requests are scheduled fairly between client addresses.
+        self.session = environ.get('REMOTE_ADDR')
+        self.scheduler = self.slot = None
+
+        self.pool = self.conn = None
+        self.keep_alive = self.complete = False
+
+        # how long it took to connect (if it wasn't a pooled connection)
+        # and from sending the request to getting the response head.
+        self.connect_time = self.ttfb = None
+        self.sent_at = None
+
+        # a scotch.trace.Trace, if this request is being traced.
+        self.trace = environ.get('scotch.trace')
+
+        self.headers = []
+        self.set_headers(client_headers)
+
+    def set_headers(self, headers):
         """
-        Connect to the given network location ('host:port')
+        Add headers to the request, replacing any with the same names,
+        & rebuild the request line & headers.
         """
-        netloc = self.netloc
-        
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        i = netloc.find(':')
+        replaced = dict([ (k.lower(), 1) for (k, v) in headers ])
+        self.headers = [ (k, v) for (k, v) in self.headers
+                         if not replaced.has_key(k.lower()) ] + headers
 
-        if i >= 0:
-            host, port = netloc[:i], int(netloc[i+1:])
-        else:
-            host, port = netloc, 80
+        request = ['%s %s %s\r\n' % (self.method, self.url, self.protocol,)]
+        for k, v in self.headers:
+            request.append("%s: %s\r\n" % (k, v,))
+        request.append("\r\n")
 
-        sock.settimeout(float(self.TIMEOUT))
-        sock.connect((host, port))
+        self.request_head = "".join(request)
+
+    def absolute_url(self):
+        return 'http://%s%s' % (self.netloc, self.url)
+
+    def schedule(self, scheduler):
+        """
+        Wait for the scheduler to let the request go ahead; raises
+        scotch.scheduler.Overloaded if it won't.
+        """
+        (host, port) = _split_netloc(self.netloc)
 
-        self.sock = sock
+        start = time.time()
+        self.slot = scheduler.acquire(host, port, self.session)
+        self.scheduler = scheduler
+        self.span('queue', start)
+
+    def connect(self, pool, fresh=False):
+        """
+        Get a connection to the given network location ('host:port')
+        from the pool.
+        """
+        (host, port) = _split_netloc(self.netloc)
+
+        self.pool = pool
+        self.conn = None
+
+        start = time.time()
+        self.conn = pool.get(host, port, self.READ_TIMEOUT, fresh,
+                             self.CONNECT_TIMEOUT)
+        self.connect_time = None
+        if not self.conn.reused:
+            self.connect_time = time.time() - start
+
+        for (name, start, end) in self.conn.phases:    # dns & connect.
+            self.span(name, start, end)
+
+        self.keep_alive = False
+        self.complete = False
 
     def send(self):
         """
-        Send an HTTP request on via the given socket.
+        Send an HTTP request on via the connection, streaming the body
+        (if any) from 'wsgi.input' a block at a time.
         """
-        sock = self.sock
+        sock = self.conn.sock
+        self.sent_at = time.time()
 
-        # build the request line
-        request = '%s %s %s\r\n' % (self.method,
-                                    self.url,
-                                    self.protocol,)
+        if not self.content_len:
+            sock.sendall(self.request_head)
+        else:
+            # send the head along with the first block of the body, so
+            # that small requests still go out in a single write.
+            blocks = self._iter_request_body()
 
-        # build the header list
-        for k, v in self.headers:
-            request += "%s: %s\r\n" % (k, v,)
+            first = ''
+            for first in blocks:
+                break
+            sock.sendall(self.request_head + first)
 
-        # put together the rest of the request data
-        request += "\r\n"
-        if self.body is not None:
-            request += self.body
+            for data in blocks:
+                sock.sendall(data)
 
-        # send
-        sock.send(request)
+        self.span('send', self.sent_at)
 
-    def receive(self):
+    def _iter_request_body(self):
         """
-        Get the entirety of an HTTP response from the given socket.
+        Yield the request body in blocks.
 
-        Note: 'Connection: close' must have have been sent for this to work...
+        If the connection is a reused one, the request may have to be
+        retried on a new connection, so keep a copy of what's been read
+        from 'wsgi.input' in a spool file (in memory up to SPOOL_SIZE
+        bytes, on disk past that).  A retry replays the copy first.
+        """
+        remaining = self.content_len
+
+        if self.spool is not None:
+            self.spool.seek(0)
+            while 1:
+                data = self.spool.read(self.BLOCKSIZE)
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+        spool = None
+        if self.conn.reused:
+            spool = self.spool = \
+                    tempfile.SpooledTemporaryFile(self.SPOOL_SIZE)
+
+        while remaining > 0:
+            data = self.input.read(min(remaining, self.BLOCKSIZE))
+            if not data:
+                raise Exception("client sent an incomplete request body")
+
+            if spool is not None:
+                spool.write(data)
+            remaining -= len(data)
+            yield data
+
+    def receive_head(self):
         """
-        sock = self.sock
-        response = []
+        Read the status line & headers of the response, and figure out
+        how the body is delimited.
+        """
+        conn = self.conn
+        parser = self.parser = \
+                 ResponseParser(self.method, BE_TOLERANT_OF_BROKEN_SERVERS)
 
-        while 1:
-            data = sock.recv(self.BLOCKSIZE)
-            response.append(data)
+        events = []
+        received = None                 # when the first data arrived.
+        waiting = time.time()
+        try:
+            while parser.headers is None:
+                data = conn.read_some(conn.BUFSIZE)
+                if data:
+                    if received is None:
+                        received = time.time()
+                        self.span('ttfb', waiting, received)
+                    events = parser.feed(data)
+                elif received is None:
+                    raise _EmptyResponse()
+                else:
+                    parser.feed_eof()
+        except ParseError, e:
+            raise ParseError("bad response head from server: %s" % (e,))
+
+        now = time.time()
+        self.ttfb = now - self.sent_at
+        self.span('parse', received, now)
+
+        # body events that arrived along with the head.
+        self.events = [ e for e in events if e[0] != 'head' ]
+
+        self.keep_alive = parser.keep_alive
+        self.status_code = parser.status_code
+        (self.status, self.response_headers) = \
+                      _wsgi_response(parser.status_code, parser.reason,
+                                     parser.headers)
+
+        # the server has answered, so we won't be retrying the request.
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+    def iter_body(self):
+        """
+        Yield the body of the response in blocks, as they come off the
+        connection, de-chunking if necessary; then release the connection.
 
-            if len(data) == 0:
-                break
+        The connection is only put back in the pool if the body was read
+        completely.
+        """
+        conn = self.conn
+        parser = self.parser
+        events = self.events
 
-        return "".join(response)
+        start = time.time()
+        n = 0
+
+        try:
+            while 1:
+                for (event, value) in events:
+                    if event == 'body':
+                        n += len(value)
+                        yield value
+                    elif event == 'end':
+                        # anything past the end belongs to the next response.
+                        conn.unread(parser.unused)
+                        self.complete = True
+                        return
+
+                data = conn.read_some(conn.BUFSIZE)
+                try:
+                    if data:
+                        events = parser.feed(data)
+                    else:
+                        events = parser.feed_eof()
+                except ParseError:
+                    return              # truncated; drop the connection.
+        finally:
+            self.span('body', start, bytes=n)
+            self.close()
+
+    def span(self, name, start, end=None, **args):
+        """
+        Add a span to the trace, if the request is being traced.
+        """
+        if self.trace is not None:
+            if end is None:
+                end = time.time()
+            self.trace.add(name, start, end, **args)
 
     def close(self):
-        self.sock.close()
+        """
+        Put the connection back in the pool if the response was read
+        completely and the server is willing to keep it open; otherwise,
+        close it.
+        """
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            if self.keep_alive and self.complete:
+                self.pool.put(conn)
+            else:
+                conn.close()
+
+        # let the next request to this server go ahead.
+        if self.slot is not None:
+            self.scheduler.release(self.slot)
+            self.slot = None
 
 ###
 
-_client_omit = { 'proxy-connection' : 1 }
+
+_hoppish = {
+    'connection':1, 'keep-alive':1, 'proxy-authenticate':1,
+    'proxy-authorization':1, 'te':1, 'trailers':1, 'transfer-encoding':1,
+    'upgrade':1
+    }
+
+# hop-by-hop headers only apply to the client <-> proxy connection, so
+# don't pass them on to the server.
+_client_omit = dict(_hoppish)
+_client_omit['proxy-connection'] = 1
 
 def _extract_client_headers(env):
     """
@@ -203,41 +656,53 @@ def _extract_client_headers(env):
 
     return headers
 
-_hoppish = {
-    'connection':1, 'keep-alive':1, 'proxy-authenticate':1,
-    'proxy-authorization':1, 'te':1, 'trailers':1, 'transfer-encoding':1,
-    'upgrade':1
-    }
+_decodable_encodings = { 'gzip':1, 'x-gzip':1, 'deflate':1 }
 
-def _parse_server_response(response):
+def _accept_encoding(headers, compression):
+    """
+    Build the Accept-Encoding header to send to the server.
     """
-    Parse the HTTP response into a status line, headers, and body.
+    if compression == 'identity':
+        return 'identity'
 
-    Remove "hoppish" headers that WSGI can't/won't handle.
+    value = ''
+    for (k, v) in headers:
+        if k.lower() == 'accept-encoding':
+            value = v
+
+    codings = []
+    for coding in value.split(','):
+        name = coding.split(';')[0].strip().lower()
+        if _decodable_encodings.has_key(name):
+            codings.append(coding.strip())
+
+    return ', '.join(codings) or 'identity'
+
+def _wsgi_response(status_code, reason, headers):
     """
-    try:
-        status_line, response = response.split("\r\n", 1)
-        headers, body = response.split("\r\n\r\n", 1)
-    except ValueError:
-        # some servers occasionally use '\n' instead of \r\n', the bastards.
-        if BE_TOLERANT_OF_BROKEN_SERVERS:
-            status_line, response = response.split("\n", 1)
-            headers, body = response.split("\n\n", 1)
-        else:
-            raise
+    Build the WSGI status line & headers for a parsed response.
 
-    status = status_line.split(' ', 1)[1]
-    headers = headers.split("\r\n")
-    headers = [ h.split(':', 1) for h in headers ]
+    Remove "hoppish" headers that WSGI can't/won't handle.
+    """
+    status = ('%d %s' % (status_code, reason)).rstrip()
 
-    # remove hoppy headers
     new_headers = []
     for (a, b) in headers:
         if not _hoppish.has_key(a.lower()):
-            new_headers.append((a, b[1:]))
-    
+            new_headers.append((a, b))
+
+    return status, new_headers
+
+def _split_netloc(netloc):
+    """
+    Split a network location ('host:port' or 'host') into host and port.
+    """
+    i = netloc.find(':')
+
+    if i >= 0:
+        return netloc[:i], int(netloc[i+1:])
 
-    return status, new_headers, body
+    return netloc, 80
 
 def _extract_wsgi_in_headers(environ):
     """
@@ -246,23 +711,22 @@ def _extract_wsgi_in_headers(environ):
     # URL
     path_info = environ['PATH_INFO']
 
-    # downgrade the protocol to HTTP/1.0
-    protocol = environ['SERVER_PROTOCOL']
-    if protocol == 'HTTP/1.1':
-        protocol = 'HTTP/1.0'
+    # we always talk HTTP/1.1 to the server, whatever the client speaks,
+    # so that the connection can be kept open & reused.
+    protocol = 'HTTP/1.1'
 
     # method (GET/POST/etc.)
     method = environ['REQUEST_METHOD']
     query_string = environ.get('QUERY_STRING', "")
 
-    # read the input
+    # size of the input; it's read later on, as it's sent to the server.
     content_len = environ.get('CONTENT_LENGTH', 0)
-    body = None
     if content_len:
         content_len = int(content_len)
-        body = environ['wsgi.input'].read(content_len)
+    else:
+        content_len = 0
 
-    return (path_info, protocol, method, query_string, body)
+    return (path_info, protocol, method, query_string, content_len)
 
 def _display_header_list(prefix, headers):
     """
@@ -19,12 +19,20 @@ You can also do:
 ..      record.refeed(wsgi_app)
 
 to replay the recorded session.
+
+Compressed (gzip/deflate) responses are recorded as they came over the
+wire; use Response.get_decoded_output() to get at the text.
+
+Pass a scotch.metrics.Registry as 'metrics' to count the records &
+bytes recorded; requests traced by scotch.trace.TracingApp get spans for
+capturing the request and building & storing the record.
 """
 
+import time, threading, zlib
 from cStringIO import StringIO
-from cPickle import load, dump
 
 from scotch import utils
+from scotch.metrics import RecorderMetrics
 
 class Response:
     """
@@ -37,13 +45,53 @@ class Response:
     def get_output(self):
         return "".join(self.content_list)
 
+    def get_output_length(self):
+        """
+        Return the length of the output -- even if it wasn't loaded, as
+        when scotch.storage reads records without their bodies.
+        """
+        if self.content_list is None:
+            return getattr(self, 'output_length', 0)
+        return sum([ len(data) for data in self.content_list ])
+
+    def get_decoded_output(self):
+        """
+        Return the output, decompressed according to its Content-Encoding.
+
+        The decoded output is computed the first time it's asked for, and
+        isn't saved with the response.  Output that can't be decoded is
+        returned as-is.
+        """
+        decoded = getattr(self, '_decoded', None)
+        if decoded is None:
+            decoded = _decode(self.get_output(), self.get_content_encoding())
+            self._decoded = decoded
+
+        return decoded
+
     def get_content_type(self):
+        return self._get_header('content-type')
+
+    def get_content_encoding(self):
+        encoding = self._get_header('content-encoding')
+        if encoding is not None:
+            encoding = encoding.strip().lower()
+        return encoding
+
+    def _get_header(self, name):
         for (h, v) in self.headers:
-            if h.lower() == 'content-type':
+            if h.lower() == name:
                 return v
 
         return None
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for k in ('_decoded', 'output_length'):
+            if state.has_key(k):
+                del state[k]
+        return state
+
     def get_status_code(self):
         status_code = self.status.split()[0]
         return int(status_code)
@@ -66,10 +114,13 @@ class Record:
     object.
     """
     
-    def __init__(self, environ, inp, response):
+    def __init__(self, environ, inp, response, timestamp=None):
         """
         Create a record object, with the WSGI environment, any POST-ed
         input, and the response object (of type Response).
+
+        'timestamp' is the time the transaction completed; it defaults
+        to now.
         """
         self.environ = environ
         self.inp = str(inp)
@@ -77,14 +128,18 @@ class Record:
         assert isinstance(response, Response)
         self.response = response
 
+        if timestamp is None:
+            timestamp = time.time()
+        self.timestamp = timestamp
+
     def is_post(self):
         method = self.environ.get('REQUEST_METHOD', '')
-        if method.lower() is 'post':
+        if method.lower() == 'post':
             return True
 
     def is_get(self):
         method = self.environ.get('REQUEST_METHOD', '')
-        if method.lower() is 'get':
+        if method.lower() == 'get':
             return True
 
     def has_input(self):
@@ -153,9 +208,12 @@ class RecordHolder:
 class Recorder:
     """
     Record WSGI transactions.
+
+    Recorders are thread-safe, so they can be served by a multithreaded
+    WSGI server.
     """
     
-    def __init__(self, app, record_holder=None, verbosity=0):
+    def __init__(self, app, record_holder=None, verbosity=0, metrics=None):
         """
         Create a WSGI recorder middleware object.
         """
@@ -165,17 +223,25 @@ class Recorder:
             record_holder = RecordHolder()
         self.record_holder = record_holder
         self.verbosity = verbosity
+        self.lock = threading.Lock()
+
+        self.metrics = None
+        if metrics is not None:
+            self.metrics = RecorderMetrics(metrics, self)
 
-    def load(self, fp):
+    def load(self, fp, allow_pickle=False):
+        """
+        Load a recording saved with 'save' (or, with allow_pickle=True,
+        an old pickled one).
+        """
+        from scotch.storage import load_records
         assert len(self.record_holder) == 0
         
-        record_holder = load(fp)
-        assert isinstance(record_holder, RecordHolder)
-        
-        self.record_holder = record_holder
+        self.record_holder = load_records(fp, allow_pickle)
 
     def save(self, fp):
-        dump(self.record_holder, fp)
+        from scotch.storage import save_records
+        save_records(self.record_holder, fp)
 
     def __call__(self, orig_environ, orig_start_response):
         """
@@ -187,11 +253,18 @@ class Recorder:
         # input data & the original error fp; then, duplicate the environment.
         #
         
+        trace = orig_environ.get('scotch.trace')
+        if trace is not None:
+            start = time.time()
+
         orig_inp = _extract_input(orig_environ)
         orig_errfp = orig_environ['wsgi.errors']
         
         environ = _build_new_environ(orig_inp, orig_environ)
 
+        if trace is not None:
+            trace.add('capture', start, time.time(), 'recorder')
+
         #
         # build a Response object, and a 'results' list, to hold the response.
         # Also build a wrapper 'start_response' function that records the
@@ -216,11 +289,24 @@ class Recorder:
         # run the application, & grab the iterator/generator output.
         #
 
-        generator = self.app(environ, start_response)
-
-        for data in generator:
-            results.append(data)
-            yield data
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.in_flight.inc()
+
+        try:
+            generator = self.app(environ, start_response)
+
+            try:
+                for data in generator:
+                    results.append(data)
+                    yield data
+            finally:
+                # let the app clean up, e.g. release its connections.
+                if hasattr(generator, 'close'):
+                    generator.close()
+        finally:
+            if metrics is not None:
+                metrics.in_flight.dec()
             
         response.content_list = results
 
@@ -232,12 +318,28 @@ class Recorder:
         response.errout = errout
 
         # save this record.
+        if trace is not None:
+            start = time.time()
+
         record = Record(_cleanse_environ(orig_environ), orig_inp, response)
-        self.record_holder.add_record(record)
 
-        if self.verbosity >= 1:
-            if utils.display_record(record):
-                print '(# %d)' % (len(self.record_holder),)
+        if metrics is not None:
+            metrics.records.inc()
+            metrics.bytes.inc(len(orig_inp) +
+                              sum([ len(data) for data in results ]))
+
+        self.lock.acquire()
+        try:
+            self.record_holder.add_record(record)
+
+            if self.verbosity >= 1:
+                if utils.display_record(record):
+                    print '(# %d)' % (len(self.record_holder),)
+        finally:
+            self.lock.release()
+
+        if trace is not None:
+            trace.add('serialize', start, time.time(), 'recorder')
 
 def _build_new_environ(inp, orig_environ):
     """
@@ -261,9 +363,33 @@ def _cleanse_environ(environ):
 
     if env.has_key('wsgi.errors'):
         del env['wsgi.errors']
+
+    if env.has_key('scotch.trace'):
+        del env['scotch.trace']
+
+    if env.has_key('wsgi.file_wrapper'):
+        del env['wsgi.file_wrapper']
         
     return env
 
+def _decode(output, encoding):
+    """
+    Undo a gzip or deflate Content-Encoding.
+    """
+    try:
+        if encoding in ('gzip', 'x-gzip'):
+            return zlib.decompress(output, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            # supposedly zlib-wrapped, but some servers send raw deflate.
+            try:
+                return zlib.decompress(output)
+            except zlib.error:
+                return zlib.decompress(output, -zlib.MAX_WBITS)
+    except zlib.error:
+        pass
+
+    return output
+
 def _extract_input(environ):
     """
     Return the input, read from environ['wsgi.input'].
@@ -0,0 +1,299 @@
+"""
+Combine, split & slice recording files, a record at a time.
+
+>> save_records(concatenate(['monday.scotch', 'tuesday.scotch']),
+..              open('both.scotch', 'wb'))
+
+>> for record in merge(glob.glob('worker-*.scotch')):
+..    ...                               # in timestamp order
+
+>> split(merge(filenames), by_host, 'hosts/')
+
+>> for record in select(filenames, start=1000, stop=2000,
+..                      predicate=lambda r: r.is_post()):
+..    ...
+
+Nothing here holds more than a record per input in memory, except
+merge, which sorts inputs that aren't in order already by an external
+merge sort: it reads 'run_bytes' worth of records at a time, sorts them,
+and writes them to a temporary file, and then merges the sorted inputs
+& temporary files, at most FANIN at a time.  Inputs are checked for
+order first, reading just the records' metadata.
+
+Old pickled recordings can be read too, given allow_pickle=True (see
+scotch.storage), although they have to be loaded all at once.
+"""
+
+import os, re, heapq, tempfile, shutil, urlparse
+
+from scotch.storage import RecordReader, RecordWriter
+from scotch.translate import Sessions
+
+RUN_BYTES = 64 * 1024 * 1024            # sort this much at a time.
+FANIN = 64                              # merge at most this many files.
+MAX_OPEN = 64                           # files open at a time, in split.
+
+def timestamp_key(record):
+    # (records from old recordings may not have a timestamp.)
+    return getattr(record, 'timestamp', 0)
+
+def concatenate(filenames, bodies=True, allow_pickle=False):
+    """
+    Yield the records from each file in turn.
+    """
+    for filename in filenames:
+        fp = open(filename, 'rb')
+        try:
+            reader = RecordReader(fp, allow_pickle)
+            for record in reader.iter_records(bodies=bodies):
+                yield record
+        finally:
+            fp.close()
+
+def parse_range(text):
+    """
+    Parse a range of record numbers, counting from 1: 'N-M', 'N-', '-M'
+    or 'N'.  Return (first, last), where 'last' is None if the range is
+    open-ended; raise ValueError if it's not a range.
+    """
+    if '-' in text:
+        (first, last) = text.split('-', 1)
+        first = int(first or 1)
+        last = last and int(last) or None
+    else:
+        first = last = int(text)
+
+    if first < 1 or (last is not None and last < first):
+        raise ValueError("bad range %r" % (text,))
+
+    return first, last
+
+def select(filenames, start=0, stop=None, predicate=None, allow_pickle=False):
+    """
+    Yield records 'start' up to 'stop' (counting from 0, across all of
+    the files in turn) that pass 'predicate', if it's given.
+
+    Records before 'start' are skipped without being read.  With a
+    predicate, the metadata is read first, and only the records that
+    pass are read in full (old pickled recordings are loaded twice, in
+    that case).
+    """
+    n = 0
+    for filename in filenames:
+        if stop is not None and n >= stop:
+            return
+
+        reader = RecordReader(open(filename, 'rb'), allow_pickle)
+        try:
+            # skip to the 'start'th record, reading just the frames.
+            offset = None
+            if n < start:
+                for offset in reader.iter_offsets():
+                    if n == start:
+                        break
+                    n += 1
+                else:
+                    continue
+
+            if predicate is None:
+                for (_, record) in reader.iter_entries(offset=offset):
+                    if stop is not None and n >= stop:
+                        return
+                    yield record
+                    n += 1
+                continue
+
+            bodies = RecordReader(open(filename, 'rb'), allow_pickle)
+            try:
+                for (offset, record) in reader.iter_entries(bodies=False,
+                                                            offset=offset):
+                    if stop is not None and n >= stop:
+                        return
+                    if predicate(record):
+                        yield bodies.read_record(offset)
+                    n += 1
+            finally:
+                bodies.fp.close()
+        finally:
+            reader.fp.close()
+
+###
+### merging
+###
+
+def merge(filenames, key=timestamp_key, run_bytes=RUN_BYTES, tmpdir=None,
+          allow_pickle=False):
+    """
+    Yield the records from all of the files, ordered by 'key' (and then
+    by file, and position in the file).
+    """
+    workdir = tempfile.mkdtemp(prefix='scotch-merge-', dir=tmpdir)
+    try:
+        sorted_files = []
+        for filename in filenames:
+            if _is_sorted(filename, key, allow_pickle):
+                sorted_files.append(filename)
+            else:
+                records = concatenate([filename], allow_pickle=allow_pickle)
+                sorted_files.extend(_write_runs(records, key, run_bytes,
+                                                workdir))
+
+        # merge FANIN files at a time, until they can all be merged at
+        # once.
+        while len(sorted_files) > FANIN:
+            merged = _new_run(workdir)
+            _save(_merge_files(sorted_files[:FANIN], key, allow_pickle),
+                  merged)
+            sorted_files[:FANIN] = [merged]
+
+        for record in _merge_files(sorted_files, key, allow_pickle):
+            yield record
+    finally:
+        shutil.rmtree(workdir)
+
+def _is_sorted(filename, key, allow_pickle):
+    last = None
+    for record in concatenate([filename], False, allow_pickle):
+        k = key(record)
+        if last is not None and k < last:
+            return False
+        last = k
+    return True
+
+def _write_runs(records, key, run_bytes, workdir):
+    """
+    Sort the records 'run_bytes' at a time, & write each run to a file;
+    return the filenames.
+    """
+    runs = []
+    run = []
+    size = 0
+    for record in records:
+        run.append(record)
+        size += _size(record)
+        if size >= run_bytes:
+            run.sort(key=key)
+            runs.append(_new_run(workdir))
+            _save(run, runs[-1])
+            run = []
+            size = 0
+
+    if run:
+        run.sort(key=key)
+        runs.append(_new_run(workdir))
+        _save(run, runs[-1])
+    return runs
+
+def _size(record):
+    # (a rough guess at the overhead of the environ & headers.)
+    return 1000 + len(record.inp) + record.response.get_output_length()
+
+def _merge_files(filenames, key, allow_pickle):
+    """
+    Merge the records from files that are each sorted by 'key'.
+    """
+    def decorate(i, filename):
+        records = concatenate([filename], allow_pickle=allow_pickle)
+        for (n, record) in enumerate(records):
+            yield key(record), i, n, record
+
+    streams = [ decorate(i, filename) for (i, filename)
+                in enumerate(filenames) ]
+    for (_, _, _, record) in heapq.merge(*streams):
+        yield record
+
+def _new_run(workdir):
+    (fd, filename) = tempfile.mkstemp(prefix='run-', dir=workdir)
+    os.close(fd)
+    return filename
+
+def _save(records, filename):
+    fp = open(filename, 'wb')
+    try:
+        writer = RecordWriter(fp)
+        for record in records:
+            writer.write(record)
+    finally:
+        fp.close()
+
+###
+### splitting
+###
+
+def by_host(record):
+    """
+    Group records by the host they were sent to.
+    """
+    environ = record.environ
+    host = urlparse.urlparse(environ.get('PATH_INFO', '')).netloc or \
+           environ.get('HTTP_HOST') or environ.get('SERVER_NAME') or \
+           'unknown'
+    return 'host-%s' % (_safe_name.sub('_', host.lower()),)
+
+_safe_name = re.compile(r'[^a-z0-9.-]')
+
+def by_session(gap=1800):
+    """
+    Return a function that groups records into browsing sessions, as
+    scotch.translate does: by client address & user agent, with a new
+    session after 'gap' idle seconds.  The records must be in order.
+    """
+    sessions = Sessions(gap)
+
+    def group(record):
+        environ = record.environ
+        client = (environ.get('REMOTE_ADDR'), environ.get('HTTP_USER_AGENT'))
+        return 'session-%04d' % (sessions.assign(client, timestamp_key(record)),)
+
+    return group
+
+def by_time(interval):
+    """
+    Return a function that groups records into 'interval'-second slices
+    of time.
+    """
+    def group(record):
+        start = int(timestamp_key(record) // interval * interval)
+        return 'time-%d' % (start,)
+
+    return group
+
+def split(records, group, output_dir, max_open=MAX_OPEN):
+    """
+    Write each record to the recording output_dir/NAME.scotch, where NAME
+    is group(record); return a dictionary mapping the filenames to the
+    number of records in each.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    writers = {}                        # filename => RecordWriter
+    used = []                           # filenames, least recently used first
+    counts = {}
+
+    try:
+        for record in records:
+            filename = os.path.join(output_dir, group(record) + '.scotch')
+
+            writer = writers.get(filename)
+            if writer is not None:
+                used.remove(filename)
+            else:
+                if len(writers) >= max_open:
+                    writers.pop(used.pop(0)).fp.close()
+
+                if counts.has_key(filename):
+                    writer = RecordWriter(open(filename, 'ab'), header=False)
+                else:
+                    writer = RecordWriter(open(filename, 'wb'))
+                    counts[filename] = 0
+                writers[filename] = writer
+            used.append(filename)
+
+            writer.write(record)
+            counts[filename] += 1
+    finally:
+        for writer in writers.values():
+            writer.fp.close()
+
+    return counts
@@ -0,0 +1,181 @@
+"""
+An in-process DNS cache for scotch.pool/scotch.proxy.
+
+>> resolver = Resolver(ttl=300, negative_ttl=30)
+>> addresses = resolver.resolve('www.example.com', 80)
+
+'resolve' returns a list of (host, port) socket addresses, one per A
+record, so that the caller can fail over from one to the next.  Lookups
+that fail are cached too (for 'negative_ttl' seconds), so that a page
+full of links to a dead host doesn't hit the system resolver each time.
+
+The system resolver doesn't tell us the real DNS TTL, so entries simply
+live for 'ttl' seconds.  To keep busy hostnames from ever expiring in
+the middle of a page load, start a background refresher:
+
+>> resolver.start_refresh(interval=60)
+
+Every 'interval' seconds this re-resolves hostnames that have been looked
+up at least HOT_HITS times since the last refresh.
+
+Expired entries are dropped whenever the cache grows past MAX_ENTRIES,
+along with the entries closest to expiring if that isn't enough.
+"""
+
+import socket, time, threading
+
+class Resolver:
+    """
+    A thread-safe cache of getaddrinfo results, indexed by (host, port).
+    """
+    TTL=300
+    NEGATIVE_TTL=30
+    HOT_HITS=2
+    MAX_ENTRIES=10000
+
+    def __init__(self, ttl=None, negative_ttl=None):
+        if ttl is None:
+            ttl = self.TTL
+        if negative_ttl is None:
+            negative_ttl = self.NEGATIVE_TTL
+
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self.cache = {}                 # (host, port) -> (expires, result)
+        self.hits = {}                  # (host, port) -> lookups since refresh
+        self.lock = threading.Lock()
+
+        self._refresher = None
+        self._stop_refresh = threading.Event()
+
+    def resolve(self, host, port):
+        """
+        Return a list of socket addresses for host:port, or raise
+        socket.gaierror if it can't be resolved.
+        """
+        key = (host, port)
+        now = time.time()
+
+        self.lock.acquire()
+        try:
+            # (hits only matter to the refresher.)
+            if self._refresher is not None:
+                self.hits[key] = self.hits.get(key, 0) + 1
+            entry = self.cache.get(key)
+        finally:
+            self.lock.release()
+
+        if entry is None or entry[0] < now:
+            entry = self._lookup(key)
+
+        result = entry[1]
+        if isinstance(result, socket.gaierror):
+            raise result
+
+        return result
+
+    def invalidate(self, host, port):
+        """
+        Forget anything cached for host:port.
+        """
+        self.lock.acquire()
+        try:
+            if self.cache.has_key((host, port)):
+                del self.cache[(host, port)]
+        finally:
+            self.lock.release()
+
+    def refresh_hot(self):
+        """
+        Re-resolve the hostnames that are in heavy use.  If a refresh
+        fails, keep using the old addresses until they expire.
+        """
+        self.lock.acquire()
+        try:
+            hot = [ key for (key, n) in self.hits.items()
+                    if n >= self.HOT_HITS ]
+            self.hits = {}
+        finally:
+            self.lock.release()
+
+        for key in hot:
+            self._lookup(key, keep_positive=True)
+
+    def start_refresh(self, interval=60):
+        """
+        Start a daemon thread that calls 'refresh_hot' every 'interval'
+        seconds.
+        """
+        if self._refresher is not None:
+            return
+
+        self._stop_refresh.clear()
+
+        t = threading.Thread(target=self._refresh_loop, args=(interval,))
+        t.setDaemon(True)
+        t.start()
+        self._refresher = t
+
+    def stop_refresh(self):
+        if self._refresher is not None:
+            self._stop_refresh.set()
+            self._refresher.join()
+            self._refresher = None
+            self.hits = {}
+
+    def _refresh_loop(self, interval):
+        while 1:
+            self._stop_refresh.wait(interval)
+            if self._stop_refresh.isSet():
+                break
+            self.refresh_hot()
+
+    def _lookup(self, key, keep_positive=False):
+        """
+        Ask the system resolver about 'key' & cache the answer.
+        """
+        (host, port) = key
+        try:
+            infos = socket.getaddrinfo(host, port, socket.AF_INET,
+                                       socket.SOCK_STREAM)
+            result = []
+            for (_, _, _, _, sockaddr) in infos:
+                if sockaddr not in result:
+                    result.append(sockaddr)
+            entry = (time.time() + self.ttl, result)
+        except socket.gaierror, e:
+            entry = (time.time() + self.negative_ttl, e)
+
+        self.lock.acquire()
+        try:
+            old = self.cache.get(key)
+            if keep_positive and isinstance(entry[1], socket.gaierror) and \
+               old is not None and not isinstance(old[1], socket.gaierror):
+                return old
+
+            self.cache[key] = entry
+            if len(self.cache) > self.MAX_ENTRIES:
+                self._prune(time.time())
+        finally:
+            self.lock.release()
+
+        return entry
+
+    def _prune(self, now):
+        """
+        Drop expired entries, and then the ones closest to expiring, until
+        the cache is down to 3/4 of MAX_ENTRIES.  Call with the lock held.
+        """
+        cache = self.cache
+        for (key, (expires, _)) in cache.items():
+            if expires < now:
+                del cache[key]
+
+        keep = self.MAX_ENTRIES * 3 // 4
+        if len(cache) > keep:
+            entries = [ (expires, key) for (key, (expires, _))
+                        in cache.items() ]
+            entries.sort()
+            for (_, key) in entries[:len(cache) - keep]:
+                del cache[key]
@@ -0,0 +1,417 @@
+"""
+Reverse proxying: mount external Web sites under local path prefixes.
+
+>> app = ReverseProxyApp({ '/google' : 'http://www.google.com',
+..                         '/docs' : 'http://docs.example.com/v2' })
+
+Requests for /google/search?q=scotch are passed on (through a ProxyApp)
+to http://www.google.com/search?q=scotch, and the responses are rewritten
+so that links back into the site stay under /google:
+
+ * Location & Content-Location headers are mapped back to local URLs;
+ * Set-Cookie headers lose their Domain, and their Path is moved under
+   the prefix;
+ * links in HTML (href, src, action, ...; style attributes & <style>
+   elements) and in CSS (url(...) and @import) are rewritten.
+
+Absolute links to any of the mounted origins are rewritten to point at
+their prefix, as are root-relative links ('/about').  Relative links
+work as they are, and links to other sites are left alone.
+
+HTML and CSS are rewritten as they stream through, a block at a time, by
+HTMLRewriter and CSSRewriter; rewritten responses lose their
+Content-Length, since their length changes.
+"""
+
+import re, urlparse
+
+from scotch.proxy import ProxyApp
+
+class ReverseProxyApp:
+    """
+    WSGI application mapping path prefixes onto upstream origins.
+    """
+    def __init__(self, mounts, proxy_app=None, verbosity=0):
+        self.mounts = []
+        for (prefix, origin) in mounts.items():
+            (scheme, netloc, path, _, _, _) = urlparse.urlparse(origin)
+            if scheme != 'http' or not netloc:
+                raise ValueError("can only mount http:// origins, not %r"
+                                 % (origin,))
+
+            prefix = '/' + prefix.strip('/')
+            self.mounts.append((prefix, scheme, netloc, path.rstrip('/')))
+
+        # try longer prefixes first.
+        self.mounts.sort(key=lambda m: len(m[0]), reverse=True)
+
+        if proxy_app is None:
+            proxy_app = ProxyApp(verbosity=verbosity)
+        self.proxy_app = proxy_app
+
+    def __call__(self, environ, start_response):
+        path_info = environ.get('PATH_INFO', '') or '/'
+
+        for mount in self.mounts:
+            prefix = mount[0]
+            if path_info == prefix or path_info.startswith(prefix + '/') \
+               or prefix == '/':
+                break
+        else:
+            start_response('404 Not Found', [('Content-type', 'text/plain')])
+            return ['nothing is mounted at %s\n' % (path_info,)]
+
+        (prefix, scheme, netloc, origin_path) = mount
+        rest = path_info[len(prefix.rstrip('/')):] or '/'
+
+        script_name = environ.get('SCRIPT_NAME', '').rstrip('/')
+        rewriter = URLRewriter(self.mounts, script_name, mount)
+
+        new_environ = dict(environ)
+        new_environ['SCRIPT_NAME'] = ''
+        new_environ['PATH_INFO'] = '%s://%s%s%s' % (scheme, netloc,
+                                                   origin_path, rest)
+        new_environ['HTTP_HOST'] = netloc
+
+        # we can't rewrite compressed bodies.
+        if new_environ.has_key('HTTP_ACCEPT_ENCODING'):
+            del new_environ['HTTP_ACCEPT_ENCODING']
+
+        body_rewriter = []
+
+        def my_start_response(status, headers):
+            (headers, content_rewriter) = _rewrite_headers(headers, rewriter)
+            if content_rewriter is not None:
+                body_rewriter.append(content_rewriter)
+            return start_response(status, headers)
+
+        blocks = self.proxy_app(new_environ, my_start_response)
+        if not body_rewriter:
+            return blocks
+
+        return _iter_rewritten(blocks, body_rewriter[0])
+
+class URLRewriter:
+    """
+    Map URLs on the mounted origins to local URLs, from the point of view
+    of a page fetched through 'mount'.
+    """
+    def __init__(self, mounts, script_name, mount):
+        self.script_name = script_name
+        self.mount = mount
+
+        self.origins = {}
+        for (prefix, scheme, netloc, origin_path) in mounts:
+            self.origins.setdefault(netloc.lower(), []).append((origin_path,
+                                                                prefix))
+
+    def local_prefix(self, prefix):
+        return (self.script_name + prefix).rstrip('/')
+
+    def __call__(self, url):
+        stripped = url.strip()
+
+        if stripped.startswith('//'):
+            (scheme, rest) = ('http', stripped[2:])
+        elif stripped.lower().startswith('http://'):
+            (scheme, rest) = ('http', stripped[7:])
+        elif stripped.startswith('/'):
+            (_, _, _, origin_path) = self.mount
+            if origin_path and (stripped == origin_path or
+                                stripped.startswith(origin_path + '/')):
+                stripped = stripped[len(origin_path):] or '/'
+            elif origin_path:
+                return url              # outside the mounted part of the site
+            return self.local_prefix(self.mount[0]) + stripped
+        else:
+            return url
+
+        i = rest.find('/')
+        if i < 0:
+            (netloc, path) = (rest, '/')
+        else:
+            (netloc, path) = (rest[:i], rest[i:])
+
+        for (origin_path, prefix) in self.origins.get(netloc.lower(), []):
+            if not origin_path or path == origin_path or \
+               path.startswith(origin_path + '/'):
+                return self.local_prefix(prefix) + \
+                       (path[len(origin_path):] or '/')
+
+        return url
+
+class CSSRewriter:
+    """
+    Rewrite url(...) and @import links in a stream of CSS.
+    """
+    MAX_TOKEN=8192
+
+    _url_re = re.compile(r'''(url\(\s*)(["']?)([^"')]*)(\2\s*\))''', re.I)
+    _import_re = re.compile(r'''(@import\s+)(["'])([^"']*)(\2)''', re.I)
+
+    def __init__(self, rewrite_url):
+        self.rewrite_url = rewrite_url
+        self.buf = ''
+
+    def feed(self, data):
+        """
+        Rewrite as much of the CSS as possible, holding back anything
+        that might be the start of an incomplete link.
+        """
+        data = self.buf + data
+
+        # a link can't span a ')', '}' or newline, so everything up to the
+        # last of those is safe to rewrite.
+        i = max(data.rfind(')'), data.rfind('}'), data.rfind('\n'))
+        if i < 0 and len(data) <= self.MAX_TOKEN:
+            self.buf = data
+            return ''
+
+        if i < 0:
+            i = len(data) - 1
+
+        self.buf = data[i+1:]
+        return self.rewrite(data[:i+1])
+
+    def close(self):
+        data, self.buf = self.buf, ''
+        return self.rewrite(data)
+
+    def rewrite(self, css):
+        def sub(m):
+            return m.group(1) + m.group(2) + self.rewrite_url(m.group(3)) + \
+                   m.group(4)
+
+        css = self._url_re.sub(sub, css)
+        return self._import_re.sub(sub, css)
+
+class HTMLRewriter:
+    """
+    Rewrite links in a stream of HTML.
+
+    The stream is split into text, tags, comments and <script>/<style>
+    contents as it arrives; only tags (and style sheets) are rewritten,
+    and only an incomplete tag at the end of a block is held back.
+    """
+    MAX_TAG=65536
+
+    LINK_ATTRIBUTES = ('href', 'src', 'action', 'background', 'cite',
+                       'longdesc', 'usemap', 'codebase', 'data', 'poster',
+                       'formaction')
+
+    _attr_re = re.compile(r'''(\s)([-\w:]+)(\s*=\s*)("[^"]*"|'[^']*'|[^\s"'>]+)''')
+    _tag_name_re = re.compile(r'<(/?)([a-zA-Z][-\w:]*)')
+
+    def __init__(self, rewrite_url):
+        self.rewrite_url = rewrite_url
+        self.buf = ''
+
+        # inside a comment, <script> or <style>: the string that ends it,
+        # and whether to rewrite its contents as CSS.
+        self.end_marker = None
+        self.css = None
+
+    def feed(self, data):
+        buf = self.buf + data
+        pos = 0
+        n = len(buf)
+        out = []
+
+        while pos < n:
+            if self.end_marker is not None:
+                (pos, done) = self._raw_text(buf, pos, out)
+                if not done:
+                    break
+                continue
+
+            i = buf.find('<', pos)
+            if i < 0:
+                out.append(buf[pos:])
+                pos = n
+                break
+            if i > pos:
+                out.append(buf[pos:i])
+                pos = i
+
+            if buf.startswith('<!--', pos):
+                out.append('<!--')
+                pos += 4
+                self.end_marker = '-->'
+                continue
+            elif n - pos < 4 and '<!--'.startswith(buf[pos:]):
+                break                   # might be the start of a comment.
+
+            j = _find_tag_end(buf, pos)
+            if j < 0:
+                if n - pos > self.MAX_TAG:
+                    # not a tag that we can handle; pass it on.
+                    out.append(buf[pos:])
+                    pos = n
+                break
+
+            out.append(self._rewrite_tag(buf[pos:j+1]))
+            pos = j + 1
+
+        self.buf = buf[pos:]
+        return "".join(out)
+
+    def close(self):
+        out, self.buf = self.buf, ''
+        if self.css is not None:
+            out = self.css.feed(out) + self.css.close()
+            self.css = None
+        return out
+
+    def _raw_text(self, buf, pos, out):
+        """
+        Pass on the contents of a comment, <script> or <style>, up to the
+        end marker.  Return the position after them, and whether the
+        marker was found; if it wasn't, hold back just enough text to
+        recognize it in the next block.
+        """
+        marker = self.end_marker
+        i = buf.lower().find(marker, pos)
+
+        if i < 0:
+            keep = max(pos, len(buf) - len(marker) + 1)
+            text = buf[pos:keep]
+            if self.css is not None:
+                text = self.css.feed(text)
+            out.append(text)
+
+            return keep, False
+
+        text = buf[pos:i]
+        if self.css is not None:
+            text = self.css.feed(text) + self.css.close()
+            self.css = None
+        out.append(text)
+
+        if marker == '-->':
+            out.append(marker)
+            i += len(marker)
+
+        self.end_marker = None
+        return i, True
+
+    def _rewrite_tag(self, tag):
+        m = self._tag_name_re.match(tag)
+        if not m:
+            return tag                  # <!DOCTYPE ...>, <?xml ...?>, etc.
+
+        (closing, name) = (m.group(1), m.group(2).lower())
+        if not closing and name in ('script', 'style'):
+            self.end_marker = '</' + name
+            if name == 'style':
+                self.css = CSSRewriter(self.rewrite_url)
+
+        if closing:
+            return tag
+
+        def sub(m):
+            attr = m.group(2).lower()
+            value = m.group(4)
+
+            quote = ''
+            if value[0] in '"\'':
+                (quote, value) = (value[0], value[1:-1])
+
+            if attr in self.LINK_ATTRIBUTES:
+                value = self.rewrite_url(value)
+            elif attr == 'style':
+                value = CSSRewriter(self.rewrite_url).rewrite(value)
+            else:
+                return m.group(0)
+
+            return m.group(1) + m.group(2) + m.group(3) + quote + value + quote
+
+        return self._attr_re.sub(sub, tag)
+
+###
+
+def _find_tag_end(s, start):
+    """
+    Find the '>' that ends the tag starting at s[start], skipping over
+    quoted attribute values; -1 if the tag isn't complete.
+    """
+    quote = None
+    i = start + 1
+    n = len(s)
+    while i < n:
+        c = s[i]
+        if quote is not None:
+            i = s.find(quote, i)
+            if i < 0:
+                return -1
+            quote = None
+        elif c == '>':
+            return i
+        elif c in '"\'' and s[i-1] in '= \t\r\n':
+            quote = c
+        i += 1
+
+    return -1
+
+def _rewrite_headers(headers, rewrite_url):
+    """
+    Rewrite Location, Content-Location and Set-Cookie headers; return
+    the new headers and a rewriter for the body (or None).
+    """
+    content_type = ''
+    for (k, v) in headers:
+        if k.lower() == 'content-type':
+            content_type = v.split(';')[0].strip().lower()
+
+    content_rewriter = None
+    if content_type in ('text/html', 'application/xhtml+xml'):
+        content_rewriter = HTMLRewriter(rewrite_url)
+    elif content_type == 'text/css':
+        content_rewriter = CSSRewriter(rewrite_url)
+
+    new_headers = []
+    for (k, v) in headers:
+        name = k.lower()
+        if name in ('location', 'content-location'):
+            v = rewrite_url(v)
+        elif name == 'set-cookie':
+            v = _rewrite_cookie(v, rewrite_url)
+        elif name == 'content-length' and content_rewriter is not None:
+            continue
+        new_headers.append((k, v))
+
+    return new_headers, content_rewriter
+
+def _rewrite_cookie(cookie, rewrite_url):
+    """
+    Drop a cookie's Domain, and move its Path under the mount prefix.
+    """
+    parts = [ p.strip() for p in cookie.split(';') ]
+
+    new_parts = parts[:1]
+    for p in parts[1:]:
+        name = p.split('=', 1)[0].strip().lower()
+        if name == 'domain':
+            continue
+        if name == 'path':
+            path = rewrite_url(p.split('=', 1)[1].strip() or '/')
+            p = 'Path=' + (path.rstrip('/') or '/')
+        new_parts.append(p)
+
+    return '; '.join(new_parts)
+
+def _iter_rewritten(blocks, rewriter):
+    """
+    Feed the body through 'rewriter' a block at a time.
+    """
+    try:
+        for data in blocks:
+            data = rewriter.feed(data)
+            if data:
+                yield data
+
+        data = rewriter.close()
+        if data:
+            yield data
+    finally:
+        if hasattr(blocks, 'close'):
+            blocks.close()
@@ -0,0 +1,184 @@
+"""
+Limit how many upstream requests the proxy has going at once, per host
+and in total, and share the capacity out fairly between clients.
+
+>> scheduler = Scheduler(max_per_host=8, max_total=64, queue_timeout=5)
+>> slot = scheduler.acquire('www.example.com', 80, session='10.0.0.7')
+>> try:
+..     ... talk to www.example.com ...
+.. finally:
+..     scheduler.release(slot)
+
+When a host (or the proxy as a whole) is at its limit, requests wait in
+a queue per client session, and freed-up slots go round-robin to the
+sessions that are waiting, so that one client hammering a slow server
+doesn't hold up everyone else's requests -- or the other servers.
+
+A request that has waited 'queue_timeout' seconds gives up with a
+QueueTimeout, and once 'max_queue' requests are waiting, new ones are
+turned away with a QueueFull straight away; ProxyApp answers both with
+a '503 Service Unavailable'.
+"""
+
+import threading
+
+class Overloaded(Exception):
+    """
+    The request can't be scheduled; see QueueFull & QueueTimeout.
+    """
+    pass
+
+class QueueFull(Overloaded):
+    pass
+
+class QueueTimeout(Overloaded):
+    pass
+
+class _Waiter:
+    def __init__(self, key, session):
+        self.key = key
+        self.session = session
+        self.event = threading.Event()
+        self.granted = False
+
+class Scheduler:
+    """
+    Hand out upstream request slots, within per-host & total limits.
+    """
+    MAX_PER_HOST=8
+    MAX_TOTAL=64
+    MAX_QUEUE=256
+    QUEUE_TIMEOUT=5
+
+    def __init__(self, max_per_host=None, max_total=None, max_queue=None,
+                 queue_timeout=None):
+        if max_per_host is None:
+            max_per_host = self.MAX_PER_HOST
+        if max_total is None:
+            max_total = self.MAX_TOTAL
+        if max_queue is None:
+            max_queue = self.MAX_QUEUE
+        if queue_timeout is None:
+            queue_timeout = self.QUEUE_TIMEOUT
+
+        self.max_per_host = max_per_host
+        self.max_total = max_total
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self.active = {}                # (host, port) -> slots in use
+        self.n_active = 0
+
+        self.queues = {}                # session -> [ waiter, waiter, ... ]
+        self.sessions = []              # sessions with waiters, in turn order
+        self.n_waiting = 0
+
+        self.lock = threading.Lock()
+
+    def acquire(self, host, port, session=None, timeout=None):
+        """
+        Wait for a slot for a request to host:port, on behalf of the
+        client 'session'; return the slot, to be passed to release().
+
+        Raise QueueFull or QueueTimeout if the request can't be scheduled.
+        """
+        if timeout is None:
+            timeout = self.queue_timeout
+
+        key = (host, port)
+        waiter = _Waiter(key, session)
+
+        self.lock.acquire()
+        try:
+            if not self.n_waiting and self._has_room(key):
+                self._grant(waiter)
+                return key
+
+            if self.n_waiting >= self.max_queue:
+                raise QueueFull("too many requests waiting")
+
+            self.queues.setdefault(session, []).append(waiter)
+            if len(self.queues[session]) == 1:
+                self.sessions.append(session)
+            self.n_waiting += 1
+
+            self._dispatch()
+        finally:
+            self.lock.release()
+
+        waiter.event.wait(timeout)
+
+        self.lock.acquire()
+        try:
+            if not waiter.granted:
+                self._remove(waiter)
+                raise QueueTimeout("waited %ss for %s:%s" %
+                                   (timeout, host, port))
+        finally:
+            self.lock.release()
+
+        return key
+
+    def release(self, slot):
+        """
+        Give back a slot from acquire(), and pass it on to a waiting
+        request if there is one.
+        """
+        self.lock.acquire()
+        try:
+            n = self.active[slot] - 1
+            if n:
+                self.active[slot] = n
+            else:
+                del self.active[slot]
+            self.n_active -= 1
+
+            self._dispatch()
+        finally:
+            self.lock.release()
+
+    def _has_room(self, key):
+        return self.n_active < self.max_total and \
+               self.active.get(key, 0) < self.max_per_host
+
+    def _grant(self, waiter):
+        self.active[waiter.key] = self.active.get(waiter.key, 0) + 1
+        self.n_active += 1
+
+        waiter.granted = True
+        waiter.event.set()
+
+    def _dispatch(self):
+        """
+        Hand out free slots to waiting requests, taking the sessions in
+        turn; within a session, requests go in order, except that one
+        that's waiting on a busy host doesn't hold up the rest.  Call
+        with the lock held.
+        """
+        while self.n_active < self.max_total:
+            for session in self.sessions:
+                for waiter in self.queues[session]:
+                    if self._has_room(waiter.key):
+                        break
+                else:
+                    continue
+
+                self._remove(waiter)
+                self._grant(waiter)
+
+                # this session goes to the back of the line.
+                if self.queues.has_key(session):
+                    self.sessions.remove(session)
+                    self.sessions.append(session)
+                break
+            else:
+                return                  # nobody can go yet.
+
+    def _remove(self, waiter):
+        queue = self.queues[waiter.session]
+        queue.remove(waiter)
+        self.n_waiting -= 1
+
+        if not queue:
+            del self.queues[waiter.session]
+            self.sessions.remove(waiter.session)
@@ -0,0 +1,178 @@
+"""
+Serving modes for the proxy & recording proxy scripts.
+
+wsgiref's WSGIServer handles one request at a time.  This module adds
+
+ * make_server(address, app, threads=N) -- a WSGIServer that hands
+   requests off to a fixed pool of N worker threads;
+
+ * run_workers(N, serve, finish) -- fork N worker processes that all
+   serve requests from the same (already bound) listening socket.
+
+For example,
+
+>> httpd = make_server(('', 8000), app, threads=10)
+>> run_workers(4, lambda n: serve_until_interrupted(httpd))
+
+runs 4 processes with 10 threads apiece.  Apps served with threads must
+be thread-safe (ProxyApp and Recorder are); apps served by forked workers
+don't share any state after the fork, so e.g. each worker has to save its
+own recording -- see merge_segments.
+"""
+
+import os, sys, signal, errno, threading, traceback, Queue
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+class ThreadPoolMixIn:
+    """
+    Handle each request in one of a fixed pool of threads.
+
+    The threads are started when the first request comes in, so that a
+    server built before a fork() gets its threads in the child.
+    """
+    n_threads = 10
+    daemon_threads = True
+
+    _threads_pid = None
+
+    def start_threads(self):
+        self.requests = Queue.Queue()
+
+        for i in range(self.n_threads):
+            t = threading.Thread(target=self._worker)
+            t.setDaemon(self.daemon_threads)
+            t.start()
+
+        self._threads_pid = os.getpid()
+
+    def process_request(self, request, client_address):
+        if self._threads_pid != os.getpid():
+            self.start_threads()
+        self.requests.put((request, client_address))
+
+    def _worker(self):
+        while 1:
+            (request, client_address) = self.requests.get()
+            try:
+                try:
+                    self.finish_request(request, client_address)
+                except:
+                    self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+class ThreadPoolWSGIServer(ThreadPoolMixIn, WSGIServer):
+    pass
+
+def make_server(address, app, handler_class=WSGIRequestHandler, threads=0):
+    """
+    Build a WSGI server for 'app'; if 'threads' is given, serve requests
+    from that many threads.
+    """
+    if threads:
+        httpd = ThreadPoolWSGIServer(address, handler_class)
+        httpd.n_threads = threads
+    else:
+        httpd = WSGIServer(address, handler_class)
+
+    httpd.set_app(app)
+    return httpd
+
+def serve_until_interrupted(httpd):
+    """
+    Handle requests until a KeyboardInterrupt (or SIGTERM, in a worker).
+    """
+    try:
+        while 1:
+            httpd.handle_request()
+    except KeyboardInterrupt:
+        pass
+
+def run_workers(n_workers, serve, finish=None):
+    """
+    Fork 'n_workers' processes; in each, call serve(n) and then, once
+    serve(n) has returned or been interrupted, finish(n).
+
+    The parent waits for all of the workers to exit.  An interrupt in the
+    parent is passed on to the workers as SIGTERM; they don't see any
+    further signals while they run finish(n).
+    """
+    pids = []
+    for n in range(n_workers):
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(n, serve, finish)           # never returns.
+        pids.append(pid)
+
+    def terminate(*args):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    old_handler = signal.signal(signal.SIGTERM, terminate)
+    try:
+        while pids:
+            try:
+                (pid, _) = os.waitpid(-1, 0)
+                if pid in pids:
+                    pids.remove(pid)
+            except KeyboardInterrupt:
+                terminate()
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    break
+                if e.errno != errno.EINTR:
+                    raise
+    finally:
+        signal.signal(signal.SIGTERM, old_handler)
+
+def _run_worker(n, serve, finish):
+    def interrupt(*args):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, interrupt)
+
+    status = 0
+    try:
+        try:
+            serve(n)
+        except KeyboardInterrupt:
+            pass
+
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+        if finish is not None:
+            finish(n)
+    except:
+        traceback.print_exc()
+        status = 1
+
+    sys.stdout.flush()
+    os._exit(status)
+
+def segment_filename(filename, n):
+    """
+    The name of worker n's recording segment.
+    """
+    return '%s.%d' % (filename, n)
+
+def merge_segments(filenames, fp):
+    """
+    Merge the records in the given recording segments into one recording,
+    written to 'fp', in timestamp order; return the number of records.
+
+    The segments are streamed through scotch.recordings.merge, so they
+    needn't fit into memory.
+    """
+    from scotch.recordings import merge
+    from scotch.storage import RecordWriter
+
+    writer = RecordWriter(fp)
+    n = 0
+    for record in merge(filenames):
+        writer.write(record)
+        n += 1
+
+    return n
@@ -0,0 +1,575 @@
+"""
+Save & load recordings as a stream of records, so that tools can read
+them one record at a time.
+
+>> fp = open('recording.scotch', 'wb')
+>> save_records(recorder.record_holder, fp)
+
+>> reader = RecordReader(open('recording.scotch', 'rb'))
+>> for record in reader:
+..    utils.display_record(record)
+
+>> record_holder = load_records(open('recording.scotch', 'rb'))
+
+A recording is a short header followed by one frame per record.  Each
+frame holds the record minus its response body, and then the body itself,
+raw; both are length-prefixed, so a reader can skip over records, or just
+their bodies, without decoding them:
+
+>> for record in reader.iter_records(start=1000, bodies=False):
+..    print record.response.get_output_length()
+
+Records read without their bodies have a 'content_list' of None.  A
+RecordIndex remembers where each record starts, for random access.
+
+In version 2 recordings, the record is encoded without pickle, so
+loading a recording can't run arbitrary code, and doesn't depend on how
+the classes are laid out.  It's a fixed header (the timestamp, and the
+counts & lengths of what follows) and then:
+
+  - the environ's string keys & values, the header names & values, and
+    the status, joined with NULs -- or, if any of them has a NUL in it,
+    run together after a table of their lengths;
+  - any environ items that aren't strings, each tagged with its type
+    (strings, unicode, numbers, booleans, None, tuples & lists of them),
+    and a CONNECT tunnel's metadata as 'scotch.tunnel.*' items, which
+    are made back into a scotch.tunnel.Tunnel; any other kind of value
+    (e.g. an object put there by middleware) is saved as its repr(),
+    with a RuntimeWarning;
+  - the error output and the input, raw.
+
+So most of a record comes out of a single split, and the typed items,
+which rarely change from one record to the next, are decoded once.
+
+Version 1 recordings (with pickled frames) and old recordings -- a single
+pickled RecordHolder -- can still be read, although old recordings have
+to be loaded all at once.  Unpickling can run arbitrary code, so they're
+only read given allow_pickle=True (or the tools' --allow-pickle): only
+do that for recordings from people you trust.
+"""
+
+import copy, struct, gc, warnings
+from array import array
+from cPickle import dumps, loads, load
+
+from scotch.recorder import Record, Response, RecordHolder
+
+MAGIC = 'SCOTCH-RECORDS\n'
+VERSION = 2
+
+_header = struct.Struct('>H')
+_frame = struct.Struct('>II')           # record length, body length
+
+# timestamp, flags, # of string environ items, # of headers, & the
+# lengths of the strings, typed items, error output & input.
+_meta = struct.Struct('>dBHHIIII')
+_META_SIZE = _meta.size
+_JOINED = 0x01                          # the strings are joined by NULs.
+
+_length = struct.Struct('>I')
+_double = struct.Struct('>d')
+
+# skip bodies smaller than this by reading them; a seek throws away the
+# file's read buffer.
+_SEEK_THRESHOLD = 65536
+
+class FormatError(Exception):
+    pass
+
+class RecordWriter:
+    """
+    Write records to a file, one frame at a time; version=1 writes a
+    recording that older versions of scotch can read.  With header=False,
+    append to a recording of the same version.
+    """
+    def __init__(self, fp, version=VERSION, header=True):
+        if version not in (1, 2):
+            raise ValueError("can't write version %d" % (version,))
+
+        self.fp = fp
+        self.version = version
+        self.n_records = 0
+        if header:
+            fp.write(MAGIC + _header.pack(version))
+
+    def write(self, record):
+        if record.response.content_list is None and \
+           record.response.get_output_length():
+            raise ValueError("can't save a record read without its body")
+
+        if self.version == 1:
+            response = copy.copy(record.response)
+            response.content_list = None
+
+            stored = copy.copy(record)
+            stored.response = response
+
+            data = dumps(stored, 2)
+        else:
+            data = encode_record(record)
+
+        body = "".join(record.response.content_list or [])
+
+        self.fp.write(_frame.pack(len(data), len(body)))
+        self.fp.write(data)
+        self.fp.write(body)
+        self.n_records += 1
+
+def save_records(records, fp):
+    """
+    Write the given records (e.g. a RecordHolder) to 'fp'.
+    """
+    writer = RecordWriter(fp)
+    for record in records:
+        writer.write(record)
+
+class RecordReader:
+    """
+    Read records from a file written by RecordWriter, or, with
+    allow_pickle=True, from a version 1 recording or an old pickled
+    RecordHolder.
+    """
+    def __init__(self, fp, allow_pickle=False):
+        self.fp = fp
+        self.legacy = None
+
+        magic = fp.read(len(MAGIC))
+        if magic != MAGIC:
+            # an old pickle; there's nothing to do but load it.
+            if not allow_pickle:
+                raise FormatError("not a scotch recording, or an old "
+                                  "pickled one (see allow_pickle)")
+            fp.seek(0)
+            self.legacy = load(fp)
+            self.version = 0
+            return
+
+        header = fp.read(_header.size)
+        if len(header) != _header.size:
+            raise FormatError("truncated header")
+
+        (self.version,) = _header.unpack(header)
+        if self.version > VERSION:
+            raise FormatError("unsupported version %d" % (self.version,))
+
+        self._decode = decode_record
+        if self.version < 2:
+            if not allow_pickle:
+                raise FormatError("version %d recordings are pickled "
+                                  "(see allow_pickle)" % (self.version,))
+            self._decode = loads
+
+        self.offset = fp.tell()
+
+    def __iter__(self):
+        return self.iter_records()
+
+    def iter_records(self, start=0, bodies=True):
+        """
+        Yield records, starting with the 'start'th (counting from 0).  If
+        'bodies' is False, the response bodies aren't read.
+
+        Each call reads the file from the beginning, so don't interleave
+        them (or calls to read_record).
+        """
+        for (offset, record) in self.iter_entries(start, bodies):
+            yield record
+
+    def iter_entries(self, start=0, bodies=True, offset=None):
+        """
+        Like iter_records, but yield (offset, record); read_record(offset)
+        reads the record again.  If 'offset' is given, start reading
+        there, and count 'start' from there.
+        """
+        if self.legacy is not None:
+            for i in xrange((offset or 0) + start, len(self.legacy)):
+                yield i, self.legacy[i]
+            return
+
+        if offset is None:
+            offset = self.offset
+
+        fp = self.fp
+        fp.seek(offset)
+
+        # (this is _read_frame, unrolled; it's the inner loop of every
+        # tool that reads a whole recording.)
+        (read, decode, unpack, size) = (fp.read, self._decode,
+                                        _frame.unpack, _frame.size)
+        i = 0
+        while 1:
+            header = read(size)
+            if not header:
+                return
+            if len(header) != size:
+                raise FormatError("truncated record %d" % (i,))
+
+            (n_data, n_body) = unpack(header)
+
+            if i >= start:
+                data = read(n_data)
+                if len(data) != n_data:
+                    raise FormatError("truncated record %d" % (i,))
+                record = decode(data)
+
+                response = record.response
+                response.output_length = n_body
+                if bodies:
+                    body = read(n_body)
+                    if len(body) != n_body:
+                        raise FormatError("truncated record %d" % (i,))
+                    response.content_list = [body]
+                elif n_body >= _SEEK_THRESHOLD:
+                    fp.seek(n_body, 1)
+                elif n_body:
+                    read(n_body)
+
+                yield offset, record
+            else:
+                _skip(fp, n_data + n_body)
+
+            offset += size + n_data + n_body
+            i += 1
+
+    def iter_offsets(self):
+        """
+        Yield the offset of each record, without reading the records.
+        """
+        if self.legacy is not None:
+            for i in xrange(len(self.legacy)):
+                yield i
+            return
+
+        fp = self.fp
+        fp.seek(self.offset)
+        offset = self.offset
+        while 1:
+            header = fp.read(_frame.size)
+            if not header:
+                return
+            if len(header) != _frame.size:
+                raise FormatError("truncated record at offset %d" % (offset,))
+
+            (n_data, n_body) = _frame.unpack(header)
+            _skip(fp, n_data + n_body)
+
+            yield offset
+            offset += _frame.size + n_data + n_body
+
+    def read_record(self, offset, bodies=True):
+        """
+        Read the record at 'offset', from iter_entries.
+        """
+        if self.legacy is not None:
+            return self.legacy[offset]
+
+        self.fp.seek(offset)
+        header = self.fp.read(_frame.size)
+        if len(header) != _frame.size:
+            raise FormatError("no record at offset %d" % (offset,))
+
+        (n_data, n_body) = _frame.unpack(header)
+        return self._read_frame(n_data, n_body, bodies)
+
+    def _read_frame(self, n_data, n_body, bodies):
+        fp = self.fp
+
+        data = fp.read(n_data)
+        if len(data) != n_data:
+            raise FormatError("truncated record")
+        record = self._decode(data)
+
+        response = record.response
+        response.output_length = n_body
+        if bodies:
+            body = fp.read(n_body)
+            if len(body) != n_body:
+                raise FormatError("truncated record")
+            response.content_list = [body]
+        else:
+            _skip(fp, n_body)
+
+        return record
+
+###
+### the version 2 record encoding
+###
+
+def encode_record(record):
+    """
+    Encode a record, minus its response body.
+    """
+    response = record.response
+
+    keys = []
+    values = []
+    typed = []
+    for (k, v) in record.environ.iteritems():
+        if type(k) is str and type(v) is str:
+            keys.append(k)
+            values.append(v)
+        elif k == _TUNNEL and v is not None:
+            for field in _TUNNEL_FIELDS:
+                typed.append(_encode_value('%s.%s' % (_TUNNEL, field)) +
+                             _encode_value(getattr(v, field)))
+        else:
+            try:
+                typed.append(_encode_value(k) + _encode_value(v))
+            except ValueError, e:
+                warnings.warn("saving environ[%r] as its repr: %s" % (k, e),
+                              RuntimeWarning)
+                if type(k) is not str and type(k) is not unicode:
+                    k = repr(k)
+                typed.append(_encode_value(k) + _encode_value(repr(v)))
+
+    headers = response.headers or []
+    strings = keys + values + [ str(k) for (k, v) in headers ] + \
+              [ str(v) for (k, v) in headers ] + [ response.status or '' ]
+
+    joined = '\0'.join(strings)
+    if joined.count('\0') == len(strings) - 1:
+        (flags, table) = (_JOINED, '')
+    else:
+        flags = 0
+        table = struct.pack('>%dI' % (len(strings),),
+                            *[ len(s) for s in strings ])
+        joined = ''.join(strings)
+
+    typed = ''.join(typed)
+    errout = response.errout or ''
+    inp = record.inp
+
+    head = _meta.pack(getattr(record, 'timestamp', 0) or 0, flags,
+                      len(keys), len(headers), len(table) + len(joined),
+                      len(typed), len(errout), len(inp))
+    return ''.join((head, table, joined, typed, errout, inp))
+
+def decode_record(data):
+    """
+    Decode a record encoded by encode_record; it has no response body.
+    """
+    try:
+        (timestamp, flags, n_environ, n_headers, n_strings, n_typed, n_errout,
+         n_inp) = _meta.unpack_from(data)
+    except struct.error:
+        raise FormatError("truncated record")
+
+    end = _META_SIZE + n_strings
+    if len(data) != end + n_typed + n_errout + n_inp:
+        raise FormatError("bad record length")
+
+    if flags == _JOINED and end == len(data):
+        # the usual case: just strings.
+        strings = data[_META_SIZE:].split('\0')
+        (typed, errout, inp) = ('', '', '')
+    else:
+        if flags & _JOINED:
+            strings = data[_META_SIZE:end].split('\0')
+        else:
+            strings = _split_strings(data, _META_SIZE, end,
+                                     2 * n_environ + 2 * n_headers + 1)
+
+        typed = data[end:end + n_typed]
+        end += n_typed
+        errout = data[end:end + n_errout]
+        inp = data[end + n_errout:]
+
+    if len(strings) != 2 * n_environ + 2 * n_headers + 1:
+        raise FormatError("bad record")
+
+    environ = dict(zip(strings[:n_environ],
+                       strings[n_environ:2 * n_environ]))
+    if typed:
+        environ.update(_decode_typed(typed))
+        if environ.has_key(_TUNNEL + '.host'):
+            environ[_TUNNEL] = _decode_tunnel(environ)
+
+    h = 2 * n_environ + n_headers
+    response = Response()
+    response.status = strings[-1]
+    response.headers = zip(strings[2 * n_environ:h], strings[h:-1])
+    response.errout = errout
+
+    return Record(environ, inp, response, timestamp)
+
+def _split_strings(data, start, end, n):
+    if start + 4 * n > end:
+        raise FormatError("bad record")
+    lengths = struct.unpack_from('>%dI' % (n,), data, start)
+
+    strings = []
+    i = start + 4 * n
+    for length in lengths:
+        strings.append(data[i:i + length])
+        i += length
+
+    if i != end:
+        raise FormatError("bad record")
+    return strings
+
+def _encode_value(value):
+    t = type(value)
+    if t is str:
+        return 's' + _length.pack(len(value)) + value
+    elif t is unicode:
+        value = value.encode('utf-8')
+        return 'u' + _length.pack(len(value)) + value
+    elif t is bool:
+        return value and 'T' or 'F'
+    elif value is None:
+        return 'N'
+    elif t is int or t is long:
+        value = str(value)
+        return 'i' + chr(len(value)) + value
+    elif t is float:
+        return 'f' + _double.pack(value)
+    elif t is tuple or t is list:
+        return (t is tuple and 't' or 'l') + _length.pack(len(value)) + \
+               ''.join([ _encode_value(v) for v in value ])
+
+    raise ValueError("can't encode a %s" % (t.__name__,))
+
+def _decode_value(data, i):
+    """
+    Decode the value at data[i]; return it & the index after it.
+    """
+    tag = data[i]
+    i += 1
+
+    if tag == 's' or tag == 'u':
+        (n,) = _length.unpack_from(data, i)
+        value = data[i + 4:i + 4 + n]
+        if tag == 'u':
+            value = value.decode('utf-8')
+        return value, i + 4 + n
+    elif tag == 'T':
+        return True, i
+    elif tag == 'F':
+        return False, i
+    elif tag == 'N':
+        return None, i
+    elif tag == 'i':
+        n = ord(data[i])
+        return int(data[i + 1:i + 1 + n]), i + 1 + n
+    elif tag == 'f':
+        return _double.unpack_from(data, i)[0], i + 8
+    elif tag == 't' or tag == 'l':
+        (n,) = _length.unpack_from(data, i)
+        i += 4
+        value = []
+        for j in xrange(n):
+            (v, i) = _decode_value(data, i)
+            value.append(v)
+        if tag == 't':
+            value = tuple(value)
+        return value, i
+
+    raise FormatError("unknown type %r" % (tag,))
+
+_TUNNEL = 'scotch.tunnel'
+_TUNNEL_FIELDS = ('host', 'port', 'bytes_up', 'bytes_down', 'started',
+                  'duration', 'error')
+
+def _decode_tunnel(environ):
+    """
+    Make a Tunnel (without its sockets) out of the 'scotch.tunnel.*'
+    items in 'environ', removing them.
+    """
+    from scotch.tunnel import Tunnel
+    tunnel = Tunnel(None)
+    for field in _TUNNEL_FIELDS:
+        setattr(tunnel, field, environ.pop('%s.%s' % (_TUNNEL, field), None))
+    return tunnel
+
+_typed_cache = {}
+_TYPED_CACHE_SIZE = 256
+
+def _decode_typed(data):
+    """
+    Decode the typed environ items, remembering the (immutable) results.
+    """
+    items = _typed_cache.get(data)
+    if items is not None:
+        return items
+
+    items = []
+    i = 0
+    try:
+        while i < len(data):
+            (k, i) = _decode_value(data, i)
+            (v, i) = _decode_value(data, i)
+            items.append((k, v))
+    except (struct.error, IndexError, ValueError):
+        raise FormatError("bad typed environ item")
+
+    if not _has_list(items):
+        if len(_typed_cache) >= _TYPED_CACHE_SIZE:
+            _typed_cache.clear()
+        _typed_cache[data] = items
+
+    return items
+
+def _has_list(items):
+    for item in items:
+        if type(item) is list or \
+           (type(item) is tuple and _has_list(item)):
+            return True
+    return False
+
+###
+
+class RecordIndex:
+    """
+    Random access to the records in a RecordReader, by number.  Only the
+    records' offsets are kept in memory.
+
+    >> index = RecordIndex(reader)
+    >> record = index[1000]
+
+    Building the index reads through the recording once (without the
+    bodies), calling visit(n, record) for each record, if it's given.
+    """
+    def __init__(self, reader, visit=None):
+        self.reader = reader
+        self.offsets = array('L')
+
+        n = 0
+        for (offset, record) in reader.iter_entries(bodies=False):
+            self.offsets.append(offset)
+            if visit is not None:
+                visit(n, record)
+            n += 1
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        return self.reader.read_record(self.offsets[i])
+
+def _skip(fp, n):
+    if n >= _SEEK_THRESHOLD:
+        fp.seek(n, 1)
+    elif n:
+        fp.read(n)
+
+def load_records(fp, allow_pickle=False):
+    """
+    Read all of the records in 'fp' into a new RecordHolder.
+    """
+    # none of the objects made here are garbage, but the collector
+    # would keep looking through them all, at a cost that grows with
+    # the size of the recording.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        reader = RecordReader(fp, allow_pickle)
+        if isinstance(reader.legacy, RecordHolder):
+            return reader.legacy
+
+        record_holder = RecordHolder()
+        for record in reader:
+            record_holder.add_record(record)
+        return record_holder
+    finally:
+        if enabled:
+            gc.enable()
@@ -0,0 +1,160 @@
+"""
+Trace where the time goes in individual proxied requests.
+
+>> tracer = Tracer('trace.json', sample_rate=0.1)
+>> app = TracingApp(Recorder(ProxyApp()), tracer)
+>> ... serve 'app' ...
+>> tracer.close()
+
+TracingApp picks out a sample of the requests, and puts a Trace into
+environ['scotch.trace'] for each of them.  ProxyApp & Recorder add spans
+to it for each phase of the request:
+
+ * queue -- waiting for the scheduler;
+ * dns, connect -- opening a new upstream connection;
+ * send -- sending the request (& its body) upstream;
+ * ttfb -- waiting for the first byte of the response;
+ * parse -- parsing the response head;
+ * start_response -- passing the status & headers on;
+ * body -- relaying the response body;
+ * capture, serialize -- the recorder copying the request, and building
+   & storing the record.
+
+When the response is finished, the trace is appended to the file in the
+Chrome trace-event JSON format, which chrome://tracing and Perfetto can
+load; each request shows up as a 'request' span, with its phases nested
+inside it, in the row for the thread that served it.  The file is a
+valid JSON array once the tracer has been closed, but the viewers don't
+mind if it hasn't been.
+
+Requests that aren't sampled cost one call to random().
+"""
+
+import os, time, random, threading, thread
+import json
+
+class Trace:
+    """
+    The spans of one request.
+    """
+    def __init__(self, tracer, args):
+        self.tracer = tracer
+        self.args = args
+        self.start = time.time()
+        self.tid = thread.get_ident()
+        self.events = []
+
+    def add(self, name, start, end, cat='proxy', **args):
+        """
+        Add a span that ran from 'start' to 'end' (from time.time()).
+        """
+        event = { 'name' : name, 'cat' : cat, 'ph' : 'X',
+                  'ts' : int(start * 1e6),
+                  'dur' : int((end - start) * 1e6),
+                  'pid' : os.getpid(), 'tid' : self.tid }
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def finish(self, **args):
+        """
+        Close the overall 'request' span, and write the trace out.
+        """
+        self.args.update(args)
+        self.add('request', self.start, time.time(), 'request', **self.args)
+        self.tracer.write(self)
+
+class Tracer:
+    """
+    Sample requests for tracing, and append their traces to a file.
+
+    The file is opened when the first trace is written, so a Tracer can
+    be created before forking worker processes that each set their own
+    'filename'.
+    """
+    def __init__(self, filename, sample_rate=1.0):
+        self.filename = filename
+        self.sample_rate = sample_rate
+        self.fp = None
+        self.n_events = 0
+        self.lock = threading.Lock()
+
+    def start(self, **args):
+        """
+        Return a new Trace, or None if this request isn't sampled.
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        return Trace(self, args)
+
+    def write(self, trace):
+        lines = [ json.dumps(event) for event in trace.events ]
+
+        self.lock.acquire()
+        try:
+            if self.fp is None:
+                self.fp = open(self.filename, 'w')
+                self.fp.write('[\n')
+            elif self.n_events:
+                self.fp.write(',\n')
+
+            self.fp.write(',\n'.join(lines))
+            self.fp.flush()
+            self.n_events += len(lines)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """
+        Finish off the JSON array & close the file.
+        """
+        self.lock.acquire()
+        try:
+            if self.fp is not None:
+                self.fp.write('\n]\n')
+                self.fp.close()
+                self.fp = None
+        finally:
+            self.lock.release()
+
+class TracingApp:
+    """
+    WSGI middleware that traces a sample of the requests to 'app'.
+    """
+    def __init__(self, app, tracer):
+        self.app = app
+        self.tracer = tracer
+
+    def __call__(self, environ, start_response):
+        url = environ.get('PATH_INFO', '')
+        if environ.get('QUERY_STRING'):
+            url += '?' + environ['QUERY_STRING']
+
+        trace = self.tracer.start(method=environ.get('REQUEST_METHOD'),
+                                  url=url)
+        if trace is None:
+            return self.app(environ, start_response)
+
+        environ['scotch.trace'] = trace
+        response = {}
+
+        def tracing_start_response(status, headers):
+            response['status'] = status
+            return start_response(status, headers)
+
+        try:
+            result = self.app(environ, tracing_start_response)
+        except:
+            trace.finish(error=True)
+            raise
+
+        return self._iter_traced(result, trace, response)
+
+    def _iter_traced(self, result, trace, response):
+        try:
+            for data in result:
+                yield data
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+            trace.finish(status=response.get('status'))
@@ -0,0 +1,207 @@
+"""
+Translate recorded browsing sessions into twill scripts.
+
+>> for (session, lines) in translate_file('recording.pickle', jobs=4):
+..    print "\n".join(lines)
+
+or translate(records) for records from anywhere else.
+
+Only "primary pages" are translated (see scotch.utils): page loads become
+'go' commands, and requests with query strings or form data become 'fv'
+commands followed by a 'submit'.  Fields with several values (checkboxes,
+multiple selects) get one 'fv' per value, the later ones prefixed with
+'+' so that twill adds them to the selection.
+
+Records are split into sessions by client address & user agent; a
+client that's been idle for more than 'gap' seconds starts a new session.
+
+With jobs > 1, translate_file splits the recording into blocks of
+records, and a pool of worker processes reads & translates them; only
+the translations come back to be put in order.  (Reading the records
+costs more than translating them, so handing records to the workers
+would gain nothing.)  The translation never looks at response bodies,
+so they're never read.
+"""
+
+import cgi, urlparse
+from cStringIO import StringIO
+
+from scotch import utils
+
+FILTERS = [utils.filter_only_primary_pages]
+
+BLOCK_SIZE = 5000                       # records per task, with jobs > 1.
+
+def translate_record(n, record):
+    """
+    Translate record number 'n'; return (client, timestamp, lines,
+    redirect_after_submit).  'lines' is None if the record isn't
+    interesting.
+    """
+    environ = record.environ
+    client = (environ.get('REMOTE_ADDR'), environ.get('HTTP_USER_AGENT'))
+    timestamp = getattr(record, 'timestamp', 0)
+
+    for f in FILTERS:
+        if not f(record):
+            return client, timestamp, None, False
+
+    output = [ '# record %d' % (n,) ]
+
+    referer_url = environ.get('HTTP_REFERER', '')
+    if referer_url:
+        output.append('#   referer = %s' % (referer_url,))
+
+    response = record.response
+    redirect_after_submit = False
+
+    query_string = environ.get('QUERY_STRING', '')
+    if record.is_post() or record.has_input() or query_string:
+        fields = _parse_fields(query_string, record)
+
+        seen = {}
+        for (k, v) in fields:
+            if "\n" in v:
+                v = v.split("\n")[0].strip()
+
+            if seen.has_key(k):
+                v = '+' + v                 # add to the selection.
+            seen[k] = 1
+
+            output.append("fv 1 %s '%s'" % (k, v.replace("'", "\\'")))
+
+        status = int(response.status.split()[0])
+        if status >= 300 and status < 400:
+            redirect_after_submit = True
+
+        output.append('submit')
+
+    elif response.is_ok():
+        path = environ['PATH_INFO']
+        url = urlparse.urlunparse(('', '', path, '', query_string, ''))
+        output.append('go %s' % (url,))
+
+    return client, timestamp, output, redirect_after_submit
+
+def _parse_fields(query_string, record):
+    """
+    Return the (name, value) pairs from the query string & any form data,
+    in order.
+    """
+    fields = []
+    if query_string:
+        fields.extend(cgi.parse_qsl(query_string))
+
+    if record.has_input():
+        content_type = record.environ.get('CONTENT_TYPE', '')
+        if content_type.lower().startswith('multipart/'):
+            form = cgi.FieldStorage(fp=StringIO(record.inp),
+                                    environ=record.environ)
+            for item in form.list or []:
+                fields.append((item.name, item.value))
+        else:
+            fields.extend(cgi.parse_qsl(record.inp))
+
+    return fields
+
+class Sessions:
+    """
+    Assign records to sessions, numbered from 0 in order of appearance.
+    """
+    def __init__(self, gap=1800):
+        self.gap = gap
+        self.last = {}                  # client => (session, timestamp)
+        self.n_sessions = 0
+
+    def assign(self, client, timestamp):
+        """
+        Return the session for a request from 'client' at 'timestamp'.
+        """
+        last = self.last.get(client)
+        if last is None or (self.gap and timestamp - last[1] > self.gap):
+            session = self.n_sessions
+            self.n_sessions += 1
+        else:
+            session = last[0]
+
+        self.last[client] = (session, timestamp)
+        return session
+
+def translate(records, gap=1800):
+    """
+    Yield (session, lines) for each interesting record in 'records'.
+    With gap=None, everything is one session.
+    """
+    results = ( translate_record(n, record)
+                for (n, record) in enumerate(records) )
+    return _sessions(results, gap)
+
+def translate_file(filename, jobs=1, gap=1800, allow_pickle=False):
+    """
+    Like translate, for the records in the recording 'filename', using
+    'jobs' processes.  'allow_pickle' is as for scotch.storage.
+    """
+    from scotch.storage import RecordReader
+    reader = RecordReader(open(filename, 'rb'), allow_pickle)
+
+    if jobs <= 1 or reader.legacy is not None:
+        return translate(reader.iter_records(bodies=False), gap)
+
+    return _sessions(_translate_blocks(filename, reader, jobs, allow_pickle),
+                     gap)
+
+def _translate_blocks(filename, reader, jobs, allow_pickle):
+    import multiprocessing
+
+    def blocks():
+        for (n, offset) in enumerate(reader.iter_offsets()):
+            if n % BLOCK_SIZE == 0:
+                yield filename, offset, n, allow_pickle
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for results in pool.imap(_translate_block, blocks()):
+            for result in results:
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _translate_block((filename, offset, n, allow_pickle)):
+    """
+    Translate BLOCK_SIZE records, numbered from 'n', from 'offset' on.
+    """
+    from scotch.storage import RecordReader
+    reader = RecordReader(open(filename, 'rb'), allow_pickle)
+
+    results = []
+    for (_, record) in reader.iter_entries(bodies=False, offset=offset):
+        results.append(translate_record(n, record))
+        n += 1
+        if len(results) == BLOCK_SIZE:
+            break
+
+    reader.fp.close()
+    return results
+
+def _sessions(results, gap):
+    """
+    Assign translated records to sessions, and yield (session, lines).
+    """
+    sessions = Sessions(gap)
+
+    # skip the page that a submit was redirected to, since the submit
+    # gets there by itself.
+    skip = {}
+    for (client, timestamp, lines, redirect_after_submit) in results:
+        if gap is None:
+            session = 0
+        else:
+            session = sessions.assign(client, timestamp)
+
+        if lines is None or skip.get(session):
+            skip[session] = False
+            continue
+
+        skip[session] = redirect_after_submit
+        yield session, lines
@@ -0,0 +1,512 @@
+"""
+CONNECT tunnels, so that HTTPS traffic can go through the proxy.
+
+The payload of a tunnel is encrypted, so the proxy can't see or record
+it; it just relays bytes both ways.  What it can record is the tunnel's
+metadata: the host & port, the bytes sent each way, and how long it was
+open.
+
+To accept CONNECT requests, serve ProxyApp with TunnelRequestHandler (or
+a subclass of it):
+
+>> httpd = scotch.server.make_server(('', 8000), ProxyApp(),
+..                                   TunnelRequestHandler)
+
+The handler puts a Tunnel into environ['scotch.tunnel'] for CONNECT
+requests; ProxyApp connects it upstream and returns it as the response
+body, and when the server "iterates" over it, the tunnel is handed to a
+relay thread and the request is done.  The one relay thread serves all
+of a process's tunnels, so open tunnels don't tie up the server, even a
+single-threaded one.
+
+Because the same Tunnel object ends up in a Recorder's copy of the
+environ, the recorded CONNECT request carries the tunnel's metadata,
+which is filled in as the tunnel runs; tunnel.wait() waits for it to
+close:
+
+>> tunnel = record.environ['scotch.tunnel']
+>> tunnel.wait()
+>> print tunnel.host, tunnel.port, tunnel.bytes_up, tunnel.bytes_down
+>> print tunnel.duration
+
+Relaying uses epoll where it's available (and poll, or select, where
+it's not), with a 64K buffer in each direction that's filled through
+recv_into & drained from a memoryview, so no Python code runs per byte.
+"""
+
+import os, socket, select, errno, time, threading
+from wsgiref.simple_server import WSGIRequestHandler
+
+class Tunnel:
+    """
+    A CONNECT tunnel between a client socket and an upstream server.
+    """
+    BUFSIZE=65536
+    IDLE_TIMEOUT=300
+
+    def __init__(self, client, pending=''):
+        """
+        'client' is the client's socket; 'pending' is any data the
+        client sent after its CONNECT request that's already been read.
+        """
+        self.client = client
+        self.pending = pending
+        self.server = None
+
+        self.host = self.port = None
+        self.bytes_up = 0                   # client -> server
+        self.bytes_down = 0                 # server -> client
+        self.started = None
+        self.duration = None
+        self.error = None
+
+        self.finished = threading.Event()
+
+    def connect(self, pool, host, port, timeout):
+        """
+        Open a new connection to host:port through 'pool' (a
+        scotch.pool.ConnectionPool), which looks up the host.
+        """
+        self.host, self.port = host, port
+        conn = pool.get(host, port, timeout, fresh=True)
+        self.server = conn.sock
+
+    def __iter__(self):
+        """
+        As a WSGI response body, the tunnel has no content of its own:
+        iterating over it hands it to the relay thread & returns, so
+        that the server can get on with other requests.
+        """
+        self.start()
+        return iter([])
+
+    def start(self):
+        """
+        Start relaying data both ways, in the background, until both
+        sides have closed their end, or until there's an error or the
+        tunnel has been idle too long.
+        """
+        if self.client is None or self.server is None:
+            raise ValueError("the tunnel isn't connected")
+
+        self.started = time.time()
+        _get_relay().add(self)
+
+    def wait(self, timeout=None):
+        """
+        Wait for the tunnel to close; return True if it has.
+        """
+        self.finished.wait(timeout)
+        return self.finished.isSet()
+
+    def relay(self):
+        """
+        Relay data until the tunnel closes.
+        """
+        self.start()
+        self.wait()
+
+    ### called from the relay thread
+
+    def _begin(self):
+        self.up = _Direction(self.client, self.server, self.BUFSIZE,
+                             self.pending)
+        self.down = _Direction(self.server, self.client, self.BUFSIZE)
+        self.pending = ''
+        self.last_active = time.time()
+
+        self.client.setblocking(0)
+        self.server.setblocking(0)
+
+    def _wants(self, sock):
+        """
+        Return (readable, writable): what to wait for on 'sock'.
+        """
+        (up, down) = (self.up, self.down)
+        return (up.wants_read(sock) or down.wants_read(sock),
+                up.wants_write(sock) or down.wants_write(sock))
+
+    def _handle(self, sock, readable, writable):
+        """
+        Move data on after an event on 'sock'; return False if there was
+        nothing to do.
+        """
+        self.last_active = time.time()
+
+        handled = False
+        for direction in (self.up, self.down):
+            if writable and direction.wants_write(sock):
+                direction.write()
+                handled = True
+            if readable and direction.wants_read(sock):
+                direction.read()
+                handled = True
+        return handled
+
+    def _is_done(self):
+        return self.up.done and self.down.done
+
+    def _end(self, error=None):
+        if error is not None:
+            self.error = error
+
+        self.bytes_up += self.up.total
+        self.bytes_down += self.down.total
+        self.duration = time.time() - self.started
+        self.up = self.down = None
+
+        self._close_sockets()
+        self.finished.set()
+
+    def close(self):
+        """
+        Close a tunnel that never started; once it has, the relay thread
+        closes it.  (The server calls this when it's done with the
+        response body.)
+        """
+        if self.started is None:
+            self._close_sockets()
+
+    def _close_sockets(self):
+        for sock in (self.client, self.server):
+            if sock is not None:
+                try:
+                    sock.close()
+                except socket.error:
+                    pass
+
+    def __getstate__(self):
+        # the sockets don't survive pickling; the metadata does.
+        state = dict(self.__dict__)
+        state['client'] = state['server'] = None
+        state['pending'] = ''
+        del state['finished']
+        for name in ('up', 'down'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.finished = threading.Event()
+        if self.duration is not None:
+            self.finished.set()
+
+    def __str__(self):
+        s = '%s:%s, %d bytes up, %d bytes down' % (self.host, self.port,
+                                                   self.bytes_up,
+                                                   self.bytes_down)
+        if self.duration is not None:
+            s += ', %.1fs' % (self.duration,)
+        if self.error:
+            s += ' (%s)' % (self.error,)
+        return s
+
+class _Direction:
+    """
+    One direction of a tunnel: data read from 'src' is buffered until it
+    can be written to 'dst'.
+    """
+    def __init__(self, src, dst, bufsize, pending=''):
+        self.src = src
+        self.dst = dst
+
+        self.buffer = bytearray(max(bufsize, len(pending)))
+        self.view = memoryview(self.buffer)
+        self.buffer[:len(pending)] = pending
+        self.start, self.end = 0, len(pending)
+
+        self.eof = False                # 'src' has closed its end.
+        self.done = False               # ...and everything's been sent on.
+        self.total = 0
+
+    def wants_read(self, sock):
+        return sock is self.src and not self.eof and self.start == self.end
+
+    def wants_write(self, sock):
+        return sock is self.dst and self.start < self.end
+
+    def read(self):
+        try:
+            n = self.src.recv_into(self.view)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+
+        if not n:
+            self.eof = True
+            self._finish()
+            return
+
+        self.start, self.end = 0, n
+
+        # usually the other side can take it all straight away.
+        self.write()
+
+    def write(self):
+        try:
+            n = self.dst.send(self.view[self.start:self.end])
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+
+        self.start += n
+        self.total += n
+        if self.eof:
+            self._finish()
+
+    def _finish(self):
+        """
+        Once 'src' has closed its end & everything's been passed on,
+        pass the close on to 'dst'.
+        """
+        if self.done or self.start < self.end:
+            return
+
+        self.done = True
+        try:
+            self.dst.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+
+class _Relay:
+    """
+    A thread that relays data for all of a process's open tunnels, with
+    one poller.  Tunnels are handed over with 'add'.
+    """
+    CHECK_INTERVAL=1.0                  # seconds between idle checks.
+
+    def __init__(self):
+        self.poller = _Poller()
+        self.socks = {}                 # fd -> (tunnel, socket)
+        self.tunnels = []
+
+        self.lock = threading.Lock()
+        self.new = []                   # tunnels handed over, not yet added
+
+        # writing to the pipe wakes the thread up to take new tunnels.
+        (self.wake_r, self.wake_w) = os.pipe()
+        self.poller.register(self.wake_r)
+        self.poller.modify(self.wake_r, readable=True, writable=False)
+
+        t = threading.Thread(target=self.run)
+        t.setDaemon(True)
+        t.start()
+
+    def add(self, tunnel):
+        self.lock.acquire()
+        try:
+            self.new.append(tunnel)
+        finally:
+            self.lock.release()
+        os.write(self.wake_w, 'x')
+
+    def run(self):
+        next_check = time.time() + self.CHECK_INTERVAL
+        while 1:
+            for (fd, readable, writable, hangup) in \
+                    self.poller.poll(self.CHECK_INTERVAL):
+                if fd == self.wake_r:
+                    os.read(self.wake_r, 4096)
+                    self._take_new()
+                elif self.socks.has_key(fd):
+                    (tunnel, sock) = self.socks[fd]
+                    self._event(tunnel, sock, readable, writable, hangup)
+
+            now = time.time()
+            if now >= next_check:
+                next_check = now + self.CHECK_INTERVAL
+                for tunnel in self.tunnels[:]:
+                    if tunnel.last_active < now - tunnel.IDLE_TIMEOUT:
+                        self._remove(tunnel, 'idle timeout')
+
+    def _take_new(self):
+        self.lock.acquire()
+        try:
+            (new, self.new) = (self.new, [])
+        finally:
+            self.lock.release()
+
+        for tunnel in new:
+            try:
+                tunnel._begin()
+            except socket.error, e:
+                tunnel._end(str(e))
+                continue
+
+            self.tunnels.append(tunnel)
+            for sock in (tunnel.client, tunnel.server):
+                self.socks[sock.fileno()] = (tunnel, sock)
+                self.poller.register(sock.fileno())
+            self._update(tunnel)
+
+    def _event(self, tunnel, sock, readable, writable, hangup):
+        try:
+            handled = tunnel._handle(sock, readable, writable)
+        except socket.error, e:
+            self._remove(tunnel, str(e))
+            return
+
+        if tunnel._is_done() or (hangup and not handled):
+            # (the socket's closed or broken under us, with nothing left
+            # to read from it.)
+            self._remove(tunnel)
+        else:
+            self._update(tunnel)
+
+    def _update(self, tunnel):
+        for sock in (tunnel.client, tunnel.server):
+            (readable, writable) = tunnel._wants(sock)
+            self.poller.modify(sock.fileno(), readable, writable)
+
+    def _remove(self, tunnel, error=None):
+        self.tunnels.remove(tunnel)
+        for sock in (tunnel.client, tunnel.server):
+            del self.socks[sock.fileno()]
+            self.poller.unregister(sock.fileno())
+        tunnel._end(error)
+
+_relay = None
+_relay_pid = None
+
+def _get_relay():
+    """
+    The relay thread for this process, started on first use (so that a
+    forked worker gets its own).
+    """
+    global _relay, _relay_pid
+
+    _relay_lock.acquire()
+    try:
+        if _relay_pid != os.getpid():
+            _relay = _Relay()
+            _relay_pid = os.getpid()
+        return _relay
+    finally:
+        _relay_lock.release()
+
+_relay_lock = threading.Lock()
+
+class _Poller:
+    """
+    Wait for sockets to become readable/writable, with epoll if there
+    is such a thing here, otherwise poll or select.
+    """
+    def __init__(self):
+        self.flags = {}
+        self.epoll = self.poll_obj = None
+
+        if hasattr(select, 'epoll'):
+            self.epoll = select.epoll()
+        elif hasattr(select, 'poll'):
+            self.poll_obj = select.poll()
+
+    def register(self, fd):
+        self.flags[fd] = (False, False)
+        if self.epoll is not None:
+            self.epoll.register(fd, 0)
+        elif self.poll_obj is not None:
+            self.poll_obj.register(fd, 0)
+
+    def unregister(self, fd):
+        del self.flags[fd]
+        if self.epoll is not None:
+            self.epoll.unregister(fd)
+        elif self.poll_obj is not None:
+            self.poll_obj.unregister(fd)
+
+    def modify(self, fd, readable, writable):
+        if self.flags[fd] == (readable, writable):
+            return
+        self.flags[fd] = (readable, writable)
+
+        if self.epoll is not None:
+            self.epoll.modify(fd, (readable and select.EPOLLIN) |
+                                  (writable and select.EPOLLOUT))
+        elif self.poll_obj is not None:
+            self.poll_obj.modify(fd, (readable and select.POLLIN) |
+                                     (writable and select.POLLOUT))
+
+    def poll(self, timeout):
+        """
+        Return a list of (fd, readable, writable, hangup); errors and
+        hangups count as readable too, so that a read finds out about
+        them.
+        """
+        if self.epoll is not None:
+            (IN, OUT, HUP) = (select.EPOLLIN, select.EPOLLOUT,
+                              select.EPOLLERR | select.EPOLLHUP)
+            events = _retry(self.epoll.poll, timeout)
+        elif self.poll_obj is not None:
+            (IN, OUT, HUP) = (select.POLLIN, select.POLLOUT,
+                              select.POLLERR | select.POLLHUP)
+            events = _retry(self.poll_obj.poll, timeout * 1000)
+        else:
+            r = [ fd for fd in self.flags if self.flags[fd][0] ]
+            w = [ fd for fd in self.flags if self.flags[fd][1] ]
+            (r, w, _) = _retry(select.select, r, w, [], timeout)
+            return [ (fd, fd in r, fd in w, False) for fd in set(r + w) ]
+
+        return [ (fd, bool(ev & (IN | HUP)), bool(ev & OUT), bool(ev & HUP))
+                 for (fd, ev) in events ]
+
+    def close(self):
+        if self.epoll is not None:
+            self.epoll.close()
+
+def _retry(fn, *args):
+    while 1:
+        try:
+            return fn(*args)
+        except (select.error, IOError), e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+class TunnelRequestHandler(WSGIRequestHandler):
+    """
+    A WSGIRequestHandler that hands CONNECT requests to the app with a
+    Tunnel in environ['scotch.tunnel'].
+
+    The tunnel gets its own reference to the client's socket; once the
+    tunnel has started, the handler lets go of its own, so that the
+    server finishing the request doesn't shut the tunnel down.
+    """
+    tunnel = None
+
+    def get_environ(self):
+        environ = WSGIRequestHandler.get_environ(self)
+
+        if self.command == 'CONNECT':
+            # anything the client sent after the request head (e.g. the
+            # start of a TLS handshake) is sitting in rfile's buffer.
+            pending = ''
+            rbuf = getattr(self.rfile, '_rbuf', None)
+            if rbuf is not None:
+                pending = rbuf.getvalue()
+                rbuf.seek(0)
+                rbuf.truncate()
+
+            self.tunnel = Tunnel(self.connection.dup(), pending)
+            environ['scotch.tunnel'] = self.tunnel
+
+        return environ
+
+    def finish(self):
+        WSGIRequestHandler.finish(self)
+
+        if self.tunnel is not None and self.tunnel.started is not None:
+            self.connection.close()
+
+def split_authority(authority, default_port=443):
+    """
+    Split the 'host:port' of a CONNECT request into host and port.
+    """
+    (host, colon, port) = authority.rpartition(':')
+    if not colon or authority.endswith(']'):
+        (host, port) = (authority, default_port)
+
+    if host.startswith('[') and host.endswith(']'):     # IPv6 literal.
+        host = host[1:-1]
+
+    return host, int(port)
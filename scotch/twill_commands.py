@@ -5,58 +5,108 @@ import scotch.utils
 record_holder = None
 record_index = None
 
-def load_recording(filename):
-    global record_holder
-    global record_index
+# condition => bytearray with a 1 for each record passing the filter, for
+# the records in _bitmaps_holder.
+_bitmaps = {}
+_bitmaps_holder = None
+
+def _filters():
+    return [ (name[len('filter_'):], getattr(scotch.utils, name))
+             for name in dir(scotch.utils) if name.startswith('filter_') ]
+
+def load_recording(filename, allow_pickle=''):
+    """
+    Load a recording for navigation.  The records stay on disk; the
+    filters are run over all of them once, here, so that stepping through
+    the recording is just a search in a bitmap.
+
+    Pass 'allow_pickle' as a second argument to read old pickled
+    recordings (see scotch.storage).
+    """
+    global record_holder, record_index
+    global _bitmaps, _bitmaps_holder
     
-    from cPickle import load
-    record_holder = load(open(filename))
+    from scotch.storage import RecordReader, RecordIndex
+
+    bitmaps = {}
+    tests = []
+    for (name, fn) in _filters():
+        bitmaps[name] = bytearray()
+        tests.append((fn, bitmaps[name].append))
+
+    def visit(n, record):
+        for (fn, append) in tests:
+            append(fn(record) and 1 or 0)
+
+    allow_pickle = allow_pickle not in ('', '0', 'false', False)
+    record_holder = RecordIndex(RecordReader(open(filename, 'rb'),
+                                             allow_pickle), visit)
+    _bitmaps, _bitmaps_holder = bitmaps, record_holder
 
     print 'loaded %d records' % (len(record_holder),)
     record_index = 0
 
+def _bitmap(condition):
+    """
+    Return the bitmap for 'condition', computing it if need be (e.g. if
+    'record_holder' was set directly).
+    """
+    global _bitmaps, _bitmaps_holder
+    if _bitmaps_holder is not record_holder:
+        _bitmaps, _bitmaps_holder = {}, record_holder
+
+    bitmap = _bitmaps.get(condition)
+    if bitmap is None:
+        fn = getattr(scotch.utils, 'filter_%s' % (condition,))
+        bitmap = bytearray([ fn(r) and 1 or 0 for r in record_holder ])
+        _bitmaps[condition] = bitmap
+
+    return bitmap
+
 def record(n):
+    """
+    Go to record 'n'.  Records are numbered from 1, as in the 'at record'
+    and 'Displaying record' messages.
+    """
     global record_index
     assert record_holder is not None
 
-    record_index = int(n - 1)
-    record_holder[record_index]         # will throw an error if out of bounds
+    i = int(n) - 1
+    if i < 0 or i >= len(record_holder):
+        raise IndexError("no record %s" % (n,))
+    record_index = i
 
 def next_record(condition='only_primary_pages'):
-    fn = None
-    if condition:
-        fn = 'filter_%s' % (condition,)
-        fn = getattr(scotch.utils, fn)
-
     global record_index
-    i = record_index + 1
-    while i < len(record_holder) and not fn(record_holder[i]):
-        i += 1
+    assert record_holder is not None
 
-    if i == len(record_holder):
+    if condition:
+        i = _bitmap(condition).find('\x01', record_index + 1)
+    else:
+        i = record_index + 1
+        if i >= len(record_holder):
+            i = -1
+
+    if i < 0:
         print 'no more (significant) records'
     else:
-        print 'at record', i
-        
-    record_index = i
+        print 'at record', i + 1
+        record_index = i
 
 def prev_record(condition='only_primary_pages'):
-    fn = None
-    if condition:
-        fn = 'filter_%s' % (condition,)
-        fn = getattr(scotch.utils, fn)
-
     global record_index
-    i = record_index - 1
-    while i >= 0 and not fn(record_holder[i]):
-        i -= 1
+    assert record_holder is not None
 
-    if i == 0:
+    if condition:
+        i = _bitmap(condition).rfind('\x01', 0, max(record_index, 0))
+    else:
+        i = record_index - 1
+
+    if i < 0:
         print 'no previous (significant) records'
     else:
-        print 'at record', i
-        
-    record_index = i
+        print 'at record', i + 1
+        record_index = i
 
 def show_record(*what):
     record = record_holder[record_index]
@@ -65,7 +115,7 @@ def show_record(*what):
     if not what or '+' in what:
         show_default = True
 
-    print '\n** Displaying record %d:' % (record_index,)
+    print '\n** Displaying record %d:' % (record_index + 1,)
     if show_default or 'url' in what:
         print '   URL:', record.environ.get('PATH_INFO')
     if show_default or 'status' in what:
@@ -77,18 +127,17 @@ def show_record(*what):
         query_string = record.environ.get('QUERY_STRING', '')
         if query_string:
             print '   Query string:'
-            print scotch.utils
             scotch.utils._display_query_string(query_string)
 
         if record.inp:
             print '   POST data:'
             scotch.utils._display_post_data(record.inp, record.environ)
     if 'content_type' in what:
-        content = record.response.get_output()
+        content = record.response.get_decoded_output()
         typ = record.response.get_content_type()
         print '   Returned content: %d bytes of %s' % (len(content), typ)
     if 'content' in what:
-        content = record.response.get_output()
+        content = record.response.get_decoded_output()
         typ = record.response.get_content_type()
         print '   Returned content (%d bytes, %s)' % (len(content), typ)
         print '==='
@@ -2,6 +2,7 @@
 Utility functions.
 
  * display_record(r) -- pretty-print the given record.
+ * display_record_line(n, r) -- print a one-line summary of the record.
 """
 
 from cStringIO import StringIO
@@ -27,33 +28,36 @@ def filter_not_redirect_unless_submit(record):
         return False
     return True
 
+def _content_type(record):
+    return (record.response.get_content_type() or '').lower()
+
 def filter_html_only(record):
-    content_type = record.response.get_content_type()
-    if content_type.lower().split(';')[0] == 'text/html':
+    content_type = _content_type(record)
+    if content_type.split(';')[0].strip() == 'text/html':
         return True
     return False
 
 def filter_no_images(record):
-    content_type = record.response.get_content_type()
+    content_type = _content_type(record)
     if content_type.startswith('image/'):
         return False
     return True
 
 def filter_no_javascript(record):
-    content_type = record.response.get_content_type()
-    if content_type.lower() in ('application/x-javascript', 'text/javascript'):
+    content_type = _content_type(record).split(';')[0].strip()
+    if content_type in ('application/x-javascript', 'text/javascript'):
         return False
     return True
 
 def filter_no_css(record):
-    content_type = record.response.get_content_type()
-    if content_type.lower().startswith('text/css'):
+    content_type = _content_type(record)
+    if content_type.startswith('text/css'):
         return False
     return True
 
 def filter_no_application(record):
-    content_type = record.response.get_content_type()
-    if content_type.lower().startswith('application/'):
+    content_type = _content_type(record)
+    if content_type.startswith('application/'):
         return False
     return True
 
@@ -93,13 +97,20 @@ def _display_headers(env):
             print '\t %s : %s' % (k, v,)
 
 
-def display_record(record, filters=[filter_only_primary_pages]):
+def display_record(record, filters=[filter_only_primary_pages], forms=True):
     """
-    Pretty-print the record.
+    Pretty-print the record; with forms=False, skip parsing & showing
+    the query string and form data.
 
     >> for record in recorder.record_holder:
     ..    display_record(record)
     """
+    tunnel = record.environ.get('scotch.tunnel')
+    if tunnel is not None:
+        # there's nothing to show but the tunnel's metadata.
+        print 'TUNNEL ==> %s' % (tunnel,)
+        return True
+
     for f in filters:
         if not f(record):
             return False
@@ -115,19 +126,51 @@ def display_record(record, filters=[filter_only_primary_pages]):
     ### display GET variables
     
     query_string = environ.get('QUERY_STRING', "")
-    if query_string:
+    if query_string and forms:
         print '(query string)'
         _display_query_string(query_string)
 
     ### display POST variables
 
-    if inp:
+    if inp and forms:
         print '(post form)'
         _display_post_data(record.inp, environ)
 
     print ''
     print '++ RESPONSE: %s' % (record.response.status,)
-    print '++ (%d bytes of content returned)' % (len(record.response.get_output()))
+    response = record.response
+    encoding = response.get_content_encoding()
+    if encoding:
+        print '++ (%d bytes of %s content returned, %d bytes decoded)' % \
+              (len(response.get_output()), encoding,
+               len(response.get_decoded_output()))
+    else:
+        print '++ (%d bytes of content returned)' % \
+              (response.get_output_length(),)
     print '++ (response is %s)' % (record.response.get_content_type(),)
 
     return True
+
+def display_record_line(n, record):
+    """
+    Print record number 'n' on one line: method, status, size, content
+    type & URL.  Doesn't look at the body, so it works on records loaded
+    without one.
+    """
+    environ = record.environ
+    url = environ.get('PATH_INFO', '')
+    if environ.get('QUERY_STRING'):
+        url += '?' + environ['QUERY_STRING']
+
+    tunnel = environ.get('scotch.tunnel')
+    if tunnel is not None:
+        print '%6d CONNECT %s' % (n, tunnel)
+        return
+
+    response = record.response
+    content_type = (response.get_content_type() or '-').split(';')[0]
+
+    print '%6d %-7s %s %9d %-24s %s' % (n, environ.get('REQUEST_METHOD', '-'),
+                                       (response.status or '-').split()[0],
+                                       response.get_output_length(),
+                                       content_type, url)
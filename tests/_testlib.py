@@ -6,3 +6,35 @@ scotchdir = os.path.join(thisdir, '../scotch/')
 def _add_scotchdir_to_path():
     if scotchdir not in sys.path:
         sys.path.insert(0, scotchdir)
+
+def make_record(url, body='', status='200 OK', content_type='text/html',
+                headers=(), method='GET', query='', inp='', timestamp=None,
+                **environ):
+    """
+    Make a scotch.recorder.Record of a request for 'url' and its response.
+
+    'body' is the response body, or a list of the pieces it was sent in;
+    'content_type' (if not None) and 'headers' are the response headers.
+    'inp' is POSTed as a form.  Any other keyword arguments go into the
+    WSGI environ, e.g. REMOTE_ADDR='10.0.0.1'.
+    """
+    from scotch.recorder import Record, Response
+
+    response = Response()
+    response.status = status
+    response.headers = []
+    if content_type is not None:
+        response.headers.append(('Content-type', content_type))
+    response.headers.extend(headers)
+    if isinstance(body, str):
+        body = [body]
+    response.content_list = list(body)
+    response.errout = ''
+
+    environ.update({ 'PATH_INFO' : url, 'QUERY_STRING' : query,
+                     'REQUEST_METHOD' : method })
+    if inp:
+        environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+        environ['CONTENT_LENGTH'] = str(len(inp))
+
+    return Record(environ, inp, response, timestamp=timestamp)
@@ -0,0 +1,51 @@
+import _testlib
+_testlib._add_scotchdir_to_path()
+
+from scotch.chunked import ChunkedDecoder, ChunkedError
+
+_body = '5\r\nhello\r\n7;ext=1\r\n, world\r\n0\r\nX-Trailer: yes\r\n\r\nNEXT'
+
+class TestChunkedDecoder:
+    def test_basic(self):
+        """
+        Decode a chunked body in one go, with extensions & trailers.
+        """
+        decoder = ChunkedDecoder()
+        assert decoder.decode(_body) == 'hello, world'
+
+        assert decoder.done
+        assert decoder.trailers == [('X-Trailer', 'yes')]
+        assert decoder.unused == 'NEXT'
+
+    def test_byte_at_a_time(self):
+        """
+        Decode the same body fed in one byte at a time.
+        """
+        decoder = ChunkedDecoder()
+
+        out = []
+        for c in _body:
+            out.append(decoder.decode(c))
+
+        assert "".join(out) == 'hello, world'
+        assert decoder.trailers == [('X-Trailer', 'yes')]
+        assert decoder.unused == 'NEXT'
+
+    def test_not_done(self):
+        """
+        Don't claim to be done before the trailers are over.
+        """
+        decoder = ChunkedDecoder()
+        decoder.decode('5\r\nhello\r\n0\r\n')
+        assert not decoder.done
+
+    def test_bad_size(self):
+        """
+        Complain about invalid chunk sizes.
+        """
+        decoder = ChunkedDecoder()
+        try:
+            decoder.decode('zz\r\n')
+            assert 0, "should have failed"
+        except ChunkedError:
+            pass
@@ -0,0 +1,126 @@
+import _testlib
+_testlib._add_scotchdir_to_path()
+
+import json, zlib
+from cStringIO import StringIO
+
+from _testlib import make_record
+from scotch import har
+
+def _har_record(url, body, content_type, **kw):
+    return make_record(url, body, content_type=content_type,
+                       timestamp=1234567890.5, SERVER_PROTOCOL='HTTP/1.1',
+                       HTTP_USER_AGENT='test', **kw)
+
+DEVTOOLS_HAR = '''{
+  "log": {
+    "version": "1.2",
+    "creator": {"name": "WebInspector", "version": "537.36"},
+    "pages": [{"id": "page_1", "title": "x", "pageTimings": {}}],
+    "entries": [
+      {
+        "startedDateTime": "2026-10-19T14:00:00.250+02:00",
+        "time": 250,
+        "request": {
+          "method": "POST",
+          "url": "https://example.com:8443/a;p?x=1&y=%C3%A9",
+          "httpVersion": "http/2.0",
+          "headers": [{"name": ":authority", "value": "example.com"},
+                      {"name": "cookie", "value": "a=1"}],
+          "postData": {"mimeType": "application/x-www-form-urlencoded",
+                       "params": [{"name": "q", "value": "caf\\u00e9"}]}
+        },
+        "response": {
+          "status": 200, "statusText": "",
+          "headers": [{"name": "content-encoding", "value": "gzip"},
+                      {"name": "content-type", "value": "text/plain"}],
+          "content": {"size": 6, "mimeType": "text/plain",
+                      "text": "h\\u00e9llo"}
+        }
+      }
+    ]
+  }
+}'''
+
+class TestHAR:
+    def test_roundtrip(self):
+        """
+        Export records to HAR & read them back.
+        """
+        gzipped = zlib.compress('<p>zipped</p>')
+        binary = ''.join([ chr(i % 256) for i in range(har.BASE64_BLOCK + 7) ])
+
+        records = [ _har_record('http://x/page', '<p>caf\xc3\xa9</p>',
+                                'text/html; charset=utf-8', query='a=1&b='),
+                    _har_record('http://x/z', gzipped, 'text/html',
+                                headers=[('Content-Encoding', 'deflate')]),
+                    _har_record('http://x/img', binary, 'image/png'),
+                    _har_record('http://x/post', '', 'text/html',
+                                method='POST', inp='\xff\x00data') ]
+
+        fp = StringIO()
+        writer = har.HARWriter(fp)
+        for record in records:
+            writer.write(record)
+        writer.close()
+
+        archive = json.loads(fp.getvalue())      # valid JSON, all of it.
+        entries = archive['log']['entries']
+        assert len(entries) == 4
+        assert entries[0]['request']['queryString'] == \
+               [ { 'name' : 'a', 'value' : '1' }, { 'name' : 'b',
+                                                    'value' : '' } ]
+        assert entries[1]['response']['content']['text'] == '<p>zipped</p>'
+        assert entries[2]['response']['content']['encoding'] == 'base64'
+
+        loaded = list(har.read_har(StringIO(fp.getvalue())))
+        assert len(loaded) == 4
+        for (r1, r2) in zip(records, loaded):
+            for k in ('PATH_INFO', 'QUERY_STRING', 'REQUEST_METHOD',
+                      'HTTP_USER_AGENT'):
+                assert r1.environ[k] == r2.environ[k], k
+            assert r1.inp == r2.inp
+            assert r1.timestamp == r2.timestamp
+            assert r1.response.status == r2.response.status
+            assert r1.response.get_decoded_output() == \
+                   r2.response.get_output()
+
+        assert loaded[1].response.get_content_encoding() is None
+
+    def test_devtools(self):
+        """
+        Read a browser's HAR file, a few bytes at a time.
+        """
+        block = har._JSONStream.BLOCK
+        har._JSONStream.BLOCK = 7
+        try:
+            (record,) = list(har.read_har(StringIO(DEVTOOLS_HAR)))
+        finally:
+            har._JSONStream.BLOCK = block
+
+        environ = record.environ
+        assert environ['PATH_INFO'] == 'https://example.com:8443/a;p'
+        assert environ['QUERY_STRING'] == 'x=1&y=%C3%A9'
+        assert environ['SERVER_NAME'] == 'example.com'
+        assert environ['SERVER_PORT'] == '8443'
+        assert environ['SERVER_PROTOCOL'] == 'HTTP/2.0'
+        assert environ['HTTP_COOKIE'] == 'a=1'
+        assert not environ.has_key('HTTP_:AUTHORITY')
+        assert record.inp == 'q=caf\xc3\xa9'
+        assert record.timestamp == 1792411200.5, record.timestamp
+
+        response = record.response
+        assert response.status == '200'
+        assert response.get_output() == 'h\xc3\xa9llo'
+        assert response.headers == [('content-type', 'text/plain'),
+                                    ('Content-Length', '6')]
+
+    def test_truncated(self):
+        """
+        Complain about a truncated HAR file.
+        """
+        try:
+            list(har.read_har(StringIO(DEVTOOLS_HAR[:-40])))
+            assert 0, "should have raised HARError"
+        except har.HARError:
+            pass
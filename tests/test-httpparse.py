@@ -0,0 +1,119 @@
+import _testlib
+_testlib._add_scotchdir_to_path()
+
+from scotch.httpparse import ResponseParser, RequestParser, ParseError, \
+     parse_response_head
+
+_response = 'HTTP/1.1 100 Continue\r\n\r\n' \
+            'HTTP/1.1 200 OK\r\n' \
+            'Content-Type: text/plain\r\n' \
+            'Content-Length: 12\r\n' \
+            '\r\n' \
+            'hello, worldNEXT'
+
+def _parse(parser, pieces):
+    events = []
+    for piece in pieces:
+        events.extend(parser.feed(piece))
+    return events
+
+def _body(events):
+    return "".join([ v for (e, v) in events if e == 'body' ])
+
+class TestResponseParser:
+    def test_basic(self):
+        """
+        Parse a response in one go, skipping the interim response.
+        """
+        parser = ResponseParser()
+        events = _parse(parser, [_response])
+
+        assert parser.status_code == 200 and parser.reason == 'OK'
+        assert events[0] == ('head', [('Content-Type', 'text/plain'),
+                                      ('Content-Length', '12')])
+        assert _body(events) == 'hello, world'
+        assert events[-1][0] == 'end'
+        assert parser.keep_alive
+        assert parser.unused == 'NEXT'
+
+    def test_byte_at_a_time(self):
+        """
+        Parse the same response fed in one byte at a time.
+        """
+        parser = ResponseParser()
+        events = _parse(parser, list(_response))
+
+        assert parser.status_code == 200
+        assert _body(events) == 'hello, world'
+        assert parser.unused == 'NEXT'
+
+    def test_chunked(self):
+        """
+        De-chunk a chunked body.
+        """
+        parser = ResponseParser()
+        events = _parse(parser, ['HTTP/1.1 200 OK\r\n'
+                                 'Transfer-Encoding: chunked\r\n\r\n'
+                                 '5\r\nhello\r\n0\r\n\r\n'])
+        assert _body(events) == 'hello'
+        assert parser.done
+
+    def test_until_close(self):
+        """
+        Read a body without framing until the connection closes.
+        """
+        parser = ResponseParser()
+        events = _parse(parser, ['HTTP/1.0 200 OK\r\n\r\n', 'some', 'thing'])
+        assert not parser.done
+
+        events.extend(parser.feed_eof())
+        assert _body(events) == 'something'
+        assert not parser.keep_alive
+
+    def test_truncated(self):
+        """
+        Complain when the connection closes in the middle of the body.
+        """
+        parser = ResponseParser()
+        _parse(parser, [_response[:-10]])
+        try:
+            parser.feed_eof()
+            assert 0, "should have failed"
+        except ParseError:
+            pass
+
+    def test_broken_server(self):
+        """
+        Put up with bare newlines, colon-less headers, and no reason.
+        """
+        head = '\r\nHTTP/1.0 404\nX-Good: yes\nthis is junk\n' \
+               'X-Folded: a\n b\n\n'
+        (version, status_code, reason, headers) = parse_response_head(head)
+
+        assert (version, status_code, reason) == ('HTTP/1.0', 404, '')
+        assert headers == [('X-Good', 'yes'), ('X-Folded', 'a b')]
+
+        try:
+            parse_response_head(head, tolerant=False)
+            assert 0, "should have failed"
+        except ParseError:
+            pass
+
+    def test_content_length(self):
+        """
+        Accept repeated Content-Lengths that agree, & reject bad ones.
+        """
+        head = 'HTTP/1.1 200 OK\r\nContent-Length: %s\r\n' \
+               'Content-Length: 5\r\n\r\nhello'
+        events = _parse(ResponseParser(), [head % ('5',)])
+        assert _body(events) == 'hello'
+
+        request = 'POST / HTTP/1.1\r\nContent-Length: %s\r\n\r\n'
+        for bad in ('-5', '5x', '', '10, 20'):
+            for parser, data in ((ResponseParser(), head % (bad,)),
+                                 (RequestParser(), request % (bad,))):
+                try:
+                    parser.feed(data)
+                    assert 0, "should have raised ParseError on %r" % (bad,)
+                except ParseError:
+                    pass
@@ -0,0 +1,87 @@
+import _testlib
+_testlib._add_scotchdir_to_path()
+
+import threading
+
+from scotch.metrics import Registry, MetricsApp
+
+###
+
+class TestMetrics:
+    def test_counter_threads(self):
+        """
+        Add up counts from several threads.
+        """
+        registry = Registry()
+        counter = registry.counter('hits_total', 'Hits.', ('kind',))
+
+        def count():
+            for i in range(1000):
+                counter.inc(1, ('a',))
+            counter.inc(5, ('b',))
+
+        threads = [ threading.Thread(target=count) for i in range(4) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert counter.values() == { ('a',) : 4000, ('b',) : 20 }
+        assert counter.values() == { ('a',) : 4000, ('b',) : 20 }
+        assert not counter.shards.cells         # folded into 'retired'.
+
+    def test_histogram(self):
+        """
+        Count observations into cumulative buckets.
+        """
+        registry = Registry()
+        h = registry.histogram('latency_seconds', 'Latency.',
+                               buckets=(0.1, 1))
+        for v in (0.05, 0.1, 0.5, 2):
+            h.observe(v)
+
+        lines = h.render()
+        assert lines == ['latency_seconds_bucket{le="0.1"} 2',
+                         'latency_seconds_bucket{le="1"} 3',
+                         'latency_seconds_bucket{le="+Inf"} 4',
+                         'latency_seconds_sum 2.65',
+                         'latency_seconds_count 4'], lines
+
+    def test_render(self):
+        """
+        Render metrics in the Prometheus text format, over WSGI.
+        """
+        registry = Registry()
+        registry.counter('requests_total', 'Requests.', ('class',)).inc(
+            2, ('2xx',))
+        registry.gauge('queue', 'Queue "depth".', fn=lambda: 3)
+        registry.counter('errors_total', 'Errors.')
+
+        assert registry.counter('requests_total', 'Again.') is \
+               registry.by_name['requests_total']
+
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return ['proxied']
+
+        app = MetricsApp(app, registry)
+        response = {}
+        def start_response(status, headers):
+            response['status'] = status
+
+        assert app({ 'PATH_INFO' : 'http://example.com/metrics' },
+                   start_response) == ['proxied']
+
+        body = "".join(app({ 'PATH_INFO' : '/metrics' }, start_response))
+        assert response['status'] == '200 OK'
+        assert body == '''\
+# HELP requests_total Requests.
+# TYPE requests_total counter
+requests_total{class="2xx"} 2
+# HELP queue Queue "depth".
+# TYPE queue gauge
+queue 3
+# HELP errors_total Errors.
+# TYPE errors_total counter
+errors_total 0
+''', body
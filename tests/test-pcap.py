@@ -0,0 +1,218 @@
+import _testlib
+_testlib._add_scotchdir_to_path()
+
+import os, struct, tempfile
+from cStringIO import StringIO
+
+from scotch import pcap
+
+CLIENT, SERVER = '\x0a\x00\x00\x01', '\x0a\x00\x00\x02'
+
+def _ip(src, dst, tcp):
+    # (the importer doesn't check checksums.)
+    return struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp), 0, 0x4000,
+                       64, 6, 0, src, dst) + tcp
+
+def _packet(src, sport, dst, dport, seq, flags, payload=''):
+    tcp = struct.pack('>HHIIBBHHH', sport, dport, seq, 0, 5 << 4, flags,
+                      8192, 0, 0) + payload
+    return '\x00' * 12 + '\x08\x00' + _ip(src, dst, tcp)
+
+class _Conversation:
+    """
+    Build the packets of a TCP connection, one side at a time.
+    """
+    def __init__(self, cport, sport=80, client=CLIENT, server=SERVER):
+        self.ends = { 'c' : (client, cport), 's' : (server, sport) }
+        self.seq = { 'c' : 1000, 's' : 50000 }
+
+    def send(self, side, flags, payload=''):
+        """
+        Return a packet from 'side', with the next sequence number.
+        """
+        other = side == 'c' and 's' or 'c'
+        (src, sport), (dst, dport) = self.ends[side], self.ends[other]
+        packet = _packet(src, sport, dst, dport, self.seq[side], flags,
+                         payload)
+        self.seq[side] += len(payload) + (flags & 0x03 and 1 or 0)
+        return packet
+
+    def handshake(self):
+        return [ self.send('c', 0x02), self.send('s', 0x12),
+                 self.send('c', 0x10) ]
+
+def _pcap(packets, start=1000):
+    data = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+    for (n, packet) in enumerate(packets):
+        data += struct.pack('<IIII', start + n, 500000, len(packet),
+                            len(packet)) + packet
+    return data
+
+def _pcapng(packets, start=1000):
+    def block(block_type, body):
+        body += '\x00' * (-len(body) % 4)
+        length = len(body) + 12
+        return struct.pack('<II', block_type, length) + body + \
+               struct.pack('<I', length)
+
+    data = block(0x0a0d0d0a, struct.pack('<IHHq', 0x1a2b3c4d, 1, 0, -1))
+    data += block(1, struct.pack('<HHI', 1, 0, 65535) +
+                  struct.pack('<HHB3x', 9, 1, 3) + '\x00' * 4)
+    for (n, packet) in enumerate(packets):
+        ms = (start + n) * 1000 + 500
+        data += block(6, struct.pack('<IIIII', 0, ms >> 32, ms & 0xffffffff,
+                                     len(packet), len(packet)) + packet)
+    return data
+
+def _capture():
+    """
+    A keep-alive connection with a chunked response, reordered &
+    retransmitted segments, and a POST; an HTTP/1.0 connection ended by
+    the server; and an HTTPS connection.
+    """
+    a = _Conversation(40000)
+    packets = a.handshake()
+    packets.append(a.send('c', 0x18, 'GET /one?x=1 HTTP/1.1\r\n'
+                                     'Host: example.com\r\n'
+                                     'User-Agent: test\r\n\r\n'))
+
+    first = a.send('s', 0x18, 'HTTP/1.1 200 OK\r\nContent-Type: text/html'
+                              '\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nhe')
+    second = a.send('s', 0x18, 'llo\r\n6\r\n world\r\n')
+    third = a.send('s', 0x18, '0\r\n\r\n')
+    packets.extend([first, third, second, second])
+
+    b = _Conversation(40001)
+    packets.extend(b.handshake())
+    packets.append(b.send('c', 0x18, 'GET http://other.com:8080/two '
+                                     'HTTP/1.0\r\n\r\n'))
+
+    packets.append(a.send('c', 0x18, 'POST /three HTTP/1.1\r\n'
+                                     'Host: example.com\r\n'
+                                     'Content-Type: application/'
+                                     'x-www-form-urlencoded\r\n'
+                                     'Content-Length: 7\r\n\r\na=1'))
+    packets.append(a.send('c', 0x18, '&b=2'))
+
+    packets.append(b.send('s', 0x18, 'HTTP/1.0 404 Not Found\r\n\r\nno'))
+    packets.append(b.send('s', 0x19, 'pe'))
+
+    c = _Conversation(40002, 443)
+    packets.extend(c.handshake())
+    packets.append(c.send('c', 0x18, '\x16\x03\x01\x02\x00\x01'))
+
+    packets.append(a.send('s', 0x18, 'HTTP/1.1 302 Found\r\n'
+                                     'Location: /one\r\n'
+                                     'Content-Length: 0\r\n\r\n'))
+    packets.append(a.send('c', 0x11))
+    packets.append(a.send('s', 0x11))
+    return packets
+
+def _check(records):
+    assert len(records) == 3, records
+    (one, two, three) = records
+
+    assert one.environ['PATH_INFO'] == 'http://example.com/one'
+    assert one.environ['QUERY_STRING'] == 'x=1'
+    assert one.environ['HTTP_USER_AGENT'] == 'test'
+    assert one.environ['REMOTE_ADDR'] == '10.0.0.1'
+    assert one.environ['SERVER_NAME'] == 'example.com'
+    assert one.response.status == '200 OK'
+    assert one.response.headers == [('Content-Type', 'text/html')]
+    assert one.response.get_output() == 'hello world'
+    assert one.timestamp == 1006.5
+
+    assert two.environ['PATH_INFO'] == 'http://other.com:8080/two'
+    assert two.environ['SERVER_PORT'] == '8080'
+    assert two.response.status == '404 Not Found'
+    assert two.response.get_output() == 'nope'
+
+    assert three.is_post()
+    assert three.inp == 'a=1&b=2'
+    assert three.environ['CONTENT_LENGTH'] == '7'
+    assert three.response.is_redirect()
+
+class TestPcap:
+    def test_pcap(self):
+        """
+        Reassemble & parse the transactions in a pcap file.
+        """
+        _check(list(pcap.read_pcap(StringIO(_pcap(_capture())))))
+
+    def test_pcapng(self):
+        """
+        Read the same capture, saved as pcapng.
+        """
+        _check(list(pcap.read_pcap(StringIO(_pcapng(_capture())))))
+
+    def test_jobs(self):
+        """
+        Split a capture between processes, & merge the records.
+        """
+        (fd, filename) = tempfile.mkstemp(suffix='.pcap')
+        try:
+            os.write(fd, _pcap(_capture()))
+            os.close(fd)
+            _check(list(pcap.read_pcap_file(filename, jobs=2)))
+        finally:
+            os.unlink(filename)
+
+    def test_order(self):
+        """
+        Put a response that's only finished when its connection is
+        forgotten, idle or at the end of the capture, in timestamp order.
+        """
+        a = _Conversation(40000)
+        packets = a.handshake()
+        packets.append(a.send('c', 0x18, 'GET /slow HTTP/1.0\r\n\r\n'))
+        packets.append(a.send('s', 0x18, 'HTTP/1.0 200 OK\r\n\r\nstart'))
+
+        b = _Conversation(40001)
+        packets.extend(b.handshake())
+        packets.append(b.send('c', 0x18, 'GET /fast HTTP/1.1\r\n'
+                                         'Host: x\r\n\r\n'))
+        packets.append(b.send('s', 0x18, 'HTTP/1.1 200 OK\r\n'
+                                         'Content-Length: 4\r\n\r\ndone'))
+
+        def paths(records):
+            stamps = [ r.timestamp for r in records ]
+            assert stamps == sorted(stamps), stamps
+            return [ r.environ['PATH_INFO'] for r in records ]
+
+        for idle in (3, 300):
+            records = list(pcap.read_pcap(StringIO(_pcap(packets)), idle))
+            assert paths(records) == ['http://10.0.0.2/slow',
+                                      'http://x/fast'], (idle, records)
+            assert records[0].response.get_output() == 'start'
+
+        (fd, filename) = tempfile.mkstemp(suffix='.pcap')
+        try:
+            os.write(fd, _pcap(packets))
+            os.close(fd)
+            records = list(pcap.read_pcap_file(filename, jobs=2))
+            assert len(paths(records)) == 2
+        finally:
+            os.unlink(filename)
+
+    def test_lost_data(self):
+        """
+        Skip a connection with a segment missing from the capture.
+        """
+        a = _Conversation(40000)
+        packets = a.handshake()
+        a.send('c', 0x18, 'GET / HTTP/1.1\r\n')
+        packets.append(a.send('c', 0x18, 'Host: x\r\n\r\n'))
+        packets.append(a.send('s', 0x18, 'HTTP/1.1 200 OK\r\n'
+                                         'Content-Length: 0\r\n\r\n'))
+
+        assert list(pcap.read_pcap(StringIO(_pcap(packets)))) == []
+
+    def test_not_a_capture(self):
+        """
+        Complain about a file that isn't a capture.
+        """
+        try:
+            pcap.read_packets(StringIO('not a capture'))
+            assert 0, "should have raised PcapError"
+        except pcap.PcapError:
+            pass
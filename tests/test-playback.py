@@ -0,0 +1,82 @@
+import _testlib
+_testlib._add_scotchdir_to_path()
+
+from cStringIO import StringIO
+
+from _testlib import make_record
+from scotch.recorder import RecordHolder
+from scotch.playback import PlaybackApp
+
+def _make_environ(url, query='', method='GET', body=''):
+    return { 'PATH_INFO' : url,
+             'QUERY_STRING' : query,
+             'REQUEST_METHOD' : method,
+             'CONTENT_LENGTH' : str(len(body)),
+             'CONTENT_TYPE' : 'application/x-www-form-urlencoded',
+             'wsgi.input' : StringIO(body) }
+
+def _run_app(app, environ):
+    response = {}
+    def start_response(status, headers):
+        response['status'] = status
+
+    body = "".join(app(environ, start_response))
+    return response['status'], body
+
+class TestPlayback:
+    def setup(self):
+        self.record_holder = RecordHolder()
+        for record in (make_record('http://x/a', 'A1'),
+                       make_record('http://x/a', 'A2'),
+                       make_record('http://x/q', 'Q', query='b=2&a=1'),
+                       make_record('http://x/f', 'F', method='POST',
+                                   inp='x=1&y=2')):
+            self.record_holder.add_record(record)
+
+    def test_match(self):
+        """
+        Match on URL, normalized query string, and normalized form data.
+        """
+        app = PlaybackApp(self.record_holder, fallback=())
+
+        assert _run_app(app, _make_environ('http://x/q', 'a=1&b=2')) == \
+               ('200 OK', 'Q')
+        assert _run_app(app, _make_environ('http://x/f', method='POST',
+                                           body='y=2&x=1')) == ('200 OK', 'F')
+
+        status, body = _run_app(app, _make_environ('http://x/q', 'a=2'))
+        assert status.startswith('404')
+        assert app.misses == ['GET http://x/q?a=2']
+
+    def test_fallback(self):
+        """
+        Fall back on looser matches.
+        """
+        app = PlaybackApp(self.record_holder, fallback=('no-body', 'no-query'))
+
+        assert _run_app(app, _make_environ('http://x/f', method='POST',
+                                           body='x=3')) == ('200 OK', 'F')
+        assert _run_app(app, _make_environ('http://x/q', 'c=3')) == \
+               ('200 OK', 'Q')
+
+    def test_ignore_params(self):
+        """
+        Ignore cache-busting parameters.
+        """
+        app = PlaybackApp(self.record_holder, ignore_params=['_'])
+        assert _run_app(app, _make_environ('http://x/q', 'a=1&_=123&b=2')) \
+               == ('200 OK', 'Q')
+
+    def test_sequence(self):
+        """
+        Play back repeated requests in order, then repeat/cycle/stop.
+        """
+        def play(sequence):
+            app = PlaybackApp(self.record_holder, sequence=sequence)
+            return [ _run_app(app, _make_environ('http://x/a'))[1]
+                     for i in range(3) ]
+
+        assert play('repeat') == ['A1', 'A2', 'A2']
+        assert play('cycle') == ['A1', 'A2', 'A1']
+        assert play('strict')[:2] == ['A1', 'A2']
+        assert play('strict')[2].startswith('no recorded response')
@@ -0,0 +1,892 @@
+import _testlib
+_testlib._add_scotchdir_to_path()
+
+import os, threading, BaseHTTPServer, SocketServer, httplib
+from wsgiref.simple_server import WSGIRequestHandler
+from cStringIO import StringIO
+
+import socket
+import scotch.proxy, scotch.pool, scotch.resolver, scotch.recorder
+import scotch.async_proxy, scotch.server, scotch.cache, scotch.metrics
+import scotch.trace
+
+###
+
+class _UpstreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    A minimal HTTP/1.1 server that answers with Content-Length or
+    chunked bodies.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.n_connections += 1
+
+    def do_GET(self):
+        self.server.n_requests += 1
+
+        if 'etag' in self.path and \
+           self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            return
+
+        body = 'hello, world: %s\n' % (self.path,)
+        if self.path.startswith('/big'):
+            body = 'x' * 100000
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain')
+
+        accept_encoding = self.headers.get('Accept-encoding', '')
+        self.send_header('X-Accept-encoding', accept_encoding)
+        if 'gzip' in self.path and 'gzip' in accept_encoding:
+            body = _gzip(body)
+            self.send_header('Content-encoding', 'gzip')
+
+        if 'max-age' in self.path:
+            self.send_header('Cache-Control', 'max-age=60')
+        elif 'etag' in self.path:
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('ETag', '"v1"')
+
+        if 'chunked' in self.path:
+            self.send_header('Transfer-encoding', 'chunked')
+            self.end_headers()
+            for piece in (body[:5], body[5:]):
+                self.wfile.write('%x\r\n%s\r\n' % (len(piece), piece))
+            self.wfile.write('0\r\nX-Trailer: yes\r\n\r\n')
+        else:
+            self.send_header('Content-length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def do_POST(self):
+        n = int(self.headers.get('Content-length', 0))
+        body = 'VALUE WAS: %s' % (self.rfile.read(n),)
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain')
+        self.send_header('Content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def _gzip(s):
+    import gzip
+    fp = StringIO()
+    gz = gzip.GzipFile(fileobj=fp, mode='wb')
+    gz.write(s)
+    gz.close()
+    return fp.getvalue()
+
+class _UpstreamServer(BaseHTTPServer.HTTPServer):
+    def handle_error(self, request, client_address):
+        pass                    # clients hang up on us on purpose.
+
+class _ThreadingUpstreamServer(SocketServer.ThreadingMixIn, _UpstreamServer):
+    daemon_threads = True
+
+def _start_upstream(server_class=_UpstreamServer):
+    server = server_class(('127.0.0.1', 0), _UpstreamHandler)
+    server.n_connections = 0
+    server.n_requests = 0
+
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+
+    return server
+
+def _make_environ(url, method='GET', body=''):
+    return { 'PATH_INFO' : url,
+             'QUERY_STRING' : '',
+             'REQUEST_METHOD' : method,
+             'SERVER_PROTOCOL' : 'HTTP/1.0',
+             'CONTENT_LENGTH' : str(len(body)),
+             'CONTENT_TYPE' : 'application/x-www-form-urlencoded',
+             'HTTP_CONNECTION' : 'close',
+             'wsgi.input' : StringIO(body) }
+
+def _run_app(app, environ):
+    response = {}
+    def start_response(status, headers):
+        response['status'] = status
+        response['headers'] = headers
+
+    body = "".join(app(environ, start_response))
+    return response['status'], response['headers'], body
+
+###
+
+class TestProxy:
+    def setup(self):
+        self.server = _start_upstream()
+        self.base = 'http://127.0.0.1:%d' % (self.server.server_address[1],)
+        self.app = scotch.proxy.ProxyApp()
+
+    def teardown(self):
+        self.app.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+        # every request should have given back its scheduler slot.
+        assert self.app.scheduler.n_active == 0
+
+    def test_content_length(self):
+        """
+        Relay a Content-Length-delimited response.
+        """
+        status, headers, body = _run_app(self.app,
+                                         _make_environ(self.base + '/a'))
+        assert status == '200 OK'
+        assert body == 'hello, world: /a\n'
+
+    def test_chunked(self):
+        """
+        Relay a chunked response, de-chunked & without hop-by-hop headers.
+        """
+        status, headers, body = _run_app(self.app,
+                                     _make_environ(self.base + '/chunked'))
+        assert body == 'hello, world: /chunked\n', body
+
+        names = [ k.lower() for (k, v) in headers ]
+        assert 'transfer-encoding' not in names
+
+    def test_post(self):
+        """
+        Forward POST data.
+        """
+        environ = _make_environ(self.base + '/', 'POST', 'test=howdy')
+        status, headers, body = _run_app(self.app, environ)
+
+        assert body == 'VALUE WAS: test=howdy', body
+
+    def test_keepalive(self):
+        """
+        Reuse a single upstream connection for several requests.
+        """
+        for path in ('/a', '/chunked', '/b'):
+            _run_app(self.app, _make_environ(self.base + path))
+
+        assert self.server.n_connections == 1, self.server.n_connections
+
+    def test_stale_connection(self):
+        """
+        Retry on a fresh connection when the pooled one has gone away.
+        """
+        _run_app(self.app, _make_environ(self.base + '/a'))
+
+        # kill the idle connection behind the pool's back.
+        for conns in self.app.pool.idle.values():
+            for conn in conns:
+                conn.sock.shutdown(2)
+
+        status, headers, body = _run_app(self.app,
+                                         _make_environ(self.base + '/b'))
+        assert body == 'hello, world: /b\n'
+        assert self.server.n_connections == 2
+
+    def test_large_post(self):
+        """
+        Stream a POST body larger than a block, on a reused connection.
+        """
+        _run_app(self.app, _make_environ(self.base + '/a'))
+
+        value = 'y' * 50000
+        environ = _make_environ(self.base + '/', 'POST', 'test=' + value)
+        status, headers, body = _run_app(self.app, environ)
+
+        assert body == 'VALUE WAS: test=' + value
+        assert self.server.n_connections == 1
+
+    def test_streaming(self):
+        """
+        Call start_response before the body is read, & relay the body
+        in blocks.
+        """
+        response = {}
+        def start_response(status, headers):
+            response['status'] = status
+
+        body = self.app(_make_environ(self.base + '/big/chunked'),
+                        start_response)
+        assert response['status'] == '200 OK'
+
+        blocks = list(body)
+        assert len(blocks) > 1
+        assert "".join(blocks) == 'x' * 100000
+
+        # the connection went back into the pool.
+        assert len(self.app.pool.idle.values()[0]) == 1
+
+    def test_close_early(self):
+        """
+        Don't reuse a connection whose response wasn't read completely.
+        """
+        body = self.app(_make_environ(self.base + '/big'),
+                        lambda status, headers: None)
+        body.next()
+        body.close()
+
+        assert not self.app.pool.idle
+
+    def test_garbage_response(self):
+        """
+        Answer 502 when the server doesn't speak HTTP.
+        """
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+
+        def serve():
+            (sock, _) = listener.accept()
+            sock.recv(65536)
+            sock.sendall('SSH-2.0-OpenSSH\r\n\r\n')
+            sock.close()
+        t = threading.Thread(target=serve)
+        t.start()
+
+        try:
+            url = 'http://127.0.0.1:%d/' % (listener.getsockname()[1],)
+            status, headers, body = _run_app(self.app, _make_environ(url))
+        finally:
+            t.join()
+            listener.close()
+
+        assert status == '502 Bad Gateway', status
+        assert 'bad response head' in body
+
+class TestCompression:
+    def setup(self):
+        self.server = _start_upstream()
+        self.base = 'http://127.0.0.1:%d' % (self.server.server_address[1],)
+
+        self.record_holder = scotch.recorder.RecordHolder()
+        self.app = scotch.proxy.ProxyApp(compression='passthrough')
+        self.recorder = scotch.recorder.Recorder(self.app,
+                                          record_holder=self.record_holder)
+
+    def teardown(self):
+        self.app.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _get(self, path, accept_encoding):
+        environ = _make_environ(self.base + path)
+        environ['HTTP_ACCEPT_ENCODING'] = accept_encoding
+        environ['wsgi.errors'] = StringIO()
+
+        status, headers, body = _run_app(self.recorder, environ)
+        return body, dict([ (k.lower(), v) for (k, v) in headers ])
+
+    def test_passthrough(self):
+        """
+        Pass gzipped bodies through untouched; decode them on demand.
+        """
+        body, headers = self._get('/gzip', 'br, gzip;q=0.9')
+
+        assert headers['x-accept-encoding'] == 'gzip;q=0.9'
+        assert headers['content-encoding'] == 'gzip'
+        assert body == _gzip('hello, world: /gzip\n')
+
+        response = self.record_holder[0].response
+        assert response.get_output() == body
+        assert response.get_decoded_output() == 'hello, world: /gzip\n'
+
+    def test_identity(self):
+        """
+        Ask for identity encoding if the client can't take gzip/deflate.
+        """
+        body, headers = self._get('/gzip', 'br')
+
+        assert headers['x-accept-encoding'] == 'identity'
+        assert body == 'hello, world: /gzip\n'
+        assert self.record_holder[0].response.get_decoded_output() == body
+
+class TestCache:
+    def setup(self):
+        self.server = _start_upstream()
+        self.base = 'http://127.0.0.1:%d' % (self.server.server_address[1],)
+
+        self.cache = scotch.cache.HTTPCache(max_memory=250000)
+        self.app = scotch.proxy.ProxyApp(cache=self.cache)
+
+    def teardown(self):
+        self.app.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _get(self, path, cache_control=None):
+        environ = _make_environ(self.base + path)
+        if cache_control is not None:
+            environ['HTTP_CACHE_CONTROL'] = cache_control
+        status, headers, body = _run_app(self.app, environ)
+        return body, dict([ (k.lower(), v) for (k, v) in headers ])
+
+    def test_fresh(self):
+        """
+        Serve fresh responses from the cache.
+        """
+        body, headers = self._get('/max-age')
+        assert headers['x-cache'] == 'MISS'
+
+        body2, headers = self._get('/max-age')
+        assert headers['x-cache'] == 'HIT'
+        assert body2 == body == 'hello, world: /max-age\n'
+
+        assert self.server.n_requests == 1
+
+    def test_request_max_age(self):
+        """
+        Go back to the server when the request won't take a response that
+        old (a browser reload sends max-age=0) or one that's about to go
+        stale.
+        """
+        self._get('/max-age')
+        assert self._get('/max-age', 'max-age=30')[1]['x-cache'] == 'HIT'
+
+        body, headers = self._get('/max-age', 'max-age=0')
+        assert headers['x-cache'] == 'MISS'
+        assert body == 'hello, world: /max-age\n'
+        assert self.server.n_requests == 2
+
+        body, headers = self._get('/max-age', 'min-fresh=120')
+        assert headers['x-cache'] == 'MISS'
+        assert self.server.n_requests == 3
+
+        self._get('/etag')
+        body, headers = self._get('/etag', 'max-age=0')
+        assert headers['x-cache'] == 'REVALIDATED'
+
+    def test_max_stale(self):
+        """
+        Serve stale responses to requests that allow them with max-stale,
+        unless the server said they must be revalidated.
+        """
+        import time
+        then = time.time() - 100
+        entry = scotch.cache.CacheEntry('http://x/', '200 OK',
+                                        [('Cache-Control', 'max-age=60')],
+                                        [], then, then)
+
+        assert not entry.is_fresh()
+        assert entry.is_fresh(request_directives={ 'max-stale' : None })
+        assert entry.is_fresh(request_directives={ 'max-stale' : '60' })
+        assert not entry.is_fresh(request_directives={ 'max-stale' : '10' })
+
+        entry.headers = [('Cache-Control', 'max-age=60, must-revalidate')]
+        assert not entry.is_fresh(request_directives={ 'max-stale' : None })
+
+    def test_uncacheable(self):
+        """
+        Don't cache responses without freshness information or validators.
+        """
+        self._get('/a')
+        body, headers = self._get('/a')
+
+        assert headers['x-cache'] == 'MISS'
+        assert self.server.n_requests == 2
+
+    def test_revalidate(self):
+        """
+        Revalidate 'no-cache' responses with If-None-Match.
+        """
+        self._get('/etag')
+        body, headers = self._get('/etag')
+
+        assert headers['x-cache'] == 'REVALIDATED'
+        assert body == 'hello, world: /etag\n'
+        assert self.server.n_requests == 2
+
+    def test_post_invalidates(self):
+        """
+        Throw out the cached copy of a URL when something is POSTed to it.
+        """
+        self._get('/max-age')
+        _run_app(self.app, _make_environ(self.base + '/max-age', 'POST', 'x'))
+
+        body, headers = self._get('/max-age')
+        assert headers['x-cache'] == 'MISS'
+
+    def test_lru(self):
+        """
+        Evict the least-recently-used response when memory runs out.
+        """
+        self._get('/big/max-age/1')
+        self._get('/big/max-age/2')
+        self._get('/big/max-age/1')
+        self._get('/big/max-age/3')             # pushes out #2.
+
+        assert self._get('/big/max-age/1')[1]['x-cache'] == 'HIT'
+        assert self._get('/big/max-age/2')[1]['x-cache'] == 'MISS'
+        assert self.cache.memory_used <= 250000
+
+    def test_disk(self):
+        """
+        Keep large responses on disk.
+        """
+        import tempfile, shutil
+
+        directory = tempfile.mkdtemp()
+        try:
+            cache = scotch.cache.HTTPCache(max_memory=0, directory=directory)
+            cache.MAX_MEMORY_ENTRY = 1000
+            self.app.cache = cache
+
+            body, headers = self._get('/big/max-age')
+            assert len(os.listdir(directory)) == 1
+
+            body2, headers = self._get('/big/max-age')
+            assert headers['x-cache'] == 'HIT'
+            assert body2 == body
+
+            cache.clear()
+            assert os.listdir(directory) == []
+
+            # files left over from an earlier run are cleared out.
+            open(os.path.join(directory, 'entry-old'), 'wb').write('x')
+            open(os.path.join(directory, 'other'), 'wb').write('x')
+            cache = scotch.cache.HTTPCache(directory=directory)
+            assert os.listdir(directory) == ['other']
+        finally:
+            shutil.rmtree(directory)
+
+    def test_client_gone(self):
+        """
+        Close the response when the client stops reading it.
+        """
+        closed = []
+        def blocks():
+            try:
+                yield 'a'
+                yield 'b'
+            finally:
+                closed.append(True)
+
+        entry = scotch.cache.CacheEntry('http://x/', '200 OK', [], [], 0, 0)
+        inner = blocks()
+        body = self.cache.iter_store(entry, inner)
+        assert body.next() == 'a'
+        body.close()
+
+        assert closed == [True]
+        assert len(self.cache) == 0
+
+class TestMetrics:
+    def setup(self):
+        self.server = _start_upstream()
+        self.base = 'http://127.0.0.1:%d' % (self.server.server_address[1],)
+
+        self.registry = scotch.metrics.Registry()
+        self.proxy_app = scotch.proxy.ProxyApp(metrics=self.registry)
+        self.app = scotch.recorder.Recorder(self.proxy_app,
+                                            metrics=self.registry)
+
+    def teardown(self):
+        self.proxy_app.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_proxy_metrics(self):
+        """
+        Count & time proxied and recorded requests.
+        """
+        for environ in (_make_environ(self.base + '/a'),
+                        _make_environ(self.base + '/b', 'POST', 'x=1'),
+                        _make_environ('ftp://example.com/')):
+            environ['wsgi.errors'] = StringIO()
+            _run_app(self.app, environ)
+
+        metrics = self.registry.by_name
+        assert metrics['scotch_proxy_requests_total'].values() == \
+               { ('2xx',) : 2, ('4xx',) : 1 }
+        assert metrics['scotch_proxy_bytes_total'].values() == \
+               { ('in',) : 3, ('out',) : 31 }
+        assert metrics['scotch_proxy_active_requests'].values() == \
+               { () : 0 }
+        assert metrics['scotch_proxy_upstream_ttfb_seconds'].values()[1] == 2
+        assert metrics['scotch_proxy_request_seconds'].values()[1] == 3
+
+        assert metrics['scotch_recorder_records_total'].values() == \
+               { () : 3 }
+        assert metrics['scotch_recorder_bytes_total'].values() == \
+               { () : 34 }
+        assert metrics['scotch_recorder_in_flight'].values() == { () : 0 }
+
+        text = self.registry.render()
+        assert 'scotch_proxy_upstream_connect_seconds_count 1\n' in text
+        assert 'scotch_proxy_idle_connections 1\n' in text
+
+class TestTrace:
+    def setup(self):
+        self.server = _start_upstream()
+        self.base = 'http://127.0.0.1:%d' % (self.server.server_address[1],)
+        self.proxy_app = scotch.proxy.ProxyApp()
+
+        import tempfile
+        (fd, self.filename) = tempfile.mkstemp()
+        os.close(fd)
+
+    def teardown(self):
+        self.proxy_app.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        os.unlink(self.filename)
+
+    def test_spans(self):
+        """
+        Write the phases of traced requests out as trace events.
+        """
+        import json
+
+        tracer = scotch.trace.Tracer(self.filename)
+        recorder = scotch.recorder.Recorder(self.proxy_app)
+        app = scotch.trace.TracingApp(recorder, tracer)
+
+        for url in ('/a', '/b'):
+            environ = _make_environ(self.base + url)
+            environ['wsgi.errors'] = StringIO()
+            _run_app(app, environ)
+        tracer.close()
+
+        events = json.load(open(self.filename))
+        names = [ e['name'] for e in events ]
+        assert names == ['capture', 'queue', 'dns', 'connect', 'send',
+                         'ttfb', 'parse', 'start_response', 'body',
+                         'serialize', 'request',
+                         'capture', 'queue', 'send', 'ttfb', 'parse',
+                         'start_response', 'body', 'serialize',
+                         'request'], names
+
+        request = events[10]
+        assert request['args']['url'] == self.base + '/a'
+        assert request['args']['status'] == '200 OK'
+        for e in events[:10]:
+            assert request['ts'] <= e['ts']
+            assert e['ts'] + e['dur'] <= request['ts'] + request['dur']
+
+        # the trace doesn't end up in the recording.
+        assert 'scotch.trace' not in recorder.record_holder[0].environ
+
+    def test_sampling(self):
+        """
+        Trace only a sample of the requests.
+        """
+        tracer = scotch.trace.Tracer(self.filename, sample_rate=0)
+        assert tracer.start() is None
+
+        tracer = scotch.trace.Tracer(self.filename, sample_rate=0.5)
+        n = len([ i for i in range(1000) if tracer.start() is not None ])
+        assert 350 < n < 650, n
+
+class TestConnectionPool:
+    def test_max_per_host(self):
+        """
+        Keep at most 'max_per_host' idle connections around.
+        """
+        server = _start_upstream()
+        host, port = server.server_address
+
+        pool = scotch.pool.ConnectionPool(max_per_host=1)
+        try:
+            c1 = pool.get(host, port, 5)
+            c2 = pool.get(host, port, 5)
+            pool.put(c1)
+            pool.put(c2)
+
+            assert len(pool.idle[(host, port)]) == 1
+        finally:
+            pool.close()
+            server.shutdown()
+            server.server_close()
+
+class TestResolver:
+    def test_cache(self):
+        """
+        Look each host up only once, & keep failures too.
+        """
+        resolver = scotch.resolver.Resolver()
+
+        lookups = []
+        def getaddrinfo(host, port, *args):
+            lookups.append(host)
+            if host == 'nowhere.invalid':
+                raise socket.gaierror(-2, 'Name or service not known')
+            return [ (socket.AF_INET, socket.SOCK_STREAM, 6, '', (ip, port))
+                     for ip in ('10.0.0.1', '10.0.0.2') ]
+
+        old, socket.getaddrinfo = socket.getaddrinfo, getaddrinfo
+        try:
+            for i in range(3):
+                addresses = resolver.resolve('example.com', 80)
+                assert addresses == [('10.0.0.1', 80), ('10.0.0.2', 80)]
+
+                try:
+                    resolver.resolve('nowhere.invalid', 80)
+                    assert 0, "should have failed"
+                except socket.gaierror:
+                    pass
+        finally:
+            socket.getaddrinfo = old
+
+        assert lookups == ['example.com', 'nowhere.invalid'], lookups
+
+    def test_bounded(self):
+        """
+        Only count hits when refreshing, & drop expired entries once the
+        cache is full.
+        """
+        resolver = scotch.resolver.Resolver(ttl=60)
+        resolver.MAX_ENTRIES = 8
+
+        def getaddrinfo(host, port, *args):
+            return [ (socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                      ('10.0.0.1', port)) ]
+
+        old, socket.getaddrinfo = socket.getaddrinfo, getaddrinfo
+        try:
+            for i in range(4):
+                resolver.resolve('old%d.example.com' % (i,), 80)
+            for (key, (expires, result)) in resolver.cache.items():
+                resolver.cache[key] = (expires - 120, result)
+
+            for i in range(8):
+                resolver.resolve('new%d.example.com' % (i,), 80)
+        finally:
+            socket.getaddrinfo = old
+
+        assert not resolver.hits
+        hosts = [ host for (host, port) in resolver.cache.keys() ]
+        assert len(hosts) <= 8, hosts
+        assert not [ h for h in hosts if h.startswith('old') ], hosts
+
+    def test_failover(self):
+        """
+        Connect to the next address when the first one is dead.
+        """
+        server = _start_upstream()
+        host, port = server.server_address
+
+        # nothing listens on the first address's port.
+        dead = socket.socket()
+        dead.bind(('127.0.0.1', 0))
+        dead_address = dead.getsockname()
+        dead.close()
+
+        try:
+            conn = scotch.pool.Connection(host, port, 5,
+                                          [dead_address, (host, port)])
+            assert conn.sock.getpeername() == (host, port)
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class TestAsyncProxy:
+    def setup(self):
+        self.server = _start_upstream()
+        self.base = 'http://127.0.0.1:%d' % (self.server.server_address[1],)
+
+        self.record_holder = scotch.recorder.RecordHolder()
+        self.proxy = scotch.async_proxy.ProxyServer(('127.0.0.1', 0),
+                                        record_holder=self.record_holder)
+
+        self.running = True
+        def serve():
+            while self.running:
+                self.proxy.handle_requests(0.05)
+        self.thread = threading.Thread(target=serve)
+        self.thread.start()
+
+    def teardown(self):
+        self.running = False
+        self.thread.join()
+        self.proxy.close_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _get(self, conn, path, method='GET', body=None):
+        headers = {}
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        conn.request(method, self.base + path, body, headers)
+        response = conn.getresponse()
+        return response.status, response.read()
+
+    def test_requests(self):
+        """
+        Relay several requests over one client connection, & record them.
+        """
+        conn = httplib.HTTPConnection(*self.proxy.socket.getsockname())
+
+        assert self._get(conn, '/a') == (200, 'hello, world: /a\n')
+        assert self._get(conn, '/chunked') == \
+               (200, 'hello, world: /chunked\n')
+
+        conn = httplib.HTTPConnection(*self.proxy.socket.getsockname())
+        assert self._get(conn, '/', 'POST', 'test=howdy') == \
+               (200, 'VALUE WAS: test=howdy')
+
+        assert self.server.n_connections == 1
+        assert len(self.record_holder) == 3
+
+        record = self.record_holder[2]
+        assert record.inp == 'test=howdy'
+        assert record.response.get_output() == 'VALUE WAS: test=howdy'
+
+    def test_slow_upload(self):
+        """
+        Don't time out a request body that's trickling in.
+        """
+        import time
+        self.proxy.TIMEOUT = 0.3
+
+        sock = socket.create_connection(self.proxy.socket.getsockname())
+        sock.sendall('POST %s/ HTTP/1.1\r\nHost: x\r\n'
+                     'Content-Length: 10\r\n\r\n' % (self.base,))
+        for c in '0123456789':
+            time.sleep(0.1)
+            sock.sendall(c)
+
+        response = httplib.HTTPResponse(sock)
+        response.begin()
+        assert response.status == 200
+        assert response.read() == 'VALUE WAS: 0123456789'
+        sock.close()
+
+    def test_client_flow(self):
+        """
+        Hold off reading a request body the server isn't taking, & drop
+        the rest of one the server answered early.
+        """
+        class FakeUpstream:
+            producer_fifo = ['block'] * 100
+            def send_body(self, data):
+                pass
+
+        proxy = scotch.async_proxy.ProxyServer(('127.0.0.1', 0))
+        (a, b) = socket.socketpair()
+        try:
+            client = scotch.async_proxy._ClientChannel(proxy, a, ('x', 0))
+            client.environ = { 'SERVER_PROTOCOL' : 'HTTP/1.1' }
+            client.inp = client.response = None
+            client.close_after = False
+            client.state = 'body'
+
+            client.upstream = FakeUpstream()
+            assert not client.readable()
+            client.upstream.producer_fifo = []
+            assert client.readable()
+
+            client.response_done()
+            assert client.state == 'closing'
+            client.collect_incoming_data('rest of the body')
+        finally:
+            proxy.close_all()
+            b.close()
+
+    def test_bad_gateway(self):
+        """
+        Answer 502 when the server can't be reached.
+        """
+        dead = socket.socket()
+        dead.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:%d/' % (dead.getsockname()[1],)
+        dead.close()
+
+        conn = httplib.HTTPConnection(*self.proxy.socket.getsockname())
+        conn.request('GET', url)
+        assert conn.getresponse().status == 502
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class TestThreadedServer:
+    def setup(self):
+        self.server = _start_upstream(_ThreadingUpstreamServer)
+        self.base = 'http://127.0.0.1:%d' % (self.server.server_address[1],)
+
+        self.record_holder = scotch.recorder.RecordHolder()
+        app = scotch.recorder.Recorder(scotch.proxy.ProxyApp(),
+                                       record_holder=self.record_holder)
+
+        self.httpd = scotch.server.make_server(('127.0.0.1', 0), app,
+                                               _QuietHandler, threads=4)
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       args=(0.05,))
+        self.thread.start()
+
+    def teardown(self):
+        self.httpd.shutdown()
+        self.thread.join()
+        self.httpd.server_close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_concurrent(self):
+        """
+        Serve & record simultaneous requests from the thread pool.
+        """
+        address = self.httpd.socket.getsockname()
+        results = []
+
+        def fetch(i):
+            conn = httplib.HTTPConnection(*address)
+            conn.request('GET', self.base + '/%d' % (i,))
+            results.append(conn.getresponse().read())
+            conn.close()
+
+        threads = [ threading.Thread(target=fetch, args=(i,))
+                    for i in range(8) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert sorted(results) == sorted([ 'hello, world: /%d\n' % (i,)
+                                           for i in range(8) ])
+        assert len(self.record_holder) == 8
+
+    def test_merge_segments(self):
+        """
+        Merge per-worker recordings back together in timestamp order.
+        """
+        import tempfile
+        from scotch.storage import save_records, RecordReader
+
+        def record(url, timestamp):
+            return scotch.recorder.Record({ 'PATH_INFO' : url }, '',
+                                          scotch.recorder.Response(),
+                                          timestamp=timestamp)
+
+        segments = [ [ record('/a', 1), record('/d', 4) ],
+                     [ record('/b', 2), record('/c', 3) ] ]
+
+        filenames = []
+        try:
+            for segment in segments:
+                (fd, filename) = tempfile.mkstemp()
+                filenames.append(filename)
+
+                fp = os.fdopen(fd, 'wb')
+                save_records(segment, fp)
+                fp.close()
+
+            fp = StringIO()
+            n = scotch.server.merge_segments(filenames, fp)
+        finally:
+            for filename in filenames:
+                os.unlink(filename)
+
+        assert n == 4
+        fp.seek(0)
+        merged = RecordReader(fp)
+
+        assert [ r.environ['PATH_INFO'] for r in merged ] == \
+               [ '/a', '/b', '/c', '/d' ]
@@ -0,0 +1,154 @@
+import _testlib
+_testlib._add_scotchdir_to_path()
+
+import os, tempfile, shutil
+
+from _testlib import make_record
+from scotch import storage, recordings
+
+def _nth_record(n, timestamp, host='x', client='10.0.0.1'):
+    return make_record('http://%s/%d' % (host, n), 'body %d' % (n,),
+                       method=n % 2 and 'POST' or 'GET',
+                       timestamp=timestamp,
+                       REMOTE_ADDR=client)
+
+def _numbers(records):
+    return [ int(r.response.get_output().split()[1]) for r in records ]
+
+class TestRecordings:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, records):
+        filename = os.path.join(self.tmpdir, name)
+        storage.save_records(records, open(filename, 'wb'))
+        return filename
+
+    def test_concatenate_select(self):
+        """
+        Read recordings one after another, & pick records out of them.
+        """
+        a = self._write('a', [ _nth_record(n, n) for n in range(0, 5) ])
+        b = self._write('b', [ _nth_record(n, n) for n in range(5, 10) ])
+
+        assert _numbers(recordings.concatenate([a, b])) == range(10)
+        assert _numbers(recordings.select([a, b], 3, 7)) == [3, 4, 5, 6]
+        assert _numbers(recordings.select([a, b], 5)) == [5, 6, 7, 8, 9]
+        assert _numbers(recordings.select([a, b], 7, 12)) == [7, 8, 9]
+        assert _numbers(recordings.select([a, b], 4, 4)) == []
+        assert _numbers(recordings.select([a, b], 12)) == []
+        assert _numbers(recordings.select([a, b], 2,
+                                          predicate=lambda r: r.is_post())) \
+               == [3, 5, 7, 9]
+
+    def test_merge(self):
+        """
+        Merge sorted & unsorted recordings, sorting in several runs and
+        merging in several passes.
+        """
+        a = self._write('a', [ _nth_record(n, n) for n in range(0, 20, 2) ])
+        times = [ 9, 3, 15, 1, 7, 3, 19, 11, 5, 13, 17 ]
+        b = self._write('b', [ _nth_record(100 + n, t)
+                               for (n, t) in enumerate(times) ])
+
+        fanin, recordings.FANIN = recordings.FANIN, 2
+        try:
+            merged = list(recordings.merge([a, b], run_bytes=3000,
+                                           tmpdir=self.tmpdir))
+        finally:
+            recordings.FANIN = fanin
+
+        stamps = [ r.timestamp for r in merged ]
+        assert stamps == sorted(range(0, 20, 2) + times), stamps
+
+        # ties keep their order: first by file, then within the file.
+        numbers = _numbers(merged)
+        assert numbers.index(101) < numbers.index(105)
+        assert numbers[:2] == [0, 103]
+
+        assert sorted(os.listdir(self.tmpdir)) == ['a', 'b']
+
+    def test_split(self):
+        """
+        Split recordings by host & by session, reopening files that had
+        to be closed.
+        """
+        records = [ _nth_record(n, n * 60, host='h%d' % (n % 3,),
+                                client='10.0.0.%d' % (n % 2,))
+                    for n in range(9) ]
+        outdir = os.path.join(self.tmpdir, 'out')
+
+        counts = recordings.split(records, recordings.by_host, outdir,
+                                  max_open=1)
+        assert counts == dict([ (os.path.join(outdir, 'host-h%d.scotch' % i),
+                                 3) for i in range(3) ])
+        assert _numbers(recordings.concatenate(
+            [os.path.join(outdir, 'host-h1.scotch')])) == [1, 4, 7]
+
+        shutil.rmtree(outdir)
+        counts = recordings.split(records, recordings.by_session(gap=100),
+                                  outdir)
+        assert len(counts) == 9              # 120s between each client's.
+
+        shutil.rmtree(outdir)
+        counts = recordings.split(records, recordings.by_session(gap=150),
+                                  outdir)
+        assert sorted(counts.values()) == [4, 5]
+
+    def test_legacy(self):
+        """
+        Merge, split & slice old pickled records, which have no timestamp.
+        """
+        from cPickle import dump
+        from scotch.recorder import RecordHolder
+
+        holder = RecordHolder()
+        for n in range(3):
+            record = _nth_record(n, None)
+            del record.timestamp
+            holder.add_record(record)
+
+        legacy = os.path.join(self.tmpdir, 'legacy')
+        dump(holder, open(legacy, 'wb'))
+        b = self._write('b', [ _nth_record(n, n) for n in range(3, 6) ])
+
+        merged = list(recordings.merge([b, legacy], tmpdir=self.tmpdir,
+                                       allow_pickle=True))
+        assert _numbers(merged) == [0, 1, 2, 3, 4, 5]
+
+        outdir = os.path.join(self.tmpdir, 'out')
+        for group in (recordings.by_time(60), recordings.by_session()):
+            counts = recordings.split(recordings.concatenate(
+                [legacy], allow_pickle=True), group, outdir)
+            assert counts.values() == [3], counts
+            shutil.rmtree(outdir)
+
+        assert _numbers(recordings.select([legacy, b], 2, 4,
+                                          allow_pickle=True)) == [2, 3]
+        assert _numbers(recordings.select([legacy, b], 1,
+                                          predicate=lambda r: r.is_post(),
+                                          allow_pickle=True)) == [1, 3, 5]
+
+        try:
+            list(recordings.select([legacy]))
+            assert 0, "should have raised FormatError"
+        except storage.FormatError:
+            pass
+
+    def test_parse_range(self):
+        """
+        Parse record ranges.
+        """
+        assert recordings.parse_range('5') == (5, 5)
+        assert recordings.parse_range('5-') == (5, None)
+        assert recordings.parse_range('-7') == (1, 7)
+        assert recordings.parse_range('2-7') == (2, 7)
+        for bad in ('x', '0', '7-2'):
+            try:
+                recordings.parse_range(bad)
+                assert 0, "should have raised ValueError"
+            except ValueError:
+                pass
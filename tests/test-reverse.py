@@ -0,0 +1,127 @@
+import _testlib
+_testlib._add_scotchdir_to_path()
+
+from scotch.reverse import ReverseProxyApp, HTMLRewriter, CSSRewriter
+
+_html = '''<html><head>
+<link rel="stylesheet" href="/style.css">
+<style>body { background: url('/bg.png') }</style>
+<script>if (a<b && "</p>") { x = "/not/a/link"; }</script>
+</head><body>
+<!-- <a href="/in/comment"> -->
+<a href="/about" title="a > b">About</a>
+<a href='http://www.example.com/x?y=1'>X</a>
+<a href=http://elsewhere.com/>elsewhere</a>
+<img src="pic.png" style="background: url(/dot.gif)">
+<form action="//www.example.com/search"></form>
+</body></html>'''
+
+_rewritten = '''<html><head>
+<link rel="stylesheet" href="/ex/style.css">
+<style>body { background: url('/ex/bg.png') }</style>
+<script>if (a<b && "</p>") { x = "/not/a/link"; }</script>
+</head><body>
+<!-- <a href="/in/comment"> -->
+<a href="/ex/about" title="a > b">About</a>
+<a href='/ex/x?y=1'>X</a>
+<a href=http://elsewhere.com/>elsewhere</a>
+<img src="pic.png" style="background: url(/ex/dot.gif)">
+<form action="/ex/search"></form>
+</body></html>'''
+
+def _rewrite_url():
+    app = ReverseProxyApp({ '/ex' : 'http://www.example.com' },
+                          proxy_app=lambda e, s: [])
+    from scotch.reverse import URLRewriter
+    return URLRewriter(app.mounts, '', app.mounts[0])
+
+def _feed(rewriter, blocks):
+    out = [ rewriter.feed(block) for block in blocks ]
+    out.append(rewriter.close())
+    return "".join(out)
+
+class TestRewriters:
+    def test_html(self):
+        """
+        Rewrite links in HTML, leaving scripts & comments alone.
+        """
+        out = _feed(HTMLRewriter(_rewrite_url()), [_html])
+        assert out == _rewritten, out
+
+    def test_html_streaming(self):
+        """
+        Rewrite the same HTML fed in one byte at a time.
+        """
+        out = _feed(HTMLRewriter(_rewrite_url()), list(_html))
+        assert out == _rewritten, out
+
+    def test_css_streaming(self):
+        """
+        Rewrite url() and @import in CSS fed in small blocks.
+        """
+        css = '@import "/base.css";\na { background: url( "/a.png" ) }\n'
+        blocks = [ css[i:i+3] for i in range(0, len(css), 3) ]
+
+        out = _feed(CSSRewriter(_rewrite_url()), blocks)
+        assert out == '@import "/ex/base.css";\n' \
+                      'a { background: url( "/ex/a.png" ) }\n', out
+
+class TestReverseProxyApp:
+    def setup(self):
+        self.calls = []
+
+        def upstream(environ, start_response):
+            self.calls.append(environ)
+            path = environ['PATH_INFO']
+
+            if path.endswith('/old'):
+                start_response('302 Found',
+                         [('Location', 'http://docs.example.com/v2/new'),
+                          ('Set-Cookie', 'a=b; Domain=.example.com; Path=/v2')])
+                return []
+
+            body = '<a href="/v2/page">page</a>'
+            start_response('200 OK', [('Content-Type', 'text/html'),
+                                      ('Content-Length', str(len(body)))])
+            return [body[:5], body[5:]]
+
+        self.app = ReverseProxyApp({ '/docs' : 'http://docs.example.com/v2',
+                                     '/' : 'http://www.example.com' },
+                                   proxy_app=upstream)
+
+    def _run(self, path):
+        response = {}
+        def start_response(status, headers):
+            response['status'] = status
+            response['headers'] = headers
+
+        environ = { 'PATH_INFO' : path, 'SCRIPT_NAME' : '/site',
+                    'HTTP_HOST' : 'localhost', 'HTTP_ACCEPT_ENCODING' : 'gzip'}
+        body = "".join(self.app(environ, start_response))
+        return response['status'], dict(response['headers']), body
+
+    def test_mount(self):
+        """
+        Map prefixes onto origins & rewrite the HTML that comes back.
+        """
+        status, headers, body = self._run('/docs/index.html')
+
+        environ = self.calls[0]
+        assert environ['PATH_INFO'] == 'http://docs.example.com/v2/index.html'
+        assert environ['HTTP_HOST'] == 'docs.example.com'
+        assert not environ.has_key('HTTP_ACCEPT_ENCODING')
+
+        assert body == '<a href="/site/docs/page">page</a>', body
+        assert not headers.has_key('Content-Length')
+
+        self._run('/other')
+        assert self.calls[1]['PATH_INFO'] == 'http://www.example.com/other'
+
+    def test_headers(self):
+        """
+        Rewrite Location and Set-Cookie.
+        """
+        status, headers, body = self._run('/docs/old')
+
+        assert headers['Location'] == '/site/docs/new'
+        assert headers['Set-Cookie'] == 'a=b; Path=/site/docs'
@@ -0,0 +1,157 @@
+import _testlib
+_testlib._add_scotchdir_to_path()
+
+import time, socket, threading
+from cStringIO import StringIO
+
+import scotch.proxy
+from scotch.scheduler import Scheduler, QueueFull, QueueTimeout
+
+###
+
+def _wait_for(fn):
+    for i in range(200):
+        if fn():
+            return
+        time.sleep(0.01)
+    raise AssertionError("timed out")
+
+class TestScheduler:
+    def test_per_host_limit(self):
+        """
+        Hold requests to a busy host, but not to the others.
+        """
+        scheduler = Scheduler(max_per_host=1, queue_timeout=0.1)
+
+        slot = scheduler.acquire('a', 80)
+        other = scheduler.acquire('b', 80)          # a different host.
+
+        start = time.time()
+        try:
+            scheduler.acquire('a', 80)
+            assert 0, "should have timed out"
+        except QueueTimeout:
+            pass
+        assert time.time() - start < 1
+        assert scheduler.n_waiting == 0
+
+        scheduler.release(slot)
+        scheduler.release(scheduler.acquire('a', 80))
+        scheduler.release(other)
+        assert scheduler.n_active == 0 and not scheduler.active
+
+    def test_total_limit(self):
+        """
+        Hold requests once the proxy as a whole is at its limit.
+        """
+        scheduler = Scheduler(max_total=2, queue_timeout=0.1)
+
+        slots = [ scheduler.acquire('a', 80), scheduler.acquire('b', 80) ]
+        try:
+            scheduler.acquire('c', 80)
+            assert 0, "should have timed out"
+        except QueueTimeout:
+            pass
+
+        for slot in slots:
+            scheduler.release(slot)
+
+    def test_queue_full(self):
+        """
+        Turn requests away at once when too many are waiting.
+        """
+        scheduler = Scheduler(max_per_host=1, max_queue=0)
+        slot = scheduler.acquire('a', 80)
+
+        start = time.time()
+        try:
+            scheduler.acquire('a', 80)
+            assert 0, "should have been turned away"
+        except QueueFull:
+            pass
+        assert time.time() - start < 0.5
+
+        scheduler.release(slot)
+
+    def test_fairness(self):
+        """
+        Hand freed-up slots to the waiting sessions in turn.
+        """
+        scheduler = Scheduler(max_per_host=1)
+        slot = scheduler.acquire('a', 80)
+
+        order = []
+        def request(session):
+            s = scheduler.acquire('a', 80, session)
+            order.append(session)
+            scheduler.release(s)
+
+        threads = []
+        for session in ('x', 'x', 'x', 'y'):
+            t = threading.Thread(target=request, args=(session,))
+            t.start()
+            threads.append(t)
+
+            n = len(threads)
+            _wait_for(lambda: scheduler.n_waiting == n)
+
+        scheduler.release(slot)
+        for t in threads:
+            t.join()
+
+        assert order == ['x', 'y', 'x', 'x'], order
+
+class TestProxyTimeouts:
+    def setup(self):
+        # a server that accepts connections but never answers.
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.netloc = '127.0.0.1:%d' % (self.listener.getsockname()[1],)
+
+        self.read_timeout = scotch.proxy._ProxyRequest.READ_TIMEOUT
+        scotch.proxy._ProxyRequest.READ_TIMEOUT = 0.2
+
+    def teardown(self):
+        scotch.proxy._ProxyRequest.READ_TIMEOUT = self.read_timeout
+        self.listener.close()
+
+    def _get(self, app):
+        environ = { 'PATH_INFO' : 'http://%s/' % (self.netloc,),
+                    'QUERY_STRING' : '',
+                    'REQUEST_METHOD' : 'GET',
+                    'SERVER_PROTOCOL' : 'HTTP/1.0',
+                    'REMOTE_ADDR' : '127.0.0.1',
+                    'wsgi.input' : StringIO('') }
+        response = {}
+        def start_response(status, headers):
+            response['status'] = status
+
+        body = "".join(app(environ, start_response))
+        return response['status'], body
+
+    def test_gateway_timeout(self):
+        """
+        Answer with a 504 when the server doesn't respond in time.
+        """
+        app = scotch.proxy.ProxyApp()
+        (status, body) = self._get(app)
+
+        assert status.startswith('504'), status
+        assert app.scheduler.n_active == 0
+
+    def test_overloaded(self):
+        """
+        Answer with a 503 when the server's slots are all taken.
+        """
+        scheduler = Scheduler(max_per_host=1, queue_timeout=0.05)
+        app = scotch.proxy.ProxyApp(scheduler=scheduler)
+
+        host, port = self.netloc.split(':')
+        slot = scheduler.acquire(host, int(port))
+        try:
+            (status, body) = self._get(app)
+        finally:
+            scheduler.release(slot)
+
+        assert status.startswith('503'), status
@@ -0,0 +1,277 @@
+import _testlib
+_testlib._add_scotchdir_to_path()
+
+import sys, warnings
+from cStringIO import StringIO
+from cPickle import dump
+
+from _testlib import make_record
+from scotch.recorder import RecordHolder, Response, Recorder
+from scotch.tunnel import Tunnel
+from scotch import storage, utils
+
+def _nth_record(n, content_type='text/html', body=None):
+    if body is None:
+        body = 'body %d' % (n,)
+    return make_record('http://x/%d' % (n,), [body[:3], body[3:]],
+                       content_type=content_type, timestamp=n)
+
+def _save(records):
+    fp = StringIO()
+    storage.save_records(records, fp)
+    return StringIO(fp.getvalue())
+
+def _save_warned(records):
+    """
+    Save & load the records; return them, & the warnings given.
+    """
+    catcher = warnings.catch_warnings(record=True)
+    caught = catcher.__enter__()
+    try:
+        warnings.simplefilter('always')
+        loaded = list(storage.RecordReader(_save(records)))
+    finally:
+        catcher.__exit__()
+    return loaded, caught
+
+class TestStorage:
+    def test_roundtrip(self):
+        """
+        Save records & read them back, more than once.
+        """
+        records = [ _nth_record(n) for n in range(5) ]
+        records[2].response.get_decoded_output()     # not saved.
+
+        reader = storage.RecordReader(_save(records))
+        assert reader.version == storage.VERSION
+
+        for i in range(2):
+            loaded = list(reader)
+            assert len(loaded) == 5
+            for (r1, r2) in zip(records, loaded):
+                assert r1.environ == r2.environ
+                assert r1.timestamp == r2.timestamp
+                assert r1.response.status == r2.response.status
+                assert r1.response.get_output() == r2.response.get_output()
+                assert not hasattr(r2.response, '_decoded')
+
+        holder = storage.load_records(_save(records))
+        assert isinstance(holder, RecordHolder)
+        assert [ r.environ['PATH_INFO'] for r in holder ] == \
+               [ r.environ['PATH_INFO'] for r in records ]
+
+    def test_skip_bodies(self):
+        """
+        Start partway in, and leave the bodies on disk.
+        """
+        records = [ _nth_record(n, body='x' * n * 40000) for n in range(5) ]
+        reader = storage.RecordReader(_save(records))
+
+        loaded = list(reader.iter_records(start=3, bodies=False))
+        assert [ r.timestamp for r in loaded ] == [3, 4]
+        assert loaded[0].response.content_list is None
+        assert loaded[0].response.get_output_length() == 120000
+        assert records[4].response.get_output_length() == 160000
+
+        try:
+            storage.save_records(loaded, StringIO())
+            assert 0, "should have refused to save a record without its body"
+        except ValueError:
+            pass
+
+    def test_index(self):
+        """
+        Read records by number, in any order.
+        """
+        records = [ _nth_record(n) for n in range(5) ]
+        seen = []
+        index = storage.RecordIndex(storage.RecordReader(_save(records)),
+                                    lambda n, r: seen.append((n, r.timestamp)))
+
+        assert seen == [ (n, n) for n in range(5) ]
+        assert len(index) == 5
+        assert index[3].response.get_output() == 'body 3'
+        assert index[1].response.get_output() == 'body 1'
+        assert index[-1].timestamp == 4
+
+    def test_typed_environ(self):
+        """
+        Keep the types of environ values, & save the repr of what can't
+        be saved otherwise.
+        """
+        record = _nth_record(1)
+        record.environ.update({ 'wsgi.version' : (1, 0),
+                                'wsgi.multithread' : True,
+                                'wsgi.run_once' : False,
+                                'x.unicode' : u'caf\xe9',
+                                'x.list' : [1.5, None, 2 ** 70],
+                                u'x.key' : 'value',
+                                'HTTP_X_NUL' : 'a\0b' })
+        record.inp = 'a=1&b=\0'
+        record.response.errout = 'oops'
+
+        for i in range(2):                          # (the 2nd is cached.)
+            loaded = list(storage.RecordReader(_save([record])))[0]
+            assert loaded.environ == record.environ, loaded.environ
+            assert type(loaded.environ['wsgi.version']) is tuple
+            assert type(loaded.environ['x.list']) is list
+            assert loaded.inp == record.inp
+            assert loaded.response.errout == 'oops'
+            assert loaded.response.headers == record.response.headers
+
+        record.environ['wsgi.file_wrapper'] = Response
+        (loaded, caught) = _save_warned([record])
+        assert loaded[0].environ['wsgi.file_wrapper'] == repr(Response)
+        assert len(caught) == 1
+        assert 'wsgi.file_wrapper' in str(caught[0].message)
+
+    def test_recorded_object(self):
+        """
+        Save a recording whose environ has an object in it, as middleware
+        outside the Recorder might put there.
+        """
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['hello']
+
+        session = object()
+        def middleware(environ, start_response):
+            environ['beaker.session'] = session
+            return recorder(environ, start_response)
+
+        recorder = Recorder(app)
+        environ = { 'REQUEST_METHOD' : 'GET', 'PATH_INFO' : '/',
+                    'wsgi.input' : StringIO(''), 'wsgi.errors' : StringIO() }
+        list(middleware(environ, lambda status, headers: None))
+
+        (loaded, caught) = _save_warned(recorder.record_holder)
+        assert len(loaded) == 1
+        assert loaded[0].environ['beaker.session'] == repr(session)
+        assert loaded[0].response.get_output() == 'hello'
+
+    def test_tunnel(self):
+        """
+        Save & load a CONNECT record's tunnel metadata.
+        """
+        tunnel = Tunnel(object(), 'pending')
+        (tunnel.host, tunnel.port) = ('example.com', 443)
+        (tunnel.bytes_up, tunnel.bytes_down) = (517, 4096)
+        (tunnel.started, tunnel.duration) = (1234567890.5, 2.25)
+
+        record = _nth_record(1)
+        record.environ = { 'REQUEST_METHOD' : 'CONNECT',
+                           'PATH_INFO' : 'example.com:443',
+                           'scotch.tunnel' : tunnel }
+
+        loaded = list(storage.RecordReader(_save([record])))[0]
+        assert sorted(loaded.environ.keys()) == \
+               ['PATH_INFO', 'REQUEST_METHOD', 'scotch.tunnel']
+
+        copy = loaded.environ['scotch.tunnel']
+        assert isinstance(copy, Tunnel)
+        assert copy.client is None and copy.pending == ''
+        for field in ('host', 'port', 'bytes_up', 'bytes_down', 'started',
+                      'duration', 'error'):
+            assert getattr(copy, field) == getattr(tunnel, field), field
+        assert str(copy) == str(tunnel)
+
+    def test_version_1(self):
+        """
+        Write & read the pickled version 1 format.
+        """
+        records = [ _nth_record(n) for n in range(3) ]
+        fp = StringIO()
+        writer = storage.RecordWriter(fp, version=1)
+        for record in records:
+            writer.write(record)
+        reader = storage.RecordReader(StringIO(fp.getvalue()),
+                                      allow_pickle=True)
+
+        assert reader.version == 1
+        assert [ r.response.get_output() for r in reader ] == \
+               [ r.response.get_output() for r in records ]
+
+    def test_bad_record(self):
+        """
+        Complain about a corrupt record, rather than decoding garbage.
+        """
+        data = storage.encode_record(_nth_record(1))
+        for bad in (data[:10], data[:-1], data + 'x'):
+            try:
+                storage.decode_record(bad)
+                assert 0, "should have raised FormatError"
+            except storage.FormatError:
+                pass
+
+    def test_legacy_pickle(self):
+        """
+        Read an old pickled RecordHolder.
+        """
+        holder = RecordHolder()
+        for n in range(3):
+            holder.add_record(_nth_record(n))
+
+        fp = StringIO()
+        dump(holder, fp)
+
+        reader = storage.RecordReader(StringIO(fp.getvalue()),
+                                      allow_pickle=True)
+        assert reader.version == 0
+        assert [ r.timestamp for r in reader.iter_records(start=1) ] == [1, 2]
+
+        recorder = Recorder(None)
+        recorder.load(StringIO(fp.getvalue()), allow_pickle=True)
+        assert len(recorder.record_holder) == 3
+
+    def test_refuse_pickle(self):
+        """
+        Don't unpickle old recordings unless asked to.
+        """
+        holder = RecordHolder()
+        holder.add_record(_nth_record(0))
+        legacy = StringIO()
+        dump(holder, legacy)
+
+        v1 = StringIO()
+        storage.RecordWriter(v1, version=1).write(_nth_record(0))
+
+        for data in (legacy.getvalue(), v1.getvalue()):
+            try:
+                storage.RecordReader(StringIO(data))
+                assert 0, "should have raised FormatError"
+            except storage.FormatError:
+                pass
+
+    def test_truncated(self):
+        """
+        Complain about a truncated recording.
+        """
+        data = _save([ _nth_record(n) for n in range(2) ]).getvalue()
+        reader = storage.RecordReader(StringIO(data[:-3]))
+
+        try:
+            list(reader)
+            assert 0, "should have raised FormatError"
+        except storage.FormatError:
+            pass
+
+    def test_display_line(self):
+        """
+        Summarize a record read without its body, or its content type.
+        """
+        records = [ _nth_record(1, content_type=None) ]
+        record = storage.RecordReader(_save(records)).iter_records(
+            bodies=False).next()
+
+        assert not utils.filter_html_only(record)
+        assert utils.filter_only_primary_pages(record)
+
+        old, sys.stdout = sys.stdout, StringIO()
+        try:
+            utils.display_record_line(7, record)
+            line = sys.stdout.getvalue()
+        finally:
+            sys.stdout = old
+
+        assert line.split() == ['7', 'GET', '200', '6', '-', 'http://x/1'], \
+               line
@@ -0,0 +1,63 @@
+import _testlib
+_testlib._add_scotchdir_to_path()
+
+from _testlib import make_record
+import os, tempfile
+
+from scotch import storage, translate as translate_module
+from scotch.translate import translate, translate_file, translate_record
+
+class TestTranslate:
+    def test_multivalued(self):
+        """
+        Translate a form with a multi-valued field.
+        """
+        record = make_record('/search', method='POST', query='q=x',
+                             inp="color=red&color=blue&name=o'neil")
+        (client, timestamp, lines, redirect) = translate_record(3, record)
+
+        assert lines == [ '# record 3',
+                          "fv 1 q 'x'",
+                          "fv 1 color 'red'",
+                          "fv 1 color '+blue'",
+                          "fv 1 name 'o\\'neil'",
+                          'submit' ], lines
+        assert not redirect
+
+    def test_sessions(self):
+        """
+        Split by client & idle time, and skip the page a submit redirects
+        to.
+        """
+        records = [ make_record('/a', REMOTE_ADDR='1', timestamp=0),
+                    make_record('/login', status='302 Found',
+                                method='POST', inp='u=1', REMOTE_ADDR='1',
+                                timestamp=1),
+                    make_record('/b', REMOTE_ADDR='2', timestamp=2),
+                    make_record('/home', REMOTE_ADDR='1', timestamp=3),
+                    make_record('/c', REMOTE_ADDR='1', timestamp=4),
+                    make_record('/d', REMOTE_ADDR='1', timestamp=5000) ]
+
+        def commands(results):
+            return [ (session, lines[-1]) for (session, lines) in results ]
+
+        expected = [ (0, 'go /a'), (0, 'submit'), (1, 'go /b'),
+                     (0, 'go /c'), (2, 'go /d') ]
+        assert commands(translate(records)) == expected
+
+        (fd, filename) = tempfile.mkstemp()
+        fp = os.fdopen(fd, 'wb')
+        storage.save_records(records, fp)
+        fp.close()
+
+        block_size = translate_module.BLOCK_SIZE
+        translate_module.BLOCK_SIZE = 2
+        try:
+            assert commands(translate_file(filename)) == expected
+            assert commands(translate_file(filename, jobs=2)) == expected
+        finally:
+            translate_module.BLOCK_SIZE = block_size
+            os.unlink(filename)
+
+        assert [ s for (s, _) in commands(translate(records, gap=None)) ] \
+               == [0, 0, 0, 0, 0]
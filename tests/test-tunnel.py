@@ -0,0 +1,245 @@
+import _testlib
+_testlib._add_scotchdir_to_path()
+
+import socket, threading, SocketServer
+from cPickle import dumps, loads
+
+import scotch.proxy, scotch.recorder, scotch.server, scotch.tunnel
+
+###
+
+class _EchoHandler(SocketServer.BaseRequestHandler):
+    """
+    Echo everything back, upper-cased, until the client closes its end.
+    """
+    def setup(self):
+        SocketServer.BaseRequestHandler.setup(self)
+        self.server.n_connections += 1
+
+    def handle(self):
+        while 1:
+            data = self.request.recv(65536)
+            if not data:
+                break
+            self.request.sendall(data.upper())
+
+class _EchoServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _QuietHandler(scotch.tunnel.TunnelRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def _read_head(sock):
+    head = ''
+    while '\r\n\r\n' not in head:
+        data = sock.recv(1)
+        if not data:
+            break
+        head += data
+    return head
+
+def _recv_all(sock):
+    data = []
+    while 1:
+        s = sock.recv(65536)
+        if not s:
+            return "".join(data)
+        data.append(s)
+
+class TestTunnel:
+    def setup(self):
+        self.echo = _EchoServer(('127.0.0.1', 0), _EchoHandler)
+        self.echo.n_connections = 0
+        t = threading.Thread(target=self.echo.serve_forever)
+        t.setDaemon(True)
+        t.start()
+
+        self.record_holder = scotch.recorder.RecordHolder()
+        app = scotch.recorder.Recorder(scotch.proxy.ProxyApp(),
+                                       record_holder=self.record_holder)
+
+        self.httpd = scotch.server.make_server(('127.0.0.1', 0), app,
+                                               _QuietHandler, threads=2)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       args=(0.05,))
+        self.thread.start()
+
+    def teardown(self):
+        self.httpd.shutdown()
+        self.thread.join()
+        self.httpd.server_close()
+        self.echo.shutdown()
+        self.echo.server_close()
+
+    def _connect(self, authority, extra=''):
+        sock = socket.create_connection(self.httpd.socket.getsockname())
+        sock.sendall('CONNECT %s HTTP/1.1\r\nHost: %s\r\n\r\n%s' %
+                     (authority, authority, extra))
+        return sock
+
+    def test_relay(self):
+        """
+        Relay bytes both ways through a tunnel, and record its metadata.
+        """
+        authority = '127.0.0.1:%d' % (self.echo.server_address[1],)
+        sock = self._connect(authority, extra='early ')
+
+        head = _read_head(sock)
+        assert head.split()[1] == '200', head
+
+        payload = 'x' * 200000
+        sock.sendall(payload)
+        sock.shutdown(socket.SHUT_WR)
+        assert _recv_all(sock) == 'EARLY ' + payload.upper()
+        sock.close()
+
+        # the record is added once the tunnel has been handed off, and
+        # filled in as it runs.
+        for i in range(100):
+            if len(self.record_holder):
+                break
+            threading.Event().wait(0.05)
+
+        assert len(self.record_holder) == 1
+        record = self.record_holder[0]
+        assert record.environ['REQUEST_METHOD'] == 'CONNECT'
+        assert record.environ['scotch.tunnel'].wait(5)
+
+        tunnel = loads(dumps(record.environ['scotch.tunnel']))
+        assert tunnel.client is None
+        assert (tunnel.host, tunnel.port) == ('127.0.0.1',
+                                              self.echo.server_address[1])
+        assert tunnel.bytes_up == len(payload) + 6
+        assert tunnel.bytes_down == len(payload) + 6
+        assert tunnel.duration >= 0
+        assert tunnel.error is None
+
+    def test_single_threaded(self):
+        """
+        Keep serving requests while a tunnel is open, even with one
+        thread.
+        """
+        httpd = scotch.server.make_server(('127.0.0.1', 0),
+                                          scotch.proxy.ProxyApp(),
+                                          _QuietHandler)
+        thread = threading.Thread(target=httpd.serve_forever, args=(0.05,))
+        thread.start()
+
+        authority = '127.0.0.1:%d' % (self.echo.server_address[1],)
+        socks = []
+        try:
+            for i in range(2):
+                sock = socket.create_connection(httpd.socket.getsockname())
+                sock.settimeout(5)
+                sock.sendall('CONNECT %s HTTP/1.1\r\n\r\n' % (authority,))
+                socks.append(sock)
+
+                head = _read_head(sock)
+                assert head.split()[1] == '200', head
+
+            # both tunnels are open at once.
+            for (i, sock) in enumerate(socks):
+                sock.sendall('tunnel %d' % (i,))
+                assert sock.recv(100) == 'TUNNEL %d' % (i,)
+        finally:
+            for sock in socks:
+                sock.close()
+            httpd.shutdown()
+            thread.join()
+            httpd.server_close()
+
+    def test_idle(self):
+        """
+        Close a tunnel that's been idle too long.
+        """
+        idle, scotch.tunnel.Tunnel.IDLE_TIMEOUT = \
+              scotch.tunnel.Tunnel.IDLE_TIMEOUT, 0.5
+        try:
+            authority = '127.0.0.1:%d' % (self.echo.server_address[1],)
+            sock = self._connect(authority)
+            sock.settimeout(5)
+            assert _read_head(sock).split()[1] == '200'
+            assert _recv_all(sock) == ''
+            sock.close()
+        finally:
+            scotch.tunnel.Tunnel.IDLE_TIMEOUT = idle
+
+        for i in range(100):
+            if len(self.record_holder):
+                break
+            threading.Event().wait(0.05)
+
+        tunnel = self.record_holder[0].environ['scotch.tunnel']
+        assert tunnel.wait(5)
+        assert tunnel.error == 'idle timeout'
+
+    def test_bad_gateway(self):
+        """
+        Answer with a 502 when the upstream server can't be reached.
+        """
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+
+        sock = self._connect('127.0.0.1:%d' % (port,))
+        head = _read_head(sock)
+        sock.close()
+
+        assert head.split()[1] == '502', head
+
+    def test_refeed(self):
+        """
+        Play back a saved CONNECT record without going upstream.
+        """
+        from cStringIO import StringIO
+        import scotch.storage
+
+        authority = '127.0.0.1:%d' % (self.echo.server_address[1],)
+        sock = self._connect(authority)
+        assert _read_head(sock).split()[1] == '200'
+        sock.close()
+
+        for i in range(100):
+            if len(self.record_holder):
+                break
+            threading.Event().wait(0.05)
+        self.record_holder[0].environ['scotch.tunnel'].wait(5)
+
+        fp = StringIO()
+        scotch.storage.save_records(self.record_holder, fp)
+        fp.seek(0)
+        (record,) = list(scotch.storage.RecordReader(fp))
+        assert record.environ['scotch.tunnel'].client is None
+
+        n_connections = self.echo.n_connections
+        response = record.refeed(scotch.proxy.ProxyApp())
+
+        assert response.status == '200 Connection established'
+        assert response.get_output() == ''
+        assert self.echo.n_connections == n_connections
+
+    def test_not_supported(self):
+        """
+        Without TunnelRequestHandler, CONNECT gets a 501.
+        """
+        app = scotch.proxy.ProxyApp()
+        response = {}
+        def start_response(status, headers):
+            response['status'] = status
+
+        app({ 'REQUEST_METHOD' : 'CONNECT', 'PATH_INFO' : 'example.com:443' },
+            start_response)
+        assert response['status'].startswith('501')
+
+    def test_split_authority(self):
+        """
+        Split CONNECT authorities, including IPv6 literals.
+        """
+        split = scotch.tunnel.split_authority
+        assert split('example.com:8443') == ('example.com', 8443)
+        assert split('example.com') == ('example.com', 443)
+        assert split('[::1]:8443') == ('::1', 8443)
+        assert split('[::1]') == ('::1', 443)
@@ -0,0 +1,101 @@
+import _testlib
+_testlib._add_scotchdir_to_path()
+
+import sys, os, tempfile
+from cStringIO import StringIO
+
+from _testlib import make_record
+from scotch import storage, twill_commands
+
+def _quietly(fn, *args):
+    old, sys.stdout = sys.stdout, StringIO()
+    try:
+        fn(*args)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = old
+
+class TestNavigation:
+    def setup(self):
+        records = [ make_record('/page0', 'content of /page0'),
+                    make_record('/logo.png', 'content of /logo.png',
+                                content_type='image/png'),
+                    make_record('/moved', 'content of /moved',
+                                status='302 Found'),
+                    make_record('/page3', 'content of /page3'),
+                    make_record('/style.css', 'content of /style.css',
+                                content_type='text/css') ]
+
+        (fd, self.filename) = tempfile.mkstemp()
+        fp = os.fdopen(fd, 'wb')
+        storage.save_records(records, fp)
+        fp.close()
+
+        _quietly(twill_commands.load_recording, self.filename)
+
+    def teardown(self):
+        twill_commands.record_holder.reader.fp.close()
+        os.unlink(self.filename)
+
+    def test_next_prev(self):
+        """
+        Step through the primary pages, stopping at either end.
+        """
+        assert twill_commands.record_index == 0
+
+        _quietly(twill_commands.next_record)
+        assert twill_commands.record_index == 3
+
+        out = _quietly(twill_commands.next_record)
+        assert 'no more' in out
+        assert twill_commands.record_index == 3
+
+        _quietly(twill_commands.prev_record)
+        assert twill_commands.record_index == 0   # record 0 is reachable.
+
+        out = _quietly(twill_commands.prev_record)
+        assert 'no previous' in out
+        assert twill_commands.record_index == 0
+
+        _quietly(twill_commands.next_record, 'no_images')
+        assert twill_commands.record_index == 2
+
+        _quietly(twill_commands.next_record, '')
+        assert twill_commands.record_index == 3
+
+    def test_record_show(self):
+        """
+        Jump to a record, and read it from disk to show it.
+        """
+        twill_commands.record('5')
+        assert twill_commands.record_index == 4
+
+        out = _quietly(twill_commands.show_record, 'url', 'content')
+        assert '/style.css' in out
+        assert 'content of /style.css' in out
+
+        try:
+            twill_commands.record('6')
+            assert 0, "should have raised IndexError"
+        except IndexError:
+            pass
+
+    def test_printed_numbers(self):
+        """
+        The numbers next_record, prev_record & show_record print are the
+        ones 'record' takes.
+        """
+        out = _quietly(twill_commands.next_record)
+        n = out.split()[-1]
+        twill_commands.record_index = 0
+        twill_commands.record(n)
+        assert twill_commands.record_index == 3
+
+        out = _quietly(twill_commands.prev_record)
+        n = out.split()[-1]
+        twill_commands.record(n)
+        assert twill_commands.record_index == 0
+
+        out = _quietly(twill_commands.show_record, 'url')
+        assert 'Displaying record 1:' in out
+        assert '/page0' in out